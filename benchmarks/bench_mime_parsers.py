@@ -0,0 +1,41 @@
+"""
+Compare the body parsing engines of `GmailLoader` on the synthetic corpus.
+
+    python -m benchmarks.bench_mime_parsers [--iterations 50]
+"""
+import argparse
+import time
+
+from retriever.services.gmail import GmailLoader
+from retriever.services.gmail.parser import FAST, ITERATIVE, LEGACY
+
+from .corpus import build_corpus
+
+ENGINES = [FAST, LEGACY, ITERATIVE]
+
+
+def bench_engine(engine: str, resource: dict, iterations: int) -> float:
+    """
+    :return: Parsed messages per second.
+    """
+    loader = GmailLoader(parser_engine=engine)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        loader._parse_message_data(resource)
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    corpus = build_corpus()
+    print(f"{'message':<12}" + "".join(f"{engine + ' msg/s':>18}" for engine in ENGINES))
+    for kind, resource in corpus.items():
+        rates = [bench_engine(engine, resource, args.iterations) for engine in ENGINES]
+        print(f"{kind:<12}" + "".join(f"{rate:>18.1f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
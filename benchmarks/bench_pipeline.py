@@ -0,0 +1,235 @@
+"""
+Benchmark the stages of the ingestion pipeline: body parsing, listing with pagination, storage of listed messages
+and of their data with bulk queries, sender resolution, near-duplicate signatures, and the appends to and similarity
+queries over an embedding index. Results are saved as JSON, and compared with a previous run to catch regressions.
+
+    python -m benchmarks.bench_pipeline [--messages 2000] [--output results.json] [--baseline previous.json]
+
+Stages writing to the database need the Django settings (DJANGO_SETTINGS_MODULE, "core.settings" by default) and run
+in a transaction which is rolled back. `--no-db` skips them.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from retriever.services.embeddings import EmbeddingIndex, normalize
+from retriever.services.gmail import GmailLoader
+from retriever.services.gmail.parser import FULL, RAW
+from retriever.services.gmail.testing import FakeGmailService
+from retriever.services.near_duplicates import MinHasher
+from retriever.services.senders import parse_sender
+
+from .corpus import build_corpus, build_full_corpus
+from .harness import compare_results, load_results, measure, save_results
+
+# Distinct senders among the synthetic messages, mailboxes get most of their mail from a few senders
+SENDERS = 200
+# Dimensions of the synthetic embeddings, as many as small local embedding models
+EMBEDDING_DIMENSIONS = 384
+START_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+Stage = Callable[[], Dict[str, Any]]
+
+
+def make_messages_data(messages: int) -> List[Dict[str, Any]]:
+    """
+    Build the data the loader returns for `messages` distinct messages, with bodies taken from the corpus.
+    """
+    loader = GmailLoader()
+    bodies = [loader._parse_message_data(resource)["body"] for resource in build_corpus().values()]
+    return [
+        {
+            "id": f"m{i}",
+            "threadId": f"t{i // 3}",
+            "snippet": "Here is what happened this week",
+            "internalDate": str(int((START_DATE + timedelta(minutes=i)).timestamp() * 1000)),
+            "labelIds": ["INBOX", "CATEGORY_UPDATES"],
+            "historyId": str(i),
+            "subject": f"Weekly news #{i}",
+            "sender": f"Sender {i % SENDERS} <sender{i % SENDERS}@domain{i % SENDERS // 4}.example.com>",
+            "recipient": "me@example.com",
+            "copy": None,
+            "body": f"{bodies[i % len(bodies)]}\n{i}",
+        }
+        for i in range(messages)
+    ]
+
+
+def parsing_stages(iterations: int) -> Dict[str, Stage]:
+    stages = {}
+    loader = GmailLoader()
+    for message_format, corpus in ((RAW, build_corpus()), (FULL, build_full_corpus())):
+        for kind, resource in corpus.items():
+
+            def parse(resource=resource, message_format=message_format):
+                for _ in range(iterations):
+                    loader._parse_response(resource, message_format)
+
+            stages[f"parse.{message_format}.{kind}"] = lambda parse=parse: measure(parse, iterations)
+    return stages
+
+
+def listing_stages(messages: int) -> Dict[str, Stage]:
+    def setup():
+        loader = GmailLoader(results_per_page=500, max_results=None)
+        loader.service = FakeGmailService(dict.fromkeys((f"m{i}" for i in range(messages)), ""))
+        return (loader,)
+
+    def list_pages(loader):
+        for _ in loader.load_message_id_pages():
+            pass
+
+    return {"list.pages": lambda: measure(list_pages, messages, setup)}
+
+
+def sender_stages(messages: int) -> Dict[str, Stage]:
+    headers = [data["sender"] for data in make_messages_data(messages)]
+
+    def parse_senders():
+        parse_sender.cache_clear()
+        for header in headers:
+            parse_sender(header)
+
+    return {"senders.parse": lambda: measure(parse_senders, messages)}
+
+
+def near_duplicate_stages(messages: int) -> Dict[str, Stage]:
+    min_hasher = MinHasher()
+    texts = [f"{data['subject']}\n{data['body']}" for data in make_messages_data(messages)]
+
+    def sign():
+        for text in texts:
+            min_hasher.get_bands(min_hasher.get_signature(text))
+
+    return {"near_duplicates.sign": lambda: measure(sign, messages)}
+
+
+def embedding_stages(vectors: int, directory: str) -> Dict[str, Stage]:
+    matrix = normalize(np.random.default_rng(0).normal(size=(vectors, EMBEDDING_DIMENSIONS)).astype(np.float32))
+    indexes = iter(range(sys.maxsize))
+
+    def new_index():
+        return (EmbeddingIndex(os.path.join(directory, str(next(indexes)))),)
+
+    def append(index):
+        # Messages are embedded and appended a task chunk at a time
+        for start in range(0, vectors, 200):
+            index.append(range(start, start + 200), matrix[start : start + 200])
+
+    # The searched index is built once, the page cache holding it as for an active account
+    searched_index = EmbeddingIndex(os.path.join(directory, "search"))
+    searched_index.append(range(vectors), matrix)
+    return {
+        "embeddings.append": lambda: measure(append, vectors, new_index),
+        "embeddings.search": lambda: measure(lambda: searched_index.search(matrix[0], k=20, exclude=[0]), vectors),
+    }
+
+
+def database_stages(messages: int) -> Dict[str, Stage]:
+    from retriever.constants import GMAIL
+    from retriever.models import EmailAccount, EmailMessage, EmailMessageSender
+
+    messages_data = make_messages_data(messages)
+    listed = [{"id": data["id"], "threadId": data["threadId"]} for data in messages_data]
+    accounts = iter(range(sys.maxsize))
+
+    def new_account():
+        # Every run stores the messages again in a new account, so they are new to the Bloom filter and the table
+        return EmailAccount.objects.create(email=f"bench{next(accounts)}@example.com", service_type=GMAIL)
+
+    def new_listed_messages():
+        email_account = new_account()
+        email_account.store_message_ids(listed)
+        return (list(email_account.email_messages.order_by("id")), messages_data)
+
+    def new_unlinked_messages():
+        email_account = new_account()
+        EmailMessage.objects.bulk_create(
+            [
+                EmailMessage(
+                    external_id=data["id"],
+                    email_account=email_account,
+                    sender=data["sender"],
+                    received_at=START_DATE + timedelta(minutes=i),
+                )
+                for i, data in enumerate(messages_data)
+            ]
+        )
+        return (list(email_account.email_messages.order_by("id")),)
+
+    def link_senders(email_messages):
+        parse_sender.cache_clear()
+        EmailMessageSender.link_senders(email_messages)
+
+    return {
+        "store.message_ids": lambda: measure(
+            lambda email_account: email_account.store_message_ids(listed), messages, lambda: (new_account(),)
+        ),
+        "store.full_data": lambda: measure(EmailMessage.store_full_data, messages, new_listed_messages),
+        "senders.link": lambda: measure(link_senders, messages, new_unlinked_messages),
+    }
+
+
+def run_database_stages(stages: Dict[str, Stage]) -> Dict[str, Dict[str, Any]]:
+    from django.db import transaction
+
+    with transaction.atomic():
+        results = {name: stage() for name, stage in stages.items()}
+        transaction.set_rollback(True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000, help="Number of messages listed, stored and linked")
+    parser.add_argument("--iterations", type=int, default=50, help="Number of times each corpus message is parsed")
+    parser.add_argument("--vectors", type=int, default=100_000, help="Number of vectors of the embedding index")
+    parser.add_argument("--output", help="Path of the JSON file to save the results to")
+    parser.add_argument("--baseline", help="Path of the JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Accepted relative slowdown or memory growth")
+    parser.add_argument("--no-db", action="store_true", help="Skip the stages writing to the database")
+    args = parser.parse_args()
+
+    stages = {
+        **parsing_stages(args.iterations),
+        **listing_stages(args.messages),
+        **sender_stages(args.messages),
+        **near_duplicate_stages(args.messages),
+    }
+    results = {name: stage() for name, stage in stages.items()}
+    with tempfile.TemporaryDirectory() as directory:
+        results.update({name: stage() for name, stage in embedding_stages(args.vectors, directory).items()})
+    if not args.no_db:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+        import django
+
+        django.setup()
+        results.update(run_database_stages(database_stages(args.messages)))
+
+    print(f"{'stage':<28}{'messages':>10}{'msg/s':>14}{'peak KiB':>12}")
+    for name, result in results.items():
+        print(
+            f"{name:<28}{result['messages']:>10}{result['messages_per_second']:>14.1f}"
+            f"{result['peak_memory_bytes'] / 1024:>12.0f}"
+        )
+
+    options = {"messages": args.messages, "iterations": args.iterations, "vectors": args.vectors}
+    if args.output:
+        save_results(args.output, results, options)
+
+    if args.baseline:
+        baseline = load_results(args.baseline)
+        if baseline["options"] != options:
+            print(f"WARNING the baseline was run with other options: {baseline['options']}")
+        regressions = compare_results(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Synthetic MIME corpus for the benchmarks, covering the shapes of mail seen in real mailboxes.
+"""
+import base64
+import random
+from email.message import EmailMessage
+from typing import Any, Dict
+
+from retriever.services.gmail.testing import make_payload
+
+PARAGRAPH = (
+    "Thanks for being a subscriber. Here is what happened this week in the projects you follow, "
+    "with a short summary of every update and links to read more."
+)
+
+
+def _html_newsletter(paragraphs: int) -> str:
+    rows = "".join(
+        f"<tr><td><p>{PARAGRAPH}</p><a href='https://example.com/{i}'>Read more</a></td></tr>"
+        for i in range(paragraphs)
+    )
+    return (
+        "<html><head><style>td { padding: 4px; }</style><script>track()</script></head>"
+        f"<body><table>{rows}</table></body></html>"
+    )
+
+
+def _base_message(subject: str) -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = "Weekly News <news@example.com>"
+    message["To"] = "me@example.com"
+    message["List-Unsubscribe"] = "<mailto:unsubscribe@example.com>"
+    return message
+
+
+def plain_message() -> EmailMessage:
+    message = _base_message("Plain text")
+    message.set_content("\n\n".join([PARAGRAPH] * 20))
+    return message
+
+
+def html_message() -> EmailMessage:
+    message = _base_message("HTML only")
+    message.set_content(_html_newsletter(50), subtype="html")
+    return message
+
+
+def multipart_message() -> EmailMessage:
+    message = _base_message("Multipart alternative")
+    message.set_content("\n\n".join([PARAGRAPH] * 20))
+    message.add_alternative(_html_newsletter(50), subtype="html")
+    return message
+
+
+def attachment_message(size: int = 2 * 1024 * 1024) -> EmailMessage:
+    message = _base_message("Large attachment")
+    message.set_content("Please find the report attached.")
+    payload = random.Random(0).randbytes(size)
+    message.add_attachment(payload, maintype="application", subtype="pdf", filename="report.pdf")
+    return message
+
+
+def charset_message() -> EmailMessage:
+    message = _base_message("=?koi8-r?b?8NLJ18XU?=")
+    message.set_content("Привет, это письмо в кодировке KOI8-R.\n" * 50, charset="koi8-r")
+    message.add_alternative("<p>Caf\xe9 cr\xe8me br\xfbl\xe9e</p>" * 50, subtype="html", charset="iso-8859-1")
+    return message
+
+
+MESSAGE_FACTORIES = {
+    "plain": plain_message,
+    "html": html_message,
+    "multipart": multipart_message,
+    "attachment": attachment_message,
+    "charset": charset_message,
+}
+
+
+def to_resource(message_id: str, message: EmailMessage) -> Dict[str, str]:
+    """
+    Wrap a message as the resource returned by `messages.get` with format="raw".
+    """
+    raw = base64.urlsafe_b64encode(message.as_bytes()).decode("utf-8")
+    return {"id": message_id, "threadId": f"thread-{message_id}", "raw": raw}
+
+
+def to_full_resource(message_id: str, message: EmailMessage) -> Dict[str, Any]:
+    """
+    Wrap a message as the resource returned by `messages.get` and `threads.get` with format="full".
+    """
+    return {"id": message_id, "threadId": f"thread-{message_id}", "payload": make_payload(message)}
+
+
+def build_corpus() -> Dict[str, Dict[str, str]]:
+    """
+    One raw message resource per kind of message.
+    """
+    return {kind: to_resource(kind, factory()) for kind, factory in MESSAGE_FACTORIES.items()}
+
+
+def build_full_corpus() -> Dict[str, Dict[str, Any]]:
+    """
+    One "full" message resource per kind of message.
+    """
+    return {kind: to_full_resource(kind, factory()) for kind, factory in MESSAGE_FACTORIES.items()}
@@ -0,0 +1,100 @@
+"""
+Measure benchmark stages, and save and compare their results as JSON to catch regressions between runs.
+"""
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+
+def measure(
+    func: Callable[..., Any], messages: int, setup: Optional[Callable[[], tuple]] = None, repeat: int = 3
+) -> Dict[str, Any]:
+    """
+    Time a stage processing `messages` messages, keeping its best run, then run it once more under tracemalloc to
+    get its peak memory, which would otherwise slow the timed runs down.
+
+    :param func: The stage, called with the arguments returned by `setup`.
+    :param messages: The number of messages processed by one call of `func`.
+    :param setup: Prepares the arguments of each call, outside of the measures.
+    :param repeat: The number of timed runs.
+    :return: The measures of the stage.
+    """
+    setup = setup or tuple
+    seconds = float("inf")
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "messages": messages,
+        "seconds": round(seconds, 6),
+        "messages_per_second": round(messages / seconds, 1) if seconds else None,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def get_environment() -> Dict[str, Any]:
+    """
+    Describe where the results were measured, as they are only comparable on the same machine.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+    }
+
+
+def save_results(path: str, results: Dict[str, Dict[str, Any]], options: Dict[str, Any]) -> None:
+    with open(path, "w") as f:
+        json.dump({"environment": get_environment(), "options": options, "results": results}, f, indent=2)
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float = 0.2
+) -> List[str]:
+    """
+    Find the stages that got slower, or use more memory, than in a baseline run.
+
+    :param results: The results of the current run, by stage.
+    :param baseline: The results of the baseline run, by stage.
+    :param tolerance: Accepted relative change, as runs are noisy.
+    :return: A description of every regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        rate, previous_rate = result["messages_per_second"], previous["messages_per_second"]
+        if rate and previous_rate and rate < previous_rate * (1 - tolerance):
+            regressions.append(f"{name}: {previous_rate:.1f} -> {rate:.1f} msg/s")
+        memory, previous_memory = result["peak_memory_bytes"], previous["peak_memory_bytes"]
+        if previous_memory and memory > previous_memory * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {previous_memory / 1024:.0f} -> {memory / 1024:.0f} KiB")
+    return regressions
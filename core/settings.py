@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "main",
     "retriever",
     "django_celery_beat",
@@ -140,8 +141,90 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # merge base dir with env var
 GMAIL_CREDS_PATH = os.path.join(BASE_DIR, os.environ.get("GMAIL_CREDS_PATH", "config/credentials.json"))
 GMAIL_TOKEN_PATH = os.path.join(BASE_DIR, os.environ.get("GMAIL_TOKEN_PATH", "config/token.json"))
-SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+# OAuth scopes requested when authorizing an account. Labeling, archiving and trashing messages need the extra scope
+# "https://www.googleapis.com/auth/gmail.modify", and deleting them permanently "https://mail.google.com/"
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"] + env.list("GMAIL_EXTRA_SCOPES", default=[])
 
 # celery configs
 CELERY_BROKER_URL = "redis://localhost:6379/0"
 CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
+
+# Periodic syncs of every active account: Celery beat runs `schedule_syncs` every SYNC_TICK_SECONDS, which queues a
+# `sync_email_account` task for at most SYNC_MAX_ACCOUNTS_PER_TICK accounts due, the longest overdue first
+CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+SYNC_TICK_SECONDS = env.float("SYNC_TICK_SECONDS", default=60)
+SYNC_MAX_ACCOUNTS_PER_TICK = env.int("SYNC_MAX_ACCOUNTS_PER_TICK", default=50)
+CELERY_BEAT_SCHEDULE = {
+    "schedule-syncs": {"task": "retriever.tasks.schedule_syncs", "schedule": SYNC_TICK_SECONDS},
+}
+# Seconds between two syncs of an account, adapted to the rate at which its mail arrives so that a sync finds about
+# SYNC_TARGET_NEW_MESSAGES new messages; SYNC_RATE_SMOOTHING is the weight of the last sync in the rate
+SYNC_MIN_INTERVAL = env.float("SYNC_MIN_INTERVAL", default=120)
+SYNC_MAX_INTERVAL = env.float("SYNC_MAX_INTERVAL", default=6 * 3600)
+SYNC_TARGET_NEW_MESSAGES = env.float("SYNC_TARGET_NEW_MESSAGES", default=5)
+SYNC_RATE_SMOOTHING = env.float("SYNC_RATE_SMOOTHING", default=0.3)
+# Messages loaded by one sync of an account: the rest of a backlog is loaded by the next syncs, due at once but queued
+# behind the accounts already due, so a large mailbox takes turns with the others
+SYNC_MAX_MESSAGES_PER_RUN = env.int("SYNC_MAX_MESSAGES_PER_RUN", default=2000)
+# Seconds a sync holds its account, after which a crashed sync no longer blocks the next ones
+SYNC_LEASE_SECONDS = env.int("SYNC_LEASE_SECONDS", default=3600)
+# First listings of the accounts are split in windows of time of about LIST_PARTITION_SIZE messages, listed in parallel
+# by `list_email_messages_window` tasks instead of following a single chain of pages
+SYNC_PARTITIONED_LISTING = env.bool("SYNC_PARTITIONED_LISTING", default=True)
+LIST_PARTITION_SIZE = env.int("LIST_PARTITION_SIZE", default=5000)
+# Workers only reserve the task they run, so long syncs are spread over idle workers instead of queuing behind others
+CELERY_WORKER_PREFETCH_MULTIPLIER = env.int("CELERY_WORKER_PREFETCH_MULTIPLIER", default=1)
+
+# Number of messages loaded by one `fill_full_data_batch` task
+FILL_FULL_DATA_CHUNK_SIZE = env.int("FILL_FULL_DATA_CHUNK_SIZE", default=100)
+# Number of threads loaded by one `fill_threads_batch` task, each thread holding any number of messages
+FILL_THREADS_CHUNK_SIZE = env.int("FILL_THREADS_CHUNK_SIZE", default=20)
+
+# Local LLM sorting messages into categories, served by Ollama
+CLASSIFIER_MODEL = env.str("CLASSIFIER_MODEL", default="llama3")
+CLASSIFIER_OLLAMA_URL = env.str("CLASSIFIER_OLLAMA_URL", default="http://localhost:11434")
+CLASSIFIER_REQUEST_TIMEOUT = env.float("CLASSIFIER_REQUEST_TIMEOUT", default=300)
+CLASSIFIER_CATEGORIES = env.list(
+    "CLASSIFIER_CATEGORIES",
+    default=["personal", "work", "newsletter", "promotion", "notification", "social", "finance", "spam"],
+)
+# Number of messages classified by one prompt, and number of tokens of their bodies shown to the model
+CLASSIFIER_BATCH_SIZE = env.int("CLASSIFIER_BATCH_SIZE", default=8)
+CLASSIFIER_MAX_BODY_TOKENS = env.int("CLASSIFIER_MAX_BODY_TOKENS", default=256)
+# Number of messages classified by one `classify_email_messages` task
+CLASSIFY_CHUNK_SIZE = env.int("CLASSIFY_CHUNK_SIZE", default=200)
+
+# Near-duplicate messages (e.g. the issues of a newsletter) are grouped in clusters when their body is stored, by the
+# estimated Jaccard similarity of the word shingles of their subject and body
+NEAR_DUPLICATES_ENABLED = env.bool("NEAR_DUPLICATES_ENABLED", default=True)
+NEAR_DUPLICATE_THRESHOLD = env.float("NEAR_DUPLICATE_THRESHOLD", default=0.7)
+
+# Embeddings of the messages, computed by a local model served by Ollama and stored in memory-mapped files, an index
+# per account and model in EMBEDDINGS_DIR
+EMBEDDING_MODEL = env.str("EMBEDDING_MODEL", default="nomic-embed-text")
+EMBEDDING_OLLAMA_URL = env.str("EMBEDDING_OLLAMA_URL", default=CLASSIFIER_OLLAMA_URL)
+EMBEDDING_BATCH_SIZE = env.int("EMBEDDING_BATCH_SIZE", default=32)
+EMBEDDING_MAX_BODY_CHARS = env.int("EMBEDDING_MAX_BODY_CHARS", default=2000)
+EMBEDDINGS_DIR = env.str("EMBEDDINGS_DIR", default=os.path.join(BASE_DIR, "embeddings"))
+# Number of rows of an index scored at once by a similarity query, which bounds its memory
+EMBEDDINGS_CHUNK_ROWS = env.int("EMBEDDINGS_CHUNK_ROWS", default=65536)
+# Embed the messages as soon as their data is loaded by `fill_full_data_batch` and `fill_threads_batch`
+EMBEDDINGS_ON_INGEST = env.bool("EMBEDDINGS_ON_INGEST", default=False)
+# Number of messages embedded by one `embed_email_messages` task
+EMBED_CHUNK_SIZE = env.int("EMBED_CHUNK_SIZE", default=200)
+
+# Gmail API quota shared by all workers through Redis, per account (Gmail allows 250 quota units per user per second)
+GMAIL_RATE_LIMIT_ENABLED = env.bool("GMAIL_RATE_LIMIT_ENABLED", default=True)
+GMAIL_QUOTA_UNITS_PER_SECOND = env.int("GMAIL_QUOTA_UNITS_PER_SECOND", default=250)
+GMAIL_QUOTA_UNITS_BURST = env.int("GMAIL_QUOTA_UNITS_BURST", default=250)
+RATE_LIMIT_REDIS_URL = env.str("RATE_LIMIT_REDIS_URL", default=CELERY_BROKER_URL)
+
+# Pipeline metrics, added up in Redis by every process and served at /metrics in the Prometheus text format
+METRICS_ENABLED = env.bool("METRICS_ENABLED", default=True)
+METRICS_REDIS_URL = env.str("METRICS_REDIS_URL", default=CELERY_BROKER_URL)
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", default=10)
+# Bearer token required to read /metrics, which is open when empty
+METRICS_TOKEN = env.str("METRICS_TOKEN", default="")
+
+# Text search configuration used to index and search messages, e.g. "simple" for mailboxes in many languages
+EMAIL_SEARCH_CONFIG = env.str("EMAIL_SEARCH_CONFIG", default="english")
@@ -16,5 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import include, path
+from retriever import views
 
-urlpatterns = [path("admin/", admin.site.urls), path("advanced_filters/", include("advanced_filters.urls"))]
+urlpatterns = [
+    path("admin/metrics/", admin.site.admin_view(views.metrics_summary), name="metrics_summary"),
+    path("admin/", admin.site.urls),
+    path("advanced_filters/", include("advanced_filters.urls")),
+    path("metrics", views.metrics, name="metrics"),
+]
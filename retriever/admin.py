@@ -1,25 +1,85 @@
 from advanced_filters.admin import AdminAdvancedFiltersMixin
-from django.contrib import admin
-from django.db import models
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils import timezone
 
-from .models import EmailAccount, EmailMessage, EmailMessageSender
-from .tasks import fill_full_data
+from .models import EmailAccount, EmailMessage, EmailMessageCluster, EmailMessageSender, EmailThread
+from .services.gmail.gmail_loader import DELETE_SCOPES, METADATA, MODIFY_SCOPES
+from .tasks import (
+    enqueue_classify_email_messages,
+    enqueue_delete_email_messages_from_mailbox,
+    enqueue_embed_email_messages,
+    enqueue_fill_full_data,
+    enqueue_fill_threads,
+    enqueue_modify_email_messages,
+    list_email_messages_partitioned,
+)
 
 
 class EmailAccountAdmin(admin.ModelAdmin):
-    list_display = ("email", "service_type")
+    list_display = ("email", "service_type", "last_synced_at", "next_sync_at", "message_arrival_rate")
     search_fields = ("email",)
+    readonly_fields = (
+        "last_synced_at",
+        "sync_interval",
+        "message_arrival_rate",
+        "sync_lease_until",
+        "list_history_id",
+        "list_windows_left",
+    )
+
+    actions = ["run_sync", "run_partitioned_listing"]
+
+    def run_sync(self, request, queryset):
+        queryset.update(next_sync_at=timezone.now())
+
+    run_sync.short_description = "Sync selected EmailAccounts on the next run of the scheduler"
+
+    def run_partitioned_listing(self, request, queryset):
+        for email_account in queryset:
+            list_email_messages_partitioned.delay(email_account.id)
+
+    run_partitioned_listing.short_description = "List every message of selected EmailAccounts in parallel"
 
 
 admin.site.register(EmailAccount, EmailAccountAdmin)
 
 
+class EmailMessageActionForm(helpers.ActionForm):
+    labels = forms.CharField(required=False, help_text="Comma separated label names, to add or remove labels")
+
+
 class EmailMessageAdmin(AdminAdvancedFiltersMixin, admin.ModelAdmin):
-    list_display = ("external_id", "subject", "email_sender", "recipient")
+    list_display = ("external_id", "subject", "email_sender", "recipient", "category")
+    list_filter = ("category",)
     search_fields = ("subject", "sender", "recipient")
     sortable_by = ("subject",)
+    # Show the decoded body instead of a select of every stored body
+    exclude = ("body_content", "search_vector")
+    readonly_fields = ("body",)
+
+    actions = [
+        "run_load_full_data",
+        "run_load_metadata",
+        "run_load_threads",
+        "run_classify",
+        "run_embed",
+        "show_similar",
+        "show_near_duplicates",
+        "run_archive",
+        "run_trash",
+        "run_add_labels",
+        "run_remove_labels",
+        "run_delete_from_mailbox",
+    ]
+    action_form = EmailMessageActionForm
 
-    actions = ["run_load_full_data"]
+    # Number of messages shown by `show_similar`
+    similar_messages_limit = 100
 
     advanced_filter_fields = (
         "subject",
@@ -27,34 +87,204 @@ class EmailMessageAdmin(AdminAdvancedFiltersMixin, admin.ModelAdmin):
         "recipient",
     )
 
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Match the headers with the trigram indexed `search_fields`, or the full text search over subject, sender and
+        body, among the filtered messages. Full text matches come first, by relevance.
+        """
+        header_matches, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if not search_term:
+            return header_matches, may_have_duplicates
+        return queryset.search(search_term, other_matches=header_matches), may_have_duplicates
+
     def run_load_full_data(self, request, queryset):
-        for obj in queryset:
-            fill_full_data.delay(obj.id, "EmailMessage")
+        enqueue_fill_full_data(queryset)
 
     run_load_full_data.short_description = "Load full data for selected EmailMessages"
 
+    def run_load_metadata(self, request, queryset):
+        enqueue_fill_full_data(queryset, message_format=METADATA)
+
+    run_load_metadata.short_description = "Load headers only for selected EmailMessages"
+
+    def run_load_threads(self, request, queryset):
+        enqueue_fill_threads(queryset)
+
+    run_load_threads.short_description = "Load selected EmailMessages thread by thread"
+
+    def run_classify(self, request, queryset):
+        enqueue_classify_email_messages(queryset)
+
+    run_classify.short_description = "Classify selected EmailMessages"
+
+    def run_embed(self, request, queryset):
+        enqueue_embed_email_messages(queryset.filter(subject__isnull=False))
+
+    run_embed.short_description = "Compute embeddings of selected EmailMessages"
+
+    def show_similar(self, request, queryset):
+        """
+        List the selected message with the most similar ones, to run the other actions on them at once.
+        """
+        if queryset.count() != 1:
+            self.message_user(request, "Select a single EmailMessage to show similar ones", messages.WARNING)
+            return None
+
+        email_message = queryset.select_related("email_account", "body_content").get()
+        try:
+            similar = email_message.find_similar(limit=self.similar_messages_limit)
+        except Exception as e:
+            self.message_user(request, f"Can't find similar EmailMessages: {e}", messages.ERROR)
+            return None
+
+        ids = ",".join(str(m.id) for m in [email_message, *similar])
+        return HttpResponseRedirect(f"{reverse('admin:retriever_emailmessage_changelist')}?id__in={ids}")
+
+    show_similar.short_description = "Show EmailMessages similar to the selected one"
+
+    def show_near_duplicates(self, request, queryset):
+        """
+        List the messages of the clusters of the selected messages, to run the other actions on them at once.
+        """
+        cluster_ids = queryset.filter(cluster__isnull=False).values_list("cluster_id", flat=True).distinct()
+        return show_cluster_messages(cluster_ids)
+
+    show_near_duplicates.short_description = "Show near-duplicates of selected EmailMessages"
+
+    def run_archive(self, request, queryset):
+        if self._check_scopes(request, queryset, MODIFY_SCOPES):
+            enqueue_modify_email_messages(queryset, remove_labels=["INBOX"])
+
+    run_archive.short_description = "Archive selected EmailMessages in the mailbox"
+
+    def run_trash(self, request, queryset):
+        if self._check_scopes(request, queryset, MODIFY_SCOPES):
+            enqueue_modify_email_messages(queryset, add_labels=["TRASH"])
+
+    run_trash.short_description = "Move selected EmailMessages to the trash of the mailbox"
+
+    def run_add_labels(self, request, queryset):
+        labels = self._get_action_labels(request)
+        if labels and self._check_scopes(request, queryset, MODIFY_SCOPES):
+            enqueue_modify_email_messages(queryset, add_labels=labels)
+
+    run_add_labels.short_description = "Add labels to selected EmailMessages in the mailbox"
+
+    def run_remove_labels(self, request, queryset):
+        labels = self._get_action_labels(request)
+        if labels and self._check_scopes(request, queryset, MODIFY_SCOPES):
+            enqueue_modify_email_messages(queryset, remove_labels=labels)
+
+    run_remove_labels.short_description = "Remove labels from selected EmailMessages in the mailbox"
+
+    def run_delete_from_mailbox(self, request, queryset):
+        """
+        Delete the selected messages permanently, from the mailbox and the database, once confirmed.
+        """
+        if not self._check_scopes(request, queryset, DELETE_SCOPES):
+            return None
+        if request.POST.get("post"):
+            enqueue_delete_email_messages_from_mailbox(queryset)
+            self.message_user(request, f"Deleting {queryset.count()} EmailMessages from the mailbox")
+            return None
+
+        # Messages selected across pages are the filtered changelist, only the IDs checked on the page are posted back
+        # for the changelist to run the action again
+        select_across = request.POST.get("select_across") == "1"
+        if select_across:
+            selected_ids = request.POST.getlist(helpers.ACTION_CHECKBOX_NAME)
+        else:
+            selected_ids = queryset.values_list("pk", flat=True)
+        return TemplateResponse(
+            request,
+            "admin/retriever/delete_from_mailbox_confirmation.html",
+            {
+                **self.admin_site.each_context(request),
+                "title": "Delete from the mailbox?",
+                "opts": self.model._meta,
+                "queryset": queryset,
+                "count": queryset.count(),
+                "select_across": select_across,
+                "selected_ids": selected_ids,
+                "action_checkbox_name": helpers.ACTION_CHECKBOX_NAME,
+            },
+        )
+
+    run_delete_from_mailbox.short_description = "Delete selected EmailMessages permanently from the mailbox"
+
+    def _check_scopes(self, request, queryset, scopes):
+        """
+        Check that the accounts of the selected messages were granted one of the OAuth scopes, else ask to authorize
+        them again.
+        """
+        email_accounts = EmailAccount.objects.filter(id__in=queryset.values("email_account_id")).order_by("id")
+        unauthorized = [
+            email_account.email for email_account in email_accounts if not email_account.has_any_scope(scopes)
+        ]
+        if unauthorized:
+            self.message_user(
+                request,
+                f"Authorize {', '.join(unauthorized)} again with the {' or '.join(scopes)} scope, "
+                "see GMAIL_EXTRA_SCOPES",
+                messages.ERROR,
+            )
+        return not unauthorized
+
+    def _get_action_labels(self, request):
+        labels = [label.strip() for label in request.POST.get("labels", "").split(",") if label.strip()]
+        if not labels:
+            self.message_user(request, "Enter the labels in the Labels field", messages.WARNING)
+        return labels
+
+
+def show_cluster_messages(cluster_ids):
+    ids = ",".join(map(str, cluster_ids)) or "0"
+    return HttpResponseRedirect(f"{reverse('admin:retriever_emailmessage_changelist')}?cluster__id__in={ids}")
+
 
 admin.site.register(EmailMessage, EmailMessageAdmin)
 
 
+class EmailMessageClusterAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "representative_subject", "email_account", "number_of_messages", "updated_at")
+    list_filter = ("email_account",)
+    list_select_related = ("representative",)
+    ordering = ("-number_of_messages",)
+    raw_id_fields = ("representative",)
+    readonly_fields = ("number_of_messages",)
+
+    actions = ["show_messages"]
+
+    @admin.display(description="Subject")
+    def representative_subject(self, obj):
+        return obj.representative.subject if obj.representative else None
+
+    def show_messages(self, request, queryset):
+        return show_cluster_messages(queryset.values_list("id", flat=True))
+
+    show_messages.short_description = "Show EmailMessages of selected clusters"
+
+
+admin.site.register(EmailMessageCluster, EmailMessageClusterAdmin)
+
+
 class EmailMessageSenderAdmin(admin.ModelAdmin):
-    list_display = ("name", "email", "email_account", "number_of_emails")
+    list_display = ("name", "email", "email_account", "number_of_emails", "first_seen_at", "last_seen_at")
     search_fields = ("name", "email")
     list_filter = ("email_account",)
+    ordering = ("-number_of_emails",)
+    readonly_fields = ("number_of_emails", "first_seen_at", "last_seen_at")
 
-    def get_queryset(self, request):
-        return (
-            super()
-            .get_queryset(request)
-            .annotate(
-                number_of_emails=models.Count("email_messages"),
-            )
-        )
 
-    def number_of_emails(self, obj):
-        return obj.number_of_emails
+admin.site.register(EmailMessageSender, EmailMessageSenderAdmin)
 
-    number_of_emails.admin_order_field = "number_of_emails"
 
+class EmailThreadAdmin(admin.ModelAdmin):
+    list_display = ("subject", "email_account", "number_of_messages", "last_message_at")
+    search_fields = ("subject", "external_id")
+    list_filter = ("email_account",)
+    ordering = ("-last_message_at",)
+    readonly_fields = ("number_of_messages", "participants", "last_message_at")
 
-admin.site.register(EmailMessageSender, EmailMessageSenderAdmin)
+
+admin.site.register(EmailThread, EmailThreadAdmin)
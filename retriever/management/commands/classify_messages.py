@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailMessage
+from retriever.tasks import enqueue_classify_email_messages
+
+
+class Command(BaseCommand):
+    help = "Queue the classification of the loaded messages which have no category yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", default=None, help="Only classify the messages of this EmailAccount")
+        parser.add_argument("--all", action="store_true", help="Classify the messages with a category again")
+        parser.add_argument("--chunk-size", type=int, default=None, help="Number of messages classified per task")
+
+    def handle(self, *args, **options):
+        email_messages = EmailMessage.objects.filter(subject__isnull=False)
+        if not options["all"]:
+            email_messages = email_messages.filter(category__isnull=True)
+        if options["email"]:
+            email_messages = email_messages.filter(email_account__email=options["email"])
+
+        tasks = enqueue_classify_email_messages(email_messages.order_by("id"), chunk_size=options["chunk_size"])
+        self.stdout.write(f"Queued {tasks} tasks")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from retriever.models import EmailMessage
+from retriever.services.near_duplicates import get_min_hasher
+
+
+class Command(BaseCommand):
+    help = "Put the loaded messages stored before near-duplicates were detected in clusters of near-duplicates."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", default=None, help="Only cluster the messages of this EmailAccount")
+        parser.add_argument("--chunk-size", type=int, default=500, help="Number of messages clustered at once")
+
+    def handle(self, *args, **options):
+        if get_min_hasher() is None:
+            raise CommandError("Near-duplicate detection is disabled, see NEAR_DUPLICATES_ENABLED")
+
+        email_messages = EmailMessage.objects.filter(cluster__isnull=True, body_content__isnull=False)
+        if options["email"]:
+            email_messages = email_messages.filter(email_account__email=options["email"])
+        email_messages = email_messages.select_related("body_content").order_by("id")
+
+        last_id, clustered = 0, 0
+        while True:
+            chunk = list(email_messages.filter(id__gt=last_id)[: options["chunk_size"]])
+            if not chunk:
+                break
+            EmailMessage.update_clusters(chunk)
+            last_id, clustered = chunk[-1].id, clustered + len(chunk)
+            self.stdout.write(f"Clustered {clustered} messages")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailMessageBody
+
+
+class Command(BaseCommand):
+    help = "Delete the stored message bodies no message refers to anymore."
+
+    def handle(self, *args, **options):
+        deleted = EmailMessageBody.delete_unused()
+        self.stdout.write(f"Deleted {deleted} unused bodies")
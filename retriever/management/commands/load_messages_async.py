@@ -0,0 +1,65 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailAccount, EmailMessage
+from retriever.services import AsyncGmailLoader
+from retriever.services.metrics import get_metrics
+from retriever.services.rate_limit import get_rate_limiter
+
+
+class Command(BaseCommand):
+    help = "List the messages of an account and load their data with the asyncio Gmail loader, without Celery."
+
+    def add_arguments(self, parser):
+        parser.add_argument("email", help="Email address of the EmailAccount")
+        parser.add_argument("--query", default=None, help="Gmail search query")
+        parser.add_argument("--max-results", type=int, default=None, help="Maximum number of messages to list")
+        parser.add_argument("--concurrency", type=int, default=100, help="Number of requests in flight")
+        parser.add_argument("--chunk-size", type=int, default=500, help="Number of messages saved at once")
+        parser.add_argument("--metadata", action="store_true", help="Only load the headers of the messages")
+
+    def handle(self, *args, **options):
+        email_account = EmailAccount.objects.get(email=options["email"])
+        loader = AsyncGmailLoader(
+            query=options["query"],
+            results_per_page=500,
+            max_results=options["max_results"],
+            token=email_account.token,
+            concurrency=options["concurrency"],
+            message_format="metadata" if options["metadata"] else "raw",
+            metrics=get_metrics(),
+            metrics_key=email_account.pk,
+            rate_limiter=get_rate_limiter(),
+            rate_limit_key=email_account.pk,
+        )
+        failed = asyncio.run(self._load(email_account, loader, options["chunk_size"]))
+        email_account._store_token(loader.get_token())
+        if loader.metrics:
+            loader.metrics.flush()
+        self.stdout.write(f"Done, {failed} messages could not be loaded")
+
+    async def _load(self, email_account, loader, chunk_size):
+        failed = 0
+        async with loader:
+            # Every page is stored as soon as it is listed, so memory stays flat
+            async for messages, _ in loader.load_message_id_pages():
+                new_messages = await sync_to_async(email_account.store_message_ids)(messages)
+                self.stdout.write(f"Listed {len(messages)} messages, {len(new_messages)} of them new")
+            await sync_to_async(email_account.save_message_id_filter)()
+
+            # The messages to load are read a chunk at a time too, in the order of their IDs
+            unfilled = email_account.email_messages.filter(subject__isnull=True).order_by("id")
+            total = await sync_to_async(unfilled.count)()
+            loaded, last_id = 0, 0
+            while True:
+                chunk = await sync_to_async(list)(unfilled.filter(id__gt=last_id)[:chunk_size])
+                if not chunk:
+                    break
+                data = await loader.load_full_data_batch([email_message.external_id for email_message in chunk])
+                failed += len(await sync_to_async(EmailMessage.store_full_data)(chunk, data))
+                loaded, last_id = loaded + len(chunk), chunk[-1].id
+                self.stdout.write(f"Loaded {loaded}/{total} messages")
+
+        return failed
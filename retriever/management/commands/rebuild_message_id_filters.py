@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailAccount
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Bloom filters of the stored message IDs of the accounts from their messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", default=None, help="Only rebuild the filter of this EmailAccount")
+
+    def handle(self, *args, **options):
+        email_accounts = EmailAccount.objects.all()
+        if options["email"]:
+            email_accounts = email_accounts.filter(email=options["email"])
+
+        for email_account in email_accounts:
+            message_id_filter = email_account.rebuild_message_id_filter()
+            self.stdout.write(f"Rebuilt the filter of {email_account.email} with {len(message_id_filter)} IDs")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailAccount, EmailMessageSender, SenderDailyStat
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored message counts, first/last seen dates and daily stats of senders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", default=None, help="Only recompute the senders of this EmailAccount")
+
+    def handle(self, *args, **options):
+        email_accounts = EmailAccount.objects.all()
+        if options["email"]:
+            email_accounts = email_accounts.filter(email=options["email"])
+
+        for email_account in email_accounts:
+            updated = EmailMessageSender.recompute_counts(email_account.email_message_senders.all())
+            SenderDailyStat.recompute(email_account)
+            self.stdout.write(f"Recomputed {updated} senders of {email_account.email}")
@@ -0,0 +1,32 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailAccount, SenderDailyStat
+
+
+class Command(BaseCommand):
+    help = "Show the senders, or sender domains, of an account that sent the most messages over a time window."
+
+    def add_arguments(self, parser):
+        parser.add_argument("email", help="Email address of the EmailAccount")
+        parser.add_argument("--since", type=datetime.date.fromisoformat, help="First day, e.g. 2024-01-31")
+        parser.add_argument("--until", type=datetime.date.fromisoformat, help="Last day, e.g. 2024-12-31")
+        parser.add_argument("--days", type=int, help="Only the last N days, instead of --since")
+        parser.add_argument("--limit", type=int, default=20, help="Number of rows to show")
+        parser.add_argument("--domains", action="store_true", help="Group the senders by domain")
+
+    def handle(self, *args, **options):
+        email_account = EmailAccount.objects.get(email=options["email"])
+        since = options["since"]
+        if options["days"]:
+            since = datetime.date.today() - datetime.timedelta(days=options["days"] - 1)
+
+        if options["domains"]:
+            for row in SenderDailyStat.top_domains(email_account, since, options["until"], options["limit"]):
+                self.stdout.write(
+                    f"{row['number_of_emails']:>8}  {row['domain']} ({row['number_of_senders']} senders)"
+                )
+        else:
+            for row in SenderDailyStat.top_senders(email_account, since, options["until"], options["limit"]):
+                self.stdout.write(f"{row['number_of_emails']:>8}  {row['name'] or ''} <{row['email']}>")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailAccount, EmailMessage
+from retriever.tasks import enqueue_embed_email_messages
+
+
+class Command(BaseCommand):
+    help = "Queue the embedding of the loaded messages missing from the embedding indexes, or compact the indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", default=None, help="Only embed the messages of this EmailAccount")
+        parser.add_argument("--chunk-size", type=int, default=None, help="Number of messages embedded per task")
+        parser.add_argument(
+            "--compact", action="store_true", help="Remove the vectors of deleted messages instead of embedding"
+        )
+
+    def handle(self, *args, **options):
+        email_accounts = EmailAccount.objects.order_by("id")
+        if options["email"]:
+            email_accounts = email_accounts.filter(email=options["email"])
+
+        if options["compact"]:
+            for email_account in email_accounts:
+                removed = email_account.get_embedding_index().compact(
+                    email_account.email_messages.values_list("id", flat=True).iterator()
+                )
+                self.stdout.write(f"Removed {removed} vectors from the index of {email_account.email}")
+            return
+
+        email_messages = EmailMessage.objects.filter(subject__isnull=False, email_account__in=email_accounts)
+        tasks = enqueue_embed_email_messages(email_messages.order_by("id"), chunk_size=options["chunk_size"])
+        self.stdout.write(f"Queued {tasks} tasks")
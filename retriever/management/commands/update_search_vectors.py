@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from retriever.models import EmailMessage
+
+
+class Command(BaseCommand):
+    help = "Build the search vectors of the messages whose data was stored before they were maintained."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", default=None, help="Only update the messages of this EmailAccount")
+        parser.add_argument("--chunk-size", type=int, default=500, help="Number of messages updated at once")
+
+    def handle(self, *args, **options):
+        email_messages = EmailMessage.objects.filter(search_vector__isnull=True, subject__isnull=False)
+        if options["email"]:
+            email_messages = email_messages.filter(email_account__email=options["email"])
+        email_messages = email_messages.select_related("body_content").order_by("id")
+
+        last_id, updated = 0, 0
+        while True:
+            chunk = list(email_messages.filter(id__gt=last_id)[: options["chunk_size"]])
+            if not chunk:
+                break
+            EmailMessage.update_search_vectors(chunk)
+            last_id, updated = chunk[-1].id, updated + len(chunk)
+            self.stdout.write(f"Updated {updated} messages")
@@ -1,19 +1,98 @@
-from django.db import models
+from datetime import timezone
 
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import models, transaction
+from django.db.models.functions import TruncDate
 
-class EmailMessageSenderManager(models.Manager):
-    # add custom annotation to base queryset
-    def get_queryset(self):
+
+class EmailMessageQuerySet(models.QuerySet):
+    def search(self, terms, other_matches=None):
         """
-        - Add number of emails sent by this sender to the queryset
-        - Add number of Items in the EmailMessageSender table with the same `email` field
+        - Filter the messages matching the search terms in their subject, sender or body
+        - Order them by relevance, the subject weighing most, then the sender
+        :param terms: Search terms in the web search syntax, e.g. `invoice -paid "due date"`
+        :param other_matches: Messages matched otherwise (e.g. by header substrings) to keep, ranked last
         :return:
         """
-
+        query = SearchQuery(terms, search_type="websearch", config=settings.EMAIL_SEARCH_CONFIG)
+        condition = models.Q(search_vector=query)
+        if other_matches is not None:
+            condition |= models.Q(pk__in=other_matches.values("pk"))
         return (
-            super()
-            .get_queryset()
-            .annotate(
-                number_of_emails=models.Count("email_messages"),
-            )
+            self.filter(condition)
+            .annotate(rank=SearchRank(models.F("search_vector"), query))
+            .order_by("-rank", "-received_at")
         )
+
+    def modify_labels(self, add_labels=(), remove_labels=()):
+        """
+        - Add and remove labels of the messages in their mailboxes, with one API call per 1000 messages
+        - Update their stored labels in bulk
+        :param add_labels: Names or IDs of the labels to add, the missing ones are created in the mailboxes
+        :param remove_labels: Names or IDs of the labels to remove
+        :return: The number of modified messages
+        """
+        return sum(
+            email_account.modify_messages(self, add_labels, remove_labels)
+            for email_account in self._email_accounts()
+        )
+
+    def archive(self):
+        return self.modify_labels(remove_labels=["INBOX"])
+
+    def trash(self):
+        return self.modify_labels(add_labels=["TRASH"])
+
+    def delete_from_mailbox(self):
+        """
+        - Delete the messages permanently from their mailboxes, with one API call per 1000 messages
+        - Delete them from the database
+        :return: The number of deleted messages
+        """
+        return sum(email_account.delete_messages(self) for email_account in self._email_accounts())
+
+    def _email_accounts(self):
+        account_model = self.model._meta.get_field("email_account").related_model
+        return account_model.objects.filter(id__in=self.values("email_account_id")).order_by("id")
+
+    def delete(self):
+        """
+        - Delete the messages
+        - Take them off the stored message counts and daily stats of their senders, and the counts of their clusters
+        :return:
+        """
+        sender_model = self.model._meta.get_field("email_sender").related_model
+        daily_stat_model = sender_model._meta.get_field("daily_stats").related_model
+        cluster_model = self.model._meta.get_field("cluster").related_model
+
+        with transaction.atomic():
+            counts = (
+                self.filter(email_sender__isnull=False)
+                .order_by()
+                .values_list("email_sender", TruncDate("received_at", tzinfo=timezone.utc))
+                .annotate(count=models.Count("id"))
+            )
+            changes, daily_changes = {}, {}
+            for sender_id, day, count in counts:
+                changes[sender_id] = (changes.get(sender_id, (0,))[0] - count, None, None)
+                if day:
+                    daily_changes[sender_id, day] = -count
+            cluster_counts = (
+                self.filter(cluster__isnull=False)
+                .order_by()
+                .values_list("cluster")
+                .annotate(count=models.Count("id"))
+            )
+            clusters_by_count = {}
+            for cluster_id, count in cluster_counts:
+                clusters_by_count.setdefault(count, []).append(cluster_id)
+            deleted = super().delete()
+            sender_model.update_counts(changes)
+            daily_stat_model.update_counts(daily_changes)
+            for count, cluster_ids in clusters_by_count.items():
+                cluster_model.objects.filter(id__in=cluster_ids).update(
+                    number_of_messages=models.F("number_of_messages") - count
+                )
+
+        return deleted
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0005_emailmessagesender_emailmessage_email_sender"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailaccount",
+            name="history_id",
+            field=models.CharField(blank=True, max_length=5000, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0006_emailaccount_history_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailmessage",
+            name="list_unsubscribe",
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
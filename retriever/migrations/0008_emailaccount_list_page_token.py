@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0007_emailmessage_list_unsubscribe"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailaccount",
+            name="list_page_token",
+            field=models.CharField(blank=True, max_length=5000, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0008_emailaccount_list_page_token"),
+    ]
+
+    operations = [
+        # Keep one row per (email_account, external_id), preferring a row whose data was already loaded
+        migrations.RunSQL(
+            sql="""
+                DELETE FROM retriever_emailmessage
+                WHERE id IN (
+                    SELECT id FROM (
+                        SELECT
+                            id,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY email_account_id, external_id ORDER BY subject IS NULL, id
+                            ) AS position
+                        FROM retriever_emailmessage
+                        WHERE external_id IS NOT NULL
+                    ) AS duplicates
+                    WHERE position > 1
+                )
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="emailmessage",
+            constraint=models.UniqueConstraint(
+                fields=("email_account", "external_id"), name="unique_email_message_external_id"
+            ),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:40
+
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+CHUNK_SIZE = 500
+
+
+def move_bodies(apps, schema_editor):
+    EmailMessage = apps.get_model("retriever", "EmailMessage")
+    EmailMessageBody = apps.get_model("retriever", "EmailMessageBody")
+
+    last_id = 0
+    while True:
+        email_messages = list(
+            EmailMessage.objects.filter(id__gt=last_id, body__isnull=False)
+            .order_by("id")
+            .only("id", "body")[:CHUNK_SIZE]
+        )
+        if not email_messages:
+            return
+
+        bodies = {}
+        for email_message in email_messages:
+            data = email_message.body.encode("utf-8")
+            email_message.body_hash = hashlib.sha256(data).hexdigest()
+            bodies.setdefault(email_message.body_hash, data)
+
+        EmailMessageBody.objects.bulk_create(
+            [EmailMessageBody(hash=body_hash, content=zlib.compress(data)) for body_hash, data in bodies.items()],
+            ignore_conflicts=True,
+        )
+        ids = dict(EmailMessageBody.objects.filter(hash__in=bodies).values_list("hash", "id"))
+        for email_message in email_messages:
+            email_message.body_content_id = ids[email_message.body_hash]
+        EmailMessage.objects.bulk_update(email_messages, ["body_content"])
+        last_id = email_messages[-1].id
+
+
+def restore_bodies(apps, schema_editor):
+    EmailMessage = apps.get_model("retriever", "EmailMessage")
+
+    email_messages = EmailMessage.objects.filter(body_content__isnull=False).select_related("body_content")
+    for email_message in email_messages.iterator(chunk_size=CHUNK_SIZE):
+        email_message.body = zlib.decompress(email_message.body_content.content).decode("utf-8")
+        email_message.save(update_fields=["body"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0009_emailmessage_unique_email_message_external_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmailMessageBody",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID"),
+                ),
+                ("hash", models.CharField(max_length=64, unique=True)),
+                ("content", models.BinaryField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="body_content",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="email_messages",
+                to="retriever.emailmessagebody",
+            ),
+        ),
+        migrations.RunPython(move_bodies, restore_bodies),
+        migrations.RemoveField(
+            model_name="emailmessage",
+            name="body",
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.9 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+# Senders of an account sharing an address once normalized, with the sender each of them is merged into
+DUPLICATE_SENDERS = """
+    SELECT id, MIN(id) OVER (PARTITION BY email_account_id, email) AS kept_id
+    FROM retriever_emailmessagesender
+    WHERE email IS NOT NULL
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0010_emailmessagebody_move_bodies"),
+    ]
+
+    operations = [
+        # Normalize addresses, move messages to the first sender of each address, and delete the other senders.
+        # Foreign keys are checked right away, so the table can be altered in the same transaction.
+        migrations.RunSQL(
+            sql=[
+                "SET CONSTRAINTS ALL IMMEDIATE",
+                "UPDATE retriever_emailmessagesender SET email = LOWER(TRIM(email)) WHERE email IS NOT NULL",
+                f"""
+                    UPDATE retriever_emailmessage SET email_sender_id = duplicates.kept_id
+                    FROM ({DUPLICATE_SENDERS}) AS duplicates
+                    WHERE email_sender_id = duplicates.id AND duplicates.id <> duplicates.kept_id
+                """,
+                f"""
+                    DELETE FROM retriever_emailmessagesender
+                    WHERE id IN (SELECT id FROM ({DUPLICATE_SENDERS}) AS duplicates WHERE id <> kept_id)
+                """,
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="emailmessagesender",
+            constraint=models.UniqueConstraint(
+                fields=("email_account", "email"), name="unique_email_message_sender_email"
+            ),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0011_emailmessagesender_unique_email_message_sender_email"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailmessage",
+            name="received_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailmessagesender",
+            name="first_seen_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailmessagesender",
+            name="last_seen_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailmessagesender",
+            name="number_of_emails",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessagesender",
+            index=models.Index(fields=["email_account", "-number_of_emails"], name="sender_number_of_emails_idx"),
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                    UPDATE retriever_emailmessage
+                    SET received_at = TO_TIMESTAMP(internal_date::bigint / 1000.0)
+                    WHERE internal_date ~ '^[0-9]+$'
+                """,
+                """
+                    UPDATE retriever_emailmessagesender
+                    SET number_of_emails = counts.number_of_emails,
+                        first_seen_at = counts.first_seen_at,
+                        last_seen_at = counts.last_seen_at
+                    FROM (
+                        SELECT
+                            email_sender_id,
+                            COUNT(*) AS number_of_emails,
+                            MIN(received_at) AS first_seen_at,
+                            MAX(received_at) AS last_seen_at
+                        FROM retriever_emailmessage
+                        WHERE email_sender_id IS NOT NULL
+                        GROUP BY email_sender_id
+                    ) AS counts
+                    WHERE id = counts.email_sender_id
+                """,
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0012_emailmessage_received_at_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SenderDailyStat",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID"),
+                ),
+                ("domain", models.CharField(max_length=5000)),
+                ("day", models.DateField()),
+                ("number_of_emails", models.IntegerField(default=0)),
+                (
+                    "email_account",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sender_daily_stats",
+                        to="retriever.emailaccount",
+                    ),
+                ),
+                (
+                    "email_sender",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="daily_stats",
+                        to="retriever.emailmessagesender",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["email_account", "day"],
+                        include=("email_sender", "domain", "number_of_emails"),
+                        name="sender_daily_stat_account_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="senderdailystat",
+            constraint=models.UniqueConstraint(fields=("email_sender", "day"), name="unique_sender_daily_stat_day"),
+        ),
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO retriever_senderdailystat
+                    (email_account_id, email_sender_id, domain, day, number_of_emails)
+                SELECT
+                    sender.email_account_id, sender.id, SPLIT_PART(sender.email, '@', 2), messages.day, messages.count
+                FROM (
+                    SELECT email_sender_id, (received_at AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS count
+                    FROM retriever_emailmessage
+                    WHERE email_sender_id IS NOT NULL AND received_at IS NOT NULL
+                    GROUP BY 1, 2
+                ) AS messages
+                JOIN retriever_emailmessagesender AS sender ON sender.id = messages.email_sender_id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:38
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.functions.text
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0013_senderdailystat_and_more"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="email_message_search_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("subject"), name="gin_trgm_ops"
+                ),
+                name="email_message_subject_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("sender"), name="gin_trgm_ops"
+                ),
+                name="email_message_sender_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("recipient"), name="gin_trgm_ops"
+                ),
+                name="email_message_recipient_trgm",
+            ),
+        ),
+    ]
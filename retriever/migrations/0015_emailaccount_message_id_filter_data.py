@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0014_emailmessage_search_vector_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailaccount",
+            name="message_id_filter_data",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:43
+
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0015_emailaccount_message_id_filter_data"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmailThread",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID"),
+                ),
+                ("is_active", models.BooleanField(default=True)),
+                ("uuid", models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("raw_data", models.JSONField(default=dict)),
+                ("external_id", models.CharField(max_length=5000)),
+                ("history_id", models.CharField(blank=True, max_length=5000, null=True)),
+                ("subject", models.CharField(blank=True, max_length=5000, null=True)),
+                ("number_of_messages", models.PositiveIntegerField(default=0)),
+                ("participants", models.JSONField(blank=True, default=list)),
+                ("last_message_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "email_account",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="email_threads",
+                        to="retriever.emailaccount",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="email_thread",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="email_messages",
+                to="retriever.emailthread",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailthread",
+            index=models.Index(fields=["email_account", "-last_message_at"], name="email_thread_last_message_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="emailthread",
+            constraint=models.UniqueConstraint(
+                fields=("email_account", "external_id"), name="unique_email_thread_external_id"
+            ),
+        ),
+    ]
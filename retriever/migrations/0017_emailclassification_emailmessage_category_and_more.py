@@ -0,0 +1,38 @@
+# Generated by Django 4.2.9 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0016_emailthread_emailmessage_email_thread_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmailClassification",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID"),
+                ),
+                ("hash", models.CharField(max_length=64)),
+                ("version", models.CharField(max_length=5000)),
+                ("category", models.CharField(max_length=100)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="category",
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=models.Index(fields=["email_account", "category"], name="email_message_category_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="emailclassification",
+            constraint=models.UniqueConstraint(fields=("hash", "version"), name="unique_email_classification_hash"),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 4.2.9 on 2026-10-18 11:02
+
+import uuid
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0017_emailclassification_emailmessage_category_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailmessage",
+            name="minhash",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name="EmailMessageCluster",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID"),
+                ),
+                ("is_active", models.BooleanField(default=True)),
+                ("uuid", models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("raw_data", models.JSONField(default=dict)),
+                ("minhash", models.BinaryField()),
+                (
+                    "lsh_bands",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.BigIntegerField(), editable=False, size=None
+                    ),
+                ),
+                ("number_of_messages", models.PositiveIntegerField(default=0)),
+                (
+                    "email_account",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="email_message_clusters",
+                        to="retriever.emailaccount",
+                    ),
+                ),
+                (
+                    "representative",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="retriever.emailmessage",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="cluster",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="email_messages",
+                to="retriever.emailmessagecluster",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessagecluster",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["lsh_bands"], name="email_cluster_lsh_bands_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessagecluster",
+            index=models.Index(fields=["email_account", "-number_of_messages"], name="email_cluster_size_idx"),
+        ),
+    ]
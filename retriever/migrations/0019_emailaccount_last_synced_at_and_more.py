@@ -0,0 +1,37 @@
+# Generated by Django 4.2.9 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0018_emailmessage_minhash_emailmessagecluster_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailaccount",
+            name="last_synced_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailaccount",
+            name="message_arrival_rate",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailaccount",
+            name="next_sync_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailaccount",
+            name="sync_interval",
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailaccount",
+            name="sync_lease_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.9 on 2026-10-18 11:19
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0019_emailaccount_last_synced_at_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailaccount",
+            name="list_history_id",
+            field=models.CharField(blank=True, max_length=5000, null=True),
+        ),
+        migrations.AddField(
+            model_name="emailaccount",
+            name="list_windows_left",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.BigIntegerField(), blank=True, default=list, size=None
+            ),
+        ),
+    ]
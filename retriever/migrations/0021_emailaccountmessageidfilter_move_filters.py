@@ -0,0 +1,56 @@
+# Generated by Django 4.2.9 on 2026-10-18 11:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_filters(apps, schema_editor):
+    EmailAccount = apps.get_model("retriever", "EmailAccount")
+    EmailAccountMessageIdFilter = apps.get_model("retriever", "EmailAccountMessageIdFilter")
+
+    # One account at a time, the filters of large mailboxes weigh megabytes
+    email_accounts = EmailAccount.objects.filter(message_id_filter_data__isnull=False)
+    for email_account_id in email_accounts.values_list("id", flat=True):
+        data = EmailAccount.objects.values_list("message_id_filter_data", flat=True).get(id=email_account_id)
+        EmailAccountMessageIdFilter.objects.create(email_account_id=email_account_id, data=data)
+
+
+def restore_filters(apps, schema_editor):
+    EmailAccount = apps.get_model("retriever", "EmailAccount")
+    EmailAccountMessageIdFilter = apps.get_model("retriever", "EmailAccountMessageIdFilter")
+
+    for email_account_id in EmailAccountMessageIdFilter.objects.values_list("email_account_id", flat=True):
+        data = EmailAccountMessageIdFilter.objects.values_list("data", flat=True).get(
+            email_account_id=email_account_id
+        )
+        EmailAccount.objects.filter(id=email_account_id).update(message_id_filter_data=data)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retriever", "0020_emailaccount_list_history_id_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmailAccountMessageIdFilter",
+            fields=[
+                (
+                    "email_account",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="message_id_filter_row",
+                        serialize=False,
+                        to="retriever.emailaccount",
+                    ),
+                ),
+                ("data", models.BinaryField()),
+            ],
+        ),
+        migrations.RunPython(move_filters, restore_filters),
+        migrations.RemoveField(
+            model_name="emailaccount",
+            name="message_id_filter_data",
+        ),
+    ]
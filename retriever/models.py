@@ -1,9 +1,43 @@
 # Create your models here.
+import hashlib
+import logging
+import os
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from functools import cached_property
+
 from core.base.models import BaseData
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models.functions import Coalesce, Greatest, Least, Upper
+from django.utils import timezone
 
 from retriever.constants import EmailAccountTypes
-from retriever.managers import EmailMessageSenderManager
+from retriever.managers import EmailMessageQuerySet
+from retriever.services import HistoryExpiredError
+from retriever.services.bloom import MessageIdFilter
+from retriever.services.classifier import get_classifier
+from retriever.services.embeddings import EmbeddingIndex, get_embedder
+from retriever.services.gmail.gmail_loader import MAX_MODIFY_BATCH_SIZE, METADATA, get_date_query
+from retriever.services.metrics import get_metrics, increment, timed_write
+from retriever.services.near_duplicates import get_min_hasher
+from retriever.services.pool import loader_pool
+from retriever.services.rate_limit import get_rate_limiter
+from retriever.services.senders import parse_addresses, parse_sender
+
+logger = logging.getLogger(__name__)
+
+# Upper bound of rows inserted by a single INSERT statement
+BULK_CREATE_BATCH_SIZE = 500
+
+# Only the beginning of long bodies is indexed for search, tsvector values are limited to 1MB
+SEARCH_BODY_MAX_LENGTH = 100_000
 
 
 class EmailAccount(BaseData):
@@ -12,36 +46,503 @@ class EmailAccount(BaseData):
     token = models.JSONField(null=True, blank=True)
     # Field for the showing it is using which service (Gmail, Outlook, etc.)
     service_type = models.CharField(max_length=5000, null=True, blank=True, choices=EmailAccountTypes.get_choices())
+    # High-water mark of the last sync, changes after it are loaded incrementally
+    history_id = models.CharField(max_length=5000, null=True, blank=True)
+    # Token of the next page of an unfinished listing, to resume it
+    list_page_token = models.CharField(max_length=5000, null=True, blank=True)
+    # Schedule of the periodic syncs, see `claim_due_syncs` and `schedule_next_sync`
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    next_sync_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    sync_interval = models.DurationField(null=True, blank=True)
+    # Moving average of the number of messages added to the mailbox per hour
+    message_arrival_rate = models.FloatField(null=True, blank=True)
+    # Time until which a sync holds the account, so it is never synced twice at once
+    sync_lease_until = models.DateTimeField(null=True, blank=True)
+    # History ID taken when the running partitioned listing started, and starts of its windows left to list
+    list_history_id = models.CharField(max_length=5000, null=True, blank=True)
+    list_windows_left = ArrayField(models.BigIntegerField(), default=list, blank=True)
 
     def get_loader_class(self, results_per_page=10, max_results=10):
-        loader = EmailAccountTypes.get(self.service_type)["loader_class"](
+        loader = self._build_loader(results_per_page=results_per_page, max_results=max_results)
+        self._store_token(loader.get_token())
+        return loader
+
+    @contextmanager
+    def loader(self, results_per_page=10, max_results=10):
+        """
+        Borrow a loader for this account from the process-wide pool, so the API client and its connections are
+        reused across tasks instead of being rebuilt for every message.
+        """
+        with loader_pool.get(self.pk, self._build_loader) as loader:
+            loader.results_per_page = results_per_page
+            loader.max_results = max_results
+            yield loader
+            self._store_token(loader.get_token())
+
+    def _build_loader(self, results_per_page=10, max_results=10):
+        return EmailAccountTypes.get(self.service_type)["loader_class"](
             creds=self.creds,
             token=self.token,
             results_per_page=results_per_page,
             max_results=max_results,
+            rate_limiter=get_rate_limiter(),
+            rate_limit_key=self.pk,
+            metrics=get_metrics(),
         )
-        self.token = loader.get_token()
-        self.save()
-        return loader
 
-    def _load_ids_with_loader(self, results_per_page=10, max_results=10):
-        loader = self.get_loader_class(results_per_page=results_per_page, max_results=max_results)
-        return loader.load_message_ids()
+    def has_any_scope(self, scopes):
+        """
+        Whether the token of the account was granted one of the OAuth scopes, e.g. before modifying its mailbox.
+        """
+        granted = (self.token or {}).get("scopes") or []
+        if isinstance(granted, str):
+            granted = granted.split()
+        return not set(scopes).isdisjoint(granted)
+
+    def _store_token(self, token):
+        # Only write the account row when the token was actually refreshed
+        if token != self.token:
+            self.token = token
+            self.save(update_fields=["token", "updated_at"])
+
+    def load_ids_to_email_messages(self, results_per_page=10, max_results=10, resume=False, listed_ids=None):
+        """
+        List the messages of the mailbox and store them page by page, so memory stays flat and rows are available
+        while the listing goes on.
+
+        The token of the next page is saved after each page, and `resume=True` continues from it. Messages that are
+        already stored are skipped, so listing again is safe.
+
+        :param listed_ids: A set the external IDs of the listed messages are added to, if given.
+        """
+        page_token = self.list_page_token if resume else None
+
+        with self.loader(results_per_page=results_per_page, max_results=max_results) as loader:
+            for messages, next_page_token in loader.load_message_id_pages(page_token=page_token):
+                if listed_ids is not None:
+                    listed_ids.update(message["id"] for message in messages)
+                new_messages = self.store_message_ids(messages)
+                self.list_page_token = next_page_token
+                self.save(update_fields=["list_page_token", "updated_at"])
+                logger.info("Added %s messages to %s", len(new_messages), self.email)
+
+        self.save_message_id_filter()
+
+    @timed_write("store_message_ids")
+    def store_message_ids(self, messages):
+        """
+        Store listed messages, skipping the ones already stored.
+
+        Only the messages in the Bloom filter of stored IDs are looked up in the database, the others are new. The
+        filter is updated in memory, `save_message_id_filter` saves it.
+        :return: The newly stored messages.
+        """
+        stored_ids = self._get_stored_external_ids([d["id"] for d in messages])
+        new_messages = [d for d in messages if d["id"] not in stored_ids]
+        EmailMessage.objects.bulk_create(
+            [EmailMessage(external_id=d["id"], thread_id=d["threadId"], email_account=self) for d in new_messages],
+            batch_size=BULK_CREATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        self._add_message_ids(d["id"] for d in new_messages)
+        return new_messages
+
+    @cached_property
+    def message_id_filter(self):
+        """
+        The Bloom filter of the external IDs of the stored messages, built from them when it was never saved.
+
+        A filter missing some IDs (e.g. not saved after a crash) is safe, those IDs are stored again without
+        creating duplicates.
+        """
+        data = EmailAccountMessageIdFilter.objects.filter(email_account=self).values_list("data", flat=True).first()
+        if data is None:
+            return self.rebuild_message_id_filter()
+        return MessageIdFilter.from_bytes(bytes(data))
+
+    def rebuild_message_id_filter(self):
+        """
+        Build the Bloom filter of the external IDs of the stored messages again, and save it.
+        """
+        with transaction.atomic():
+            EmailAccount.objects.select_for_update().values_list("pk", flat=True).get(pk=self.pk)
+            message_id_filter = self._build_message_id_filter()
+            EmailAccountMessageIdFilter.objects.update_or_create(
+                email_account=self, defaults={"data": message_id_filter.to_bytes()}
+            )
+        self.message_id_filter = message_id_filter
+        self._unsaved_message_ids.clear()
+        return message_id_filter
+
+    def save_message_id_filter(self):
+        """
+        Add the IDs stored since the last save to the saved Bloom filter, nothing is written when there are none.
+
+        The saved filter is read again under a lock of the account row and the IDs are merged into it, so that
+        processes saving concurrently don't drop each other's IDs.
+        """
+        if not self._unsaved_message_ids:
+            return
+        with transaction.atomic():
+            EmailAccount.objects.select_for_update().values_list("pk", flat=True).get(pk=self.pk)
+            data = (
+                EmailAccountMessageIdFilter.objects.filter(email_account=self)
+                .values_list("data", flat=True)
+                .first()
+            )
+            if data is None:
+                message_id_filter = self._build_message_id_filter()
+            else:
+                message_id_filter = MessageIdFilter.from_bytes(bytes(data))
+                message_id_filter.add_many(self._unsaved_message_ids)
+            EmailAccountMessageIdFilter.objects.update_or_create(
+                email_account=self, defaults={"data": message_id_filter.to_bytes()}
+            )
+        self.message_id_filter = message_id_filter
+        self._unsaved_message_ids.clear()
+
+    @cached_property
+    def _unsaved_message_ids(self):
+        # External IDs added to the Bloom filter in memory but not saved yet
+        return []
+
+    def _add_message_ids(self, external_ids):
+        external_ids = list(external_ids)
+        self.message_id_filter.add_many(external_ids)
+        self._unsaved_message_ids.extend(external_ids)
+
+    def _build_message_id_filter(self):
+        message_id_filter = MessageIdFilter()
+        message_id_filter.add_many(
+            self.email_messages.values_list("external_id", flat=True).iterator(chunk_size=BULK_CREATE_BATCH_SIZE)
+        )
+        return message_id_filter
+
+    def _get_stored_external_ids(self, external_ids):
+        # Exact lookup of the IDs the Bloom filter may contain
+        maybe_stored = [external_id for external_id in external_ids if external_id in self.message_id_filter]
+        if not maybe_stored:
+            return set()
+        return set(self.email_messages.filter(external_id__in=maybe_stored).values_list("external_id", flat=True))
+
+    def sync_email_messages(self, results_per_page=10, max_results=10):
+        """
+        Bring the stored messages up to date with the mailbox.
+
+        - Apply only the messages added, deleted or relabeled since the last sync, using the stored `history_id`
+        - Fall back to a full resync when there is no `history_id` yet or it is too old: the whole mailbox is
+          listed, whatever `max_results`, and the stored messages it no longer holds are deleted
+        :return: The number of added, deleted and updated messages, or None after a full resync.
+        """
+        with self.loader(results_per_page=results_per_page, max_results=max_results) as loader:
+            if self.history_id:
+                try:
+                    return self._apply_history(loader)
+                except HistoryExpiredError:
+                    pass
+
+            # Take the high-water mark before listing, so changes made while listing are picked up by the next sync
+            history_id = loader.get_history_id()
+
+        listed_at, listed_ids = timezone.now(), set()
+        self.load_ids_to_email_messages(results_per_page=results_per_page, max_results=None, listed_ids=listed_ids)
+        deleted = self._delete_unlisted_messages(listed_ids, listed_at)
+        logger.info("Deleted %s messages no longer in the mailbox of %s", deleted, self.email)
+
+        # Only a complete listing moves the high-water mark
+        self.history_id = history_id
+        self.save(update_fields=["history_id", "updated_at"])
+
+    def _delete_unlisted_messages(self, listed_ids, listed_at):
+        """
+        Delete the messages stored before a full listing started that it didn't list, i.e. deleted from the mailbox.
+        :return: The number of deleted messages.
+        """
+        unlisted_ids = [
+            email_message_id
+            for email_message_id, external_id in self.email_messages.filter(created_at__lt=listed_at)
+            .values_list("id", "external_id")
+            .iterator(chunk_size=BULK_CREATE_BATCH_SIZE)
+            if external_id not in listed_ids
+        ]
+        deleted = 0
+        for start in range(0, len(unlisted_ids), BULK_CREATE_BATCH_SIZE):
+            _, counts = EmailMessage.objects.filter(
+                id__in=unlisted_ids[start : start + BULK_CREATE_BATCH_SIZE]
+            ).delete()
+            deleted += counts.get("retriever.EmailMessage", 0)
+        return deleted
+
+    def start_partitioned_listing(self, partition_size=None):
+        """
+        Start listing the mailbox in windows of time, to be listed in parallel by `load_message_ids_window`.
+
+        The history ID is taken first and becomes the high-water mark of the account when the last window is
+        listed, see `finish_list_window`.
+        :return: The (after, before) windows, as Unix timestamps.
+        """
+        with self.loader(results_per_page=500, max_results=None) as loader:
+            list_history_id = loader.get_history_id()
+            # Messages can be dated a little in the future, by the clock of their sender
+            before = int(timezone.now().timestamp()) + 24 * 3600
+            windows = loader.partition_by_date(0, before, partition_size or settings.LIST_PARTITION_SIZE)
+
+        # Build the Bloom filter of stored IDs once if it was never saved, rather than in every window
+        self.message_id_filter
+        self.list_history_id, self.list_windows_left = list_history_id, [after for after, _ in windows]
+        self.save(update_fields=["list_history_id", "list_windows_left", "updated_at"])
+        return windows
+
+    def load_message_ids_window(self, after, before):
+        """
+        List the messages of a window of a partitioned listing, and store the ones not stored yet, so listing a
+        window again is safe.
+
+        The Bloom filter of stored IDs is only read: parallel windows can't merge their filters, the last window
+        rebuilds it.
+        :return: The number of newly stored messages.
+        """
+        added = 0
+        with self.loader(results_per_page=500, max_results=None) as loader:
+            query = get_date_query(loader.query, after, before)
+            for messages, _ in loader.load_message_id_pages(query=query):
+                added += len(self.store_message_ids(messages))
+        return added
+
+    def finish_list_window(self, list_history_id, after):
+        """
+        Mark the window starting at `after` of the partitioned listing started with `list_history_id` as listed.
+        Windows listed again, e.g. by a task delivered twice, and windows of an older listing are ignored.
+        :return: Whether it was the last window: the history ID is then saved and the Bloom filter rebuilt.
+        """
+        with transaction.atomic():
+            email_account = EmailAccount.objects.select_for_update().get(id=self.id)
+            if email_account.list_history_id != list_history_id or after not in email_account.list_windows_left:
+                return False
+            email_account.list_windows_left.remove(after)
+            if email_account.list_windows_left:
+                email_account.save(update_fields=["list_windows_left", "updated_at"])
+                return False
+            email_account.history_id, email_account.list_history_id = list_history_id, None
+            email_account.save(update_fields=["history_id", "list_history_id", "list_windows_left", "updated_at"])
+
+        self.history_id, self.list_history_id, self.list_windows_left = list_history_id, None, []
+        self.rebuild_message_id_filter()
+        return True
+
+    def _apply_history(self, loader):
+        records, history_id = loader.load_history(self.history_id)
+
+        added, deleted, relabeled = {}, set(), {}
+        for record in records:
+            for item in record.get("messagesAdded", []):
+                added[item["message"]["id"]] = item["message"]
+                deleted.discard(item["message"]["id"])
+
+            for item in record.get("messagesDeleted", []):
+                added.pop(item["message"]["id"], None)
+                relabeled.pop(item["message"]["id"], None)
+                deleted.add(item["message"]["id"])
+
+            for item in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+                message = item["message"]
+                if message["id"] in added:
+                    added[message["id"]]["labelIds"] = message.get("labelIds", [])
+                elif message["id"] not in deleted:
+                    relabeled[message["id"]] = message.get("labelIds", [])
+
+        with transaction.atomic():
+            existing = self._get_stored_external_ids(added)
+            EmailMessage.objects.bulk_create(
+                [
+                    EmailMessage(
+                        external_id=message["id"],
+                        thread_id=message.get("threadId"),
+                        label_ids=message.get("labelIds"),
+                        email_account=self,
+                    )
+                    for message in added.values()
+                    if message["id"] not in existing
+                ],
+                ignore_conflicts=True,
+            )
+            self._add_message_ids(external_id for external_id in added if external_id not in existing)
 
-    def load_ids_to_email_messages(self, results_per_page=10, max_results=10):
-        data = self._load_ids_with_loader(results_per_page=results_per_page, max_results=max_results)
-        email_messages = []
+            _, deleted_counts = self.email_messages.filter(external_id__in=deleted).delete()
 
-        for d in data:
-            email_messages.append(EmailMessage(external_id=d["id"], thread_id=d["threadId"], email_account=self))
-            print("add", d["id"])
+            email_messages = list(self.email_messages.filter(external_id__in=relabeled))
+            for email_message in email_messages:
+                email_message.label_ids = relabeled[email_message.external_id]
+            EmailMessage.objects.bulk_update(email_messages, ["label_ids"])
 
-        # bulk create email messages
-        EmailMessage.objects.bulk_create(email_messages)
+            self.save_message_id_filter()
+            self.history_id = history_id
+            self.save(update_fields=["history_id", "updated_at"])
+
+        return {
+            "added": len(added) - len(existing),
+            "deleted": deleted_counts.get("retriever.EmailMessage", 0),
+            "updated": len(email_messages),
+        }
+
+    @classmethod
+    def claim_due_syncs(cls, limit=None, now=None):
+        """
+        Claim the active accounts due for a sync, the longest overdue first, by holding them for
+        `SYNC_LEASE_SECONDS`. Accounts held by another sync, or by another scheduler, are skipped.
+        :return: The claimed accounts.
+        """
+        now = now or timezone.now()
+        with transaction.atomic():
+            email_accounts = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(is_active=True, token__isnull=False)
+                .filter(models.Q(next_sync_at__isnull=True) | models.Q(next_sync_at__lte=now))
+                .filter(models.Q(sync_lease_until__isnull=True) | models.Q(sync_lease_until__lt=now))
+                .order_by(models.F("next_sync_at").asc(nulls_first=True), "id")[:limit]
+            )
+            sync_lease_until = now + timedelta(seconds=settings.SYNC_LEASE_SECONDS)
+            cls.objects.filter(id__in=[email_account.id for email_account in email_accounts]).update(
+                sync_lease_until=sync_lease_until
+            )
+        for email_account in email_accounts:
+            email_account.sync_lease_until = sync_lease_until
+        return email_accounts
+
+    def schedule_next_sync(self, added=None, backlog=False, now=None):
+        """
+        Release the account after a sync, and schedule the next one.
+
+        :param added: Number of messages added to the mailbox since the last sync, to update the arrival rate. None
+            when unknown, e.g. after a full resync or a failure.
+        :param backlog: Whether messages are left to load, the next sync is then due at once.
+        """
+        now = now or timezone.now()
+        if added is not None and self.last_synced_at is not None:
+            hours = max((now - self.last_synced_at).total_seconds(), 1) / 3600
+            rate = added / hours
+            if self.message_arrival_rate is not None:
+                smoothing = settings.SYNC_RATE_SMOOTHING
+                rate = smoothing * rate + (1 - smoothing) * self.message_arrival_rate
+            self.message_arrival_rate = rate
+
+        self.sync_interval = self.get_sync_interval()
+        self.last_synced_at = now
+        self.next_sync_at = now if backlog else now + self.sync_interval
+        self.sync_lease_until = None
+        self.save(
+            update_fields=[
+                "message_arrival_rate",
+                "sync_interval",
+                "last_synced_at",
+                "next_sync_at",
+                "sync_lease_until",
+                "updated_at",
+            ]
+        )
+
+    def get_sync_interval(self):
+        """
+        Time for about `SYNC_TARGET_NEW_MESSAGES` messages to arrive at the current rate, within the configured
+        bounds: the shortest interval while the rate is unknown, the longest one for an idle mailbox.
+        """
+        if self.message_arrival_rate is None:
+            seconds = settings.SYNC_MIN_INTERVAL
+        elif self.message_arrival_rate <= 0:
+            seconds = settings.SYNC_MAX_INTERVAL
+        else:
+            seconds = settings.SYNC_TARGET_NEW_MESSAGES / self.message_arrival_rate * 3600
+        return timedelta(seconds=min(max(seconds, settings.SYNC_MIN_INTERVAL), settings.SYNC_MAX_INTERVAL))
 
     def remove_token(self):
         self.token = None
-        self.save()
+        self.save(update_fields=["token", "updated_at"])
+        loader_pool.clear(self.pk)
+
+    def modify_messages(self, email_messages, add_labels=(), remove_labels=()):
+        """
+        Add and remove labels of the messages of the account in `email_messages`, in the mailbox with one
+        `batchModify` call per 1000 messages, then in their stored labels with bulk UPDATEs.
+
+        :param email_messages: A queryset of messages.
+        :param add_labels: Names or IDs of the labels to add, the missing ones are created in the mailbox.
+        :param remove_labels: Names or IDs of the labels to remove.
+        :return: The number of modified messages.
+        """
+        modified = 0
+        with self.loader() as loader:
+            add_label_ids = loader.get_label_ids(list(add_labels), create=True)
+            remove_label_ids = loader.get_label_ids(list(remove_labels))
+            for chunk in self._get_mailbox_chunks(email_messages):
+                loader.modify_messages([m.external_id for m in chunk], add_label_ids, remove_label_ids)
+                for email_message in chunk:
+                    label_ids = [label for label in email_message.label_ids or [] if label not in remove_label_ids]
+                    email_message.label_ids = label_ids + [
+                        label for label in add_label_ids if label not in label_ids
+                    ]
+                    email_message.updated_at = timezone.now()
+                EmailMessage.objects.bulk_update(
+                    chunk, ["label_ids", "updated_at"], batch_size=BULK_CREATE_BATCH_SIZE
+                )
+                modified += len(chunk)
+        return modified
+
+    def delete_messages(self, email_messages):
+        """
+        Delete the messages of the account in `email_messages` permanently, from the mailbox with one `batchDelete`
+        call per 1000 messages, then from the database.
+
+        :param email_messages: A queryset of messages.
+        :return: The number of deleted messages.
+        """
+        deleted = 0
+        with self.loader() as loader:
+            for chunk in self._get_mailbox_chunks(email_messages):
+                loader.delete_messages([m.external_id for m in chunk])
+                EmailMessage.objects.filter(id__in=[m.id for m in chunk]).delete()
+                deleted += len(chunk)
+        return deleted
+
+    def _get_mailbox_chunks(self, email_messages):
+        """
+        Split the messages of the account in `email_messages` in chunks of one `batchModify` or `batchDelete` call.
+        """
+        ids = list(
+            email_messages.filter(email_account=self, external_id__isnull=False)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        for start in range(0, len(ids), MAX_MODIFY_BATCH_SIZE):
+            yield list(
+                EmailMessage.objects.filter(id__in=ids[start : start + MAX_MODIFY_BATCH_SIZE])
+                .order_by("id")
+                .only("id", "external_id", "label_ids")
+            )
+
+    def get_embedding_index(self, embedder=None):
+        """
+        Get the index of the embeddings of the messages of the account, there is one per account and embedding model.
+        """
+        embedder = embedder or get_embedder()
+        return EmbeddingIndex(
+            os.path.join(settings.EMBEDDINGS_DIR, embedder.version, str(self.pk)),
+            chunk_rows=settings.EMBEDDINGS_CHUNK_ROWS,
+        )
+
+
+class EmailAccountMessageIdFilter(models.Model):
+    """
+    Serialized `MessageIdFilter` of the external IDs of the stored messages of an account, see
+    `EmailAccount.message_id_filter`.
+
+    It grows by megabytes per million messages, and keeping it out of the `EmailAccount` table spares loading it
+    with every account.
+    """
+
+    email_account = models.OneToOneField(
+        EmailAccount, on_delete=models.CASCADE, primary_key=True, related_name="message_id_filter_row"
+    )
+    data = models.BinaryField()
 
 
 class EmailMessage(BaseData):
@@ -49,35 +550,600 @@ class EmailMessage(BaseData):
     thread_id = models.CharField(max_length=5000, null=True)
     snippet = models.TextField(null=True, blank=True)
     internal_date = models.CharField(max_length=5000, null=True, blank=True)
+    # `internal_date` as a datetime
+    received_at = models.DateTimeField(null=True, blank=True)
     label_ids = models.JSONField(null=True, blank=True)
     history_id = models.CharField(max_length=5000, null=True, blank=True)
     subject = models.CharField(max_length=5000, null=True, blank=True)
     sender = models.CharField(max_length=5000, null=True, blank=True)
     recipient = models.CharField(max_length=5000, null=True, blank=True)
     copy = models.TextField(null=True, blank=True)
+    list_unsubscribe = models.TextField(null=True, blank=True)
+    # Set by `EmailClassification.classify`
+    category = models.CharField(max_length=100, null=True, blank=True)
     email_account = models.ForeignKey(
         "EmailAccount", on_delete=models.CASCADE, related_name="email_messages", null=True
     )
-    body = models.TextField(null=True, blank=True)
+    # The body is stored once per distinct content, read and written through the `body` property
+    body_content = models.ForeignKey(
+        "EmailMessageBody", on_delete=models.PROTECT, related_name="email_messages", null=True, blank=True
+    )
     email_sender = models.ForeignKey(
         "EmailMessageSender", on_delete=models.CASCADE, related_name="email_messages", null=True
     )
+    # Set when the message was loaded with its thread, see `EmailThread.load_threads_batch`
+    email_thread = models.ForeignKey(
+        "EmailThread", on_delete=models.SET_NULL, related_name="email_messages", null=True, blank=True
+    )
+
+    # Weighted subject, sender and body, maintained when the data of the message is stored
+    search_vector = SearchVectorField(null=True, blank=True)
+    # MinHash signature of the subject and body, see `EmailMessageCluster`
+    minhash = models.BinaryField(null=True, blank=True, editable=False)
+    # Near-duplicates of the message, set when its body is stored
+    cluster = models.ForeignKey(
+        "EmailMessageCluster", on_delete=models.SET_NULL, related_name="email_messages", null=True, blank=True
+    )
+
+    objects = EmailMessageQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # Also serves as the index for looking messages up by their external ID
+            models.UniqueConstraint(
+                fields=["email_account", "external_id"], name="unique_email_message_external_id"
+            ),
+        ]
+        indexes = [
+            GinIndex(fields=["search_vector"], name="email_message_search_idx"),
+            # Trigram indexes serve `icontains` lookups on the headers, i.e. `UPPER(field) LIKE UPPER('%term%')`
+            GinIndex(OpClass(Upper("subject"), name="gin_trgm_ops"), name="email_message_subject_trgm"),
+            GinIndex(OpClass(Upper("sender"), name="gin_trgm_ops"), name="email_message_sender_trgm"),
+            GinIndex(OpClass(Upper("recipient"), name="gin_trgm_ops"), name="email_message_recipient_trgm"),
+            models.Index(fields=["email_account", "category"], name="email_message_category_idx"),
+        ]
+
+    # Model fields filled from the loaded data, with their key in the loader's output
+    DATA_FIELDS = {
+        "snippet": "snippet",
+        "internal_date": "internalDate",
+        "label_ids": "labelIds",
+        "history_id": "historyId",
+        "subject": "subject",
+        "sender": "sender",
+        "recipient": "recipient",
+        "copy": "copy",
+        "list_unsubscribe": "listUnsubscribe",
+        "body": "body",
+    }
+
+    @property
+    def body(self):
+        """
+        The decoded text of the message. Use `select_related("body_content")` when reading it for many messages.
+        """
+        return self.body_content.text if self.body_content else None
+
+    @body.setter
+    def body(self, text):
+        self.body_content = EmailMessageBody.from_text(text) if text is not None else None
+
+    def save(self, *args, **kwargs):
+        EmailMessageBody.save_bodies(self._get_unsaved_bodies([self]))
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            if self.cluster_id:
+                EmailMessageCluster.objects.filter(id=self.cluster_id).update(
+                    number_of_messages=models.F("number_of_messages") - 1
+                )
+            if self.email_sender_id:
+                EmailMessageSender.update_counts({self.email_sender_id: (-1, None, None)})
+                if self.received_at:
+                    SenderDailyStat.update_counts(
+                        {(self.email_sender_id, SenderDailyStat.get_day(self.received_at)): -1}
+                    )
+        return deleted
+
+    @staticmethod
+    def _get_unsaved_bodies(email_messages):
+        return [
+            email_message.body_content
+            for email_message in email_messages
+            if email_message.body_content_id is None and email_message.body_content is not None
+        ]
 
     def load_full_data(self):
-        loader = self.email_account.get_loader_class()
-        data = loader.load_full_data(message_id=self.external_id)
-        data.pop("id", None)
-        data.pop("threadId", None)
-        self.snippet = data.get("snippet", None)
-        self.internal_date = data.get("internalDate", None)
-        self.label_ids = data.get("labelIds", None)
-        self.history_id = data.get("historyId", None)
-        self.subject = data.get("subject", None)
-        self.sender = data.get("sender", None)
-        self.recipient = data.get("recipient", None)
-        self.copy = data.get("copy", None)
-        self.body = data.get("body", None)
-        self.save()
+        with self.email_account.loader() as loader:
+            data = loader.load_full_data(message_id=self.external_id)
+        self.store_full_data([self], [data])
+
+    def load_metadata(self):
+        """
+        Load only the headers of the message, leaving the body to be loaded later with `load_full_data`.
+        """
+        with self.email_account.loader() as loader:
+            data = loader.load_full_data(message_id=self.external_id, message_format=METADATA)
+        self.store_full_data([self], [data])
+
+    @classmethod
+    def load_full_data_batch(cls, email_messages, message_format=None):
+        """
+        Load the data of many messages with batch requests, and save them with one bulk UPDATE per account.
+        :return: The IDs of the messages that could not be loaded.
+        """
+        messages_by_account = defaultdict(list)
+        for email_message in email_messages:
+            messages_by_account[email_message.email_account_id].append(email_message)
+
+        failed_ids = []
+        for account_messages in messages_by_account.values():
+            with account_messages[0].email_account.loader() as loader:
+                data = loader.load_full_data_batch(
+                    [email_message.external_id for email_message in account_messages], message_format=message_format
+                )
+            failed_ids += cls.store_full_data(account_messages, data)
+
+        return failed_ids
+
+    @classmethod
+    @timed_write("store_full_data")
+    def store_full_data(cls, email_messages, data, extra_fields=()):
+        """
+        Save the data loaded for the messages, in the same order, with one bulk UPDATE which also links them to
+        their sender.
+        :param extra_fields: Other fields set by the caller on the messages, saved by the same UPDATE.
+        :return: The IDs of the messages without data.
+        """
+        fields, loaded, failed_ids, previous_states = {"updated_at", *extra_fields}, [], [], []
+        for email_message, message_data in zip(email_messages, data):
+            if message_data is None:
+                failed_ids.append(email_message.id)
+                continue
+            # Sender counts move messages from their stored sender and date
+            previous_states.append((email_message.email_sender_id, email_message.received_at))
+            fields.update(email_message.apply_data(message_data))
+            email_message.updated_at = timezone.now()
+            loaded.append(email_message)
+
+        EmailMessageBody.save_bodies(cls._get_unsaved_bodies(loaded))
+        with transaction.atomic():
+            if "sender" in fields:
+                EmailMessageSender.link_senders(loaded, previous_states)
+                fields.add("email_sender")
+            unclustered = [m for m in loaded if m.minhash is not None and m.cluster_id is None]
+            if unclustered:
+                EmailMessageCluster.assign(unclustered)
+                fields.add("cluster")
+            cls.objects.bulk_update(loaded, sorted(fields))
+        return failed_ids
+
+    def apply_data(self, data):
+        """
+        Set the fields present in the data returned by the loader, keeping the others (e.g. the body when only
+        metadata was loaded).
+        :return: The names of the updated fields.
+        """
+        fields = []
+        for field, key in self.DATA_FIELDS.items():
+            if key in data:
+                setattr(self, field, data[key])
+                fields.append("body_content" if field == "body" else field)
+
+        # Metadata alone only indexes the headers of messages whose body was not loaded yet
+        if "body" in data or self.body_content_id is None:
+            self.search_vector = self.get_search_vector(data.get("body"))
+            fields.append("search_vector")
+
+        min_hasher = get_min_hasher()
+        if "body" in data and min_hasher:
+            self.minhash = self.get_minhash(data["body"], min_hasher)
+            fields.append("minhash")
+
+        if "internal_date" in fields:
+            self.received_at = (
+                datetime.fromtimestamp(int(self.internal_date) / 1000, tz=dt_timezone.utc)
+                if self.internal_date
+                else None
+            )
+            fields.append("received_at")
+        return fields
+
+    def get_search_vector(self, body):
+        """
+        Build the search vector of the message from its headers and `body`, as an expression to save.
+        """
+        config = settings.EMAIL_SEARCH_CONFIG
+        return (
+            SearchVector(models.Value(self.subject or ""), weight="A", config=config)
+            + SearchVector(models.Value(self.sender or ""), weight="B", config=config)
+            + SearchVector(models.Value((body or "")[:SEARCH_BODY_MAX_LENGTH]), weight="C", config=config)
+        )
+
+    def get_minhash(self, body, min_hasher):
+        """
+        Compute the MinHash signature of the subject of the message and `body`.
+        """
+        return min_hasher.get_signature(f"{self.subject or ''}\n{body or ''}")
+
+    @classmethod
+    def update_clusters(cls, email_messages):
+        """
+        Compute the missing signatures of messages stored before near-duplicates were detected, and put the messages
+        without a cluster in one. Select the messages with `select_related("body_content")`.
+        """
+        min_hasher = get_min_hasher()
+        for email_message in email_messages:
+            if email_message.minhash is None:
+                email_message.minhash = email_message.get_minhash(email_message.body, min_hasher)
+
+        with transaction.atomic():
+            EmailMessageCluster.assign(
+                [m for m in email_messages if m.minhash is not None and m.cluster_id is None], min_hasher
+            )
+            cls.objects.bulk_update(email_messages, ["minhash", "cluster"], batch_size=BULK_CREATE_BATCH_SIZE)
+
+    @classmethod
+    def update_search_vectors(cls, email_messages):
+        """
+        Rebuild the search vectors of messages stored before they were maintained, with one bulk UPDATE.
+        Select the messages with `select_related("body_content")`.
+        """
+        for email_message in email_messages:
+            email_message.search_vector = email_message.get_search_vector(email_message.body)
+        cls.objects.bulk_update(email_messages, ["search_vector"])
+
+    @classmethod
+    def update_embeddings(cls, email_messages, embedder=None):
+        """
+        Append the vectors of the messages missing from the embedding index of their account, so the model only
+        embeds new messages. Select the messages with `select_related("email_account", "body_content")`.
+        :return: The IDs of the messages the model could not embed.
+        """
+        embedder = embedder or get_embedder()
+        messages_by_account = defaultdict(list)
+        for email_message in email_messages:
+            messages_by_account[email_message.email_account_id].append(email_message)
+
+        failed_ids = []
+        for account_messages in messages_by_account.values():
+            index = account_messages[0].email_account.get_embedding_index(embedder)
+            missing_ids = set(index.missing(m.id for m in account_messages))
+            new_messages = [m for m in account_messages if m.id in missing_ids]
+            if not new_messages:
+                continue
+            try:
+                vectors = embedder.embed([(m.subject, m.body) for m in new_messages])
+            except Exception as e:
+                logger.warning("Can't embed %s messages: %s", len(new_messages), e)
+                failed_ids += [m.id for m in new_messages]
+                continue
+            index.append([m.id for m in new_messages], vectors)
+        return failed_ids
+
+    def find_similar(self, limit=20, min_similarity=None, embedder=None):
+        """
+        Find the messages of the account closest to this one by the cosine similarity of their embeddings, e.g. to
+        clean similar mail up at once. The message is embedded on the fly when it is not in the index yet.
+        :return: The most similar messages first, with their similarity set as `similarity`. Messages deleted since
+            they were indexed are left out.
+        """
+        embedder = embedder or get_embedder()
+        index = self.email_account.get_embedding_index(embedder)
+        _, vectors = index.get_vectors([self.id])
+        if not len(vectors):
+            vectors = embedder.embed([(self.subject, self.body)])
+
+        [neighbors] = index.search(vectors, k=limit, exclude=[self.id], min_score=min_similarity)
+        email_messages = EmailMessage.objects.in_bulk([email_message_id for email_message_id, _ in neighbors])
+        similar = []
+        for email_message_id, similarity in neighbors:
+            if email_message_id in email_messages:
+                email_messages[email_message_id].similarity = similarity
+                similar.append(email_messages[email_message_id])
+        return similar
+
+
+class EmailThread(BaseData):
+    """
+    Conversation of a mailbox, loaded with all its messages by a single `threads.get` call.
+    """
+
+    external_id = models.CharField(max_length=5000)
+    email_account = models.ForeignKey("EmailAccount", on_delete=models.CASCADE, related_name="email_threads")
+    history_id = models.CharField(max_length=5000, null=True, blank=True)
+    # Subject of the first message
+    subject = models.CharField(max_length=5000, null=True, blank=True)
+    # Aggregates of the messages of the thread, refreshed every time it is loaded
+    number_of_messages = models.PositiveIntegerField(default=0)
+    # Sorted, normalized addresses of the senders and recipients
+    participants = models.JSONField(default=list, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["email_account", "external_id"], name="unique_email_thread_external_id"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["email_account", "-last_message_at"], name="email_thread_last_message_idx"),
+        ]
+
+    def __str__(self):
+        return self.subject or self.external_id
+
+    @classmethod
+    def load_threads_batch(cls, email_account, thread_ids, message_format=None):
+        """
+        Load threads with one `threads.get` call each instead of one `messages.get` call per message, store all
+        their messages, including the ones not listed yet, and refresh the aggregates of the threads.
+        :return: The external IDs of the threads that could not be loaded.
+        """
+        with email_account.loader() as loader:
+            data = loader.load_threads_batch(thread_ids, message_format=message_format)
+        loaded = {thread_id: thread_data for thread_id, thread_data in zip(thread_ids, data) if thread_data}
+        failed_ids = [thread_id for thread_id in thread_ids if thread_id not in loaded]
+
+        cls.objects.bulk_create(
+            [cls(email_account=email_account, external_id=thread_id) for thread_id in loaded],
+            batch_size=BULK_CREATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        email_threads = {t.external_id: t for t in email_account.email_threads.filter(external_id__in=loaded)}
+
+        messages_data = [
+            (thread_id, message_data)
+            for thread_id, thread_data in loaded.items()
+            for message_data in thread_data["messages"]
+            if message_data
+        ]
+        # The Bloom filter isn't saved, batches run in parallel; the IDs missing from it are only looked up again
+        email_account.store_message_ids([{"id": m["id"], "threadId": thread_id} for thread_id, m in messages_data])
+        email_messages = {
+            m.external_id: m
+            for m in email_account.email_messages.filter(external_id__in=[m["id"] for _, m in messages_data])
+        }
+
+        thread_messages = defaultdict(list)
+        for thread_id, message_data in messages_data:
+            email_message = email_messages[message_data["id"]]
+            email_message.email_thread = email_threads[thread_id]
+            thread_messages[thread_id].append(email_message)
+        EmailMessage.store_full_data(
+            [email_messages[m["id"]] for _, m in messages_data],
+            [m for _, m in messages_data],
+            extra_fields=["email_thread"],
+        )
+
+        for thread_id, email_thread in email_threads.items():
+            email_thread.history_id = loaded[thread_id]["historyId"]
+            email_thread.set_aggregates(thread_messages[thread_id])
+            email_thread.updated_at = timezone.now()
+        cls.objects.bulk_update(
+            email_threads.values(),
+            ["history_id", "subject", "number_of_messages", "participants", "last_message_at", "updated_at"],
+        )
+        return failed_ids
+
+    def set_aggregates(self, email_messages):
+        """
+        Compute the aggregates of the thread from its loaded messages, oldest first.
+        """
+        self.subject = email_messages[0].subject if email_messages else None
+        self.number_of_messages = len(email_messages)
+        self.participants = sorted(
+            parse_addresses(header for m in email_messages for header in (m.sender, m.recipient, m.copy))
+        )
+        self.last_message_at = max((m.received_at for m in email_messages if m.received_at), default=None)
+
+
+class EmailMessageCluster(BaseData):
+    """
+    Near-duplicate messages of an account, e.g. the issues of a newsletter or the notifications of a service, so
+    downstream work (classification, review, bulk actions) can run once per cluster rather than once per message.
+
+    A message joins the cluster whose representative has the most similar MinHash signature, when the estimated
+    Jaccard similarity of their shingles reaches `NEAR_DUPLICATE_THRESHOLD`, or starts a cluster it represents.
+    """
+
+    email_account = models.ForeignKey(
+        "EmailAccount", on_delete=models.CASCADE, related_name="email_message_clusters"
+    )
+    # First message of the cluster, the other messages are similar to its signature
+    representative = models.ForeignKey(
+        "EmailMessage", on_delete=models.SET_NULL, related_name="+", null=True, blank=True
+    )
+    # Signature of the representative, kept when it is deleted, and the hashes of its LSH bands
+    minhash = models.BinaryField(editable=False)
+    lsh_bands = ArrayField(models.BigIntegerField(), editable=False)
+    # Maintained as messages are assigned or deleted
+    number_of_messages = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=["lsh_bands"], name="email_cluster_lsh_bands_idx"),
+            models.Index(fields=["email_account", "-number_of_messages"], name="email_cluster_size_idx"),
+        ]
+
+    def __str__(self):
+        return f"Cluster {self.pk} ({self.number_of_messages} messages)"
+
+    @classmethod
+    def assign(cls, email_messages, min_hasher=None):
+        """
+        Set `cluster` of messages with a signature, creating the clusters they start. The candidate clusters of the
+        messages of an account share an LSH band with one of them, and are read with one query on the GIN index.
+
+        Messages are compared with the representatives only, so the work per message doesn't grow with the size of
+        the clusters. Clustering of an account is serialized by locking its row, so concurrent near-duplicates
+        join the same cluster: call it in the transaction saving the messages.
+        """
+        min_hasher = min_hasher or get_min_hasher()
+        messages_by_account = defaultdict(list)
+        for email_message in email_messages:
+            messages_by_account[email_message.email_account_id].append(email_message)
+
+        for email_account_id, account_messages in messages_by_account.items():
+            list(EmailAccount.objects.select_for_update().filter(id=email_account_id).values_list("id"))
+            bands = [min_hasher.get_bands(m.minhash) for m in account_messages]
+            clusters_by_band = defaultdict(list)
+            candidates = cls.objects.filter(
+                email_account_id=email_account_id, lsh_bands__overlap=list({b for mb in bands for b in mb})
+            ).only("id", "minhash", "lsh_bands")
+            for cluster in candidates:
+                cluster.minhash = bytes(cluster.minhash)
+                for band in cluster.lsh_bands:
+                    clusters_by_band[band].append(cluster)
+
+            new_clusters, added = [], defaultdict(int)
+            for email_message, message_bands in zip(account_messages, bands):
+                clusters = {id(c): c for band in message_bands for c in clusters_by_band[band]}.values()
+                similarity, cluster = max(
+                    ((min_hasher.get_similarity(email_message.minhash, c.minhash), c) for c in clusters),
+                    key=lambda scored: scored[0],
+                    default=(0, None),
+                )
+                if similarity < settings.NEAR_DUPLICATE_THRESHOLD:
+                    cluster = cls(
+                        email_account_id=email_account_id,
+                        representative=email_message,
+                        minhash=email_message.minhash,
+                        lsh_bands=message_bands,
+                    )
+                    new_clusters.append(cluster)
+                    for band in message_bands:
+                        clusters_by_band[band].append(cluster)
+                if cluster.pk is None:
+                    cluster.number_of_messages += 1
+                else:
+                    added[cluster.pk] += 1
+                email_message.cluster = cluster
+
+            cls.objects.bulk_create(new_clusters, batch_size=BULK_CREATE_BATCH_SIZE)
+            for email_message in account_messages:
+                # The IDs of the new clusters are only known now
+                email_message.cluster = email_message.cluster
+
+            clusters_by_amount = defaultdict(list)
+            for cluster_id, amount in added.items():
+                clusters_by_amount[amount].append(cluster_id)
+            for amount, cluster_ids in clusters_by_amount.items():
+                cls.objects.filter(id__in=cluster_ids).update(
+                    number_of_messages=models.F("number_of_messages") + amount, updated_at=timezone.now()
+                )
+
+
+class EmailMessageBody(models.Model):
+    """
+    Body of messages, compressed and stored once per distinct content across messages and accounts.
+
+    Newsletters and notifications repeat the same bodies many times, and keeping them out of the `EmailMessage` table
+    lets queries that don't need them skip them entirely.
+    """
+
+    # SHA-256 of the UTF-8 encoded text
+    hash = models.CharField(max_length=64, unique=True)
+    # zlib compressed UTF-8 encoded text
+    content = models.BinaryField()
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Build an unsaved body for `text`, saved later with `save_bodies`.
+        """
+        data = text.encode("utf-8")
+        return cls(hash=hashlib.sha256(data).hexdigest(), content=zlib.compress(data))
+
+    @property
+    def text(self):
+        return zlib.decompress(self.content).decode("utf-8")
+
+    @classmethod
+    @timed_write("save_bodies")
+    def save_bodies(cls, bodies):
+        """
+        Save the unsaved bodies whose content is not stored yet, and set the primary key of every body, with one
+        INSERT and one SELECT whatever the number of bodies.
+        """
+        if not bodies:
+            return
+
+        new_bodies = {body.hash: body for body in bodies}
+        cls.objects.bulk_create(new_bodies.values(), batch_size=BULK_CREATE_BATCH_SIZE, ignore_conflicts=True)
+        ids = dict(cls.objects.filter(hash__in=new_bodies).values_list("hash", "id"))
+        for body in bodies:
+            body.pk = ids[body.hash]
+
+    @classmethod
+    def delete_unused(cls):
+        """
+        Delete the bodies no message refers to anymore, e.g. after messages were deleted.
+        :return: The number of deleted bodies.
+        """
+        deleted, _ = cls.objects.filter(email_messages__isnull=True).delete()
+        return deleted
+
+
+class EmailClassification(models.Model):
+    """
+    Category inferred for a content, i.e. the normalized sender, subject and beginning of the body of a message, so
+    the content of repeated messages (newsletters, notifications) is inferred once.
+    """
+
+    # `EmailClassifier.get_hash` of the content
+    hash = models.CharField(max_length=64)
+    # `EmailClassifier.version`, results of another model, categories or prompt are not reused
+    version = models.CharField(max_length=5000)
+    category = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["hash", "version"], name="unique_email_classification_hash"),
+        ]
+
+    @classmethod
+    def classify(cls, email_messages, classifier=None):
+        """
+        Set the category of the messages, and save it with one bulk UPDATE. Only contents never classified by the
+        classifier are sent to the model, once each. Select the messages with
+        `select_related("body_content", "cluster__representative__body_content")`.
+        :return: The IDs of the messages the model could not classify.
+        """
+        classifier = classifier or get_classifier()
+        # Near-duplicates are classified as the representative of their cluster, so a cluster is inferred once
+        sources = [
+            m.cluster.representative if m.cluster_id and m.cluster.representative_id else m for m in email_messages
+        ]
+        hashes = [classifier.get_hash(m.sender, m.subject, m.body) for m in sources]
+        categories = dict(
+            cls.objects.filter(version=classifier.version, hash__in=set(hashes)).values_list("hash", "category")
+        )
+        increment("classifier_messages_total", sum(h in categories for h in hashes), result="cached")
+
+        new_contents = {h: m for h, m in zip(hashes, sources) if h not in categories}
+        inferred = classifier.classify([(m.sender, m.subject, m.body) for m in new_contents.values()])
+        new_categories = {h: category for h, category in zip(new_contents, inferred) if category}
+        cls.objects.bulk_create(
+            [cls(hash=h, version=classifier.version, category=category) for h, category in new_categories.items()],
+            batch_size=BULK_CREATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        categories.update(new_categories)
+
+        classified, failed_ids = [], []
+        for email_message, h in zip(email_messages, hashes):
+            if h not in categories:
+                failed_ids.append(email_message.id)
+                continue
+            email_message.category = categories[h]
+            email_message.updated_at = timezone.now()
+            classified.append(email_message)
+        EmailMessage.objects.bulk_update(classified, ["category", "updated_at"], batch_size=BULK_CREATE_BATCH_SIZE)
+        return failed_ids
 
 
 class EmailMessageSender(BaseData):
@@ -87,7 +1153,273 @@ class EmailMessageSender(BaseData):
         "EmailAccount", on_delete=models.CASCADE, related_name="email_message_senders", null=True
     )
 
-    objects = EmailMessageSenderManager()
+    # Maintained as messages are linked to the sender or deleted, see `update_counts`
+    number_of_emails = models.PositiveIntegerField(default=0)
+    first_seen_at = models.DateTimeField(null=True, blank=True)
+    last_seen_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["email_account", "email"], name="unique_email_message_sender_email"),
+        ]
+        indexes = [
+            models.Index(fields=["email_account", "-number_of_emails"], name="sender_number_of_emails_idx"),
+        ]
 
     def __str__(self):
         return f"{self.email}"
+
+    @classmethod
+    @timed_write("link_senders")
+    def link_senders(cls, email_messages, previous_states=None):
+        """
+        Set `email_sender` of the messages from their `sender` header, creating the senders not stored yet, with one
+        INSERT and one SELECT per account. Senders are matched by their normalized address.
+
+        The counts and daily stats of the senders are updated right away, so call it in the transaction saving the
+        messages.
+
+        :param email_messages: The messages to link.
+        :param previous_states: The stored sender ID and `received_at` of each message, when they were changed in
+            memory since the messages were read.
+        """
+        if previous_states is None:
+            previous_states = [(m.email_sender_id, m.received_at) for m in email_messages]
+        names_by_account = defaultdict(dict)
+        for email_message in email_messages:
+            name, address = parse_sender(email_message.sender)
+            if address:
+                names_by_account[email_message.email_account_id].setdefault(address, name)
+
+        sender_ids = {}
+        for email_account_id, names in names_by_account.items():
+            cls.objects.bulk_create(
+                [
+                    cls(email_account_id=email_account_id, email=address, name=name)
+                    for address, name in names.items()
+                ],
+                batch_size=BULK_CREATE_BATCH_SIZE,
+                ignore_conflicts=True,
+            )
+            senders = cls.objects.filter(email_account_id=email_account_id, email__in=names)
+            for address, sender_id in senders.values_list("email", "id"):
+                sender_ids[email_account_id, address] = sender_id
+
+        for email_message in email_messages:
+            email_message.email_sender_id = sender_ids.get(
+                (email_message.email_account_id, parse_sender(email_message.sender)[1])
+            )
+
+        changes, daily_changes = defaultdict(lambda: [0, None, None]), defaultdict(int)
+        for email_message, (previous_sender_id, previous_received_at) in zip(email_messages, previous_states):
+            if email_message.email_sender_id != previous_sender_id:
+                if previous_sender_id:
+                    changes[previous_sender_id][0] -= 1
+                if email_message.email_sender_id:
+                    changes[email_message.email_sender_id][0] += 1
+
+            previous_key = (previous_sender_id, SenderDailyStat.get_day(previous_received_at))
+            key = (email_message.email_sender_id, SenderDailyStat.get_day(email_message.received_at))
+            if key != previous_key:
+                if all(previous_key):
+                    daily_changes[previous_key] -= 1
+                if all(key):
+                    daily_changes[key] += 1
+
+            if email_message.email_sender_id and email_message.received_at:
+                change = changes[email_message.email_sender_id]
+                change[1] = min(change[1] or email_message.received_at, email_message.received_at)
+                change[2] = max(change[2] or email_message.received_at, email_message.received_at)
+
+        cls.update_counts(changes)
+        SenderDailyStat.update_counts(daily_changes)
+
+    @classmethod
+    def update_counts(cls, changes):
+        """
+        Apply changes to the stored message counts and first/last seen dates of senders, with one UPDATE.
+
+        :param changes: For each sender ID, the change of its count, and the first and last dates of its new
+            messages (or None). The dates only ever move outwards, `recompute_counts` recomputes them from scratch.
+        """
+        senders = []
+        for sender_id, (count, first_seen_at, last_seen_at) in sorted(changes.items()):
+            if not count and not first_seen_at:
+                continue
+            sender = cls(id=sender_id)
+            sender.number_of_emails = models.F("number_of_emails") + count
+            # NULL values are ignored by LEAST and GREATEST in Postgres
+            sender.first_seen_at = Least("first_seen_at", models.Value(first_seen_at, models.DateTimeField()))
+            sender.last_seen_at = Greatest("last_seen_at", models.Value(last_seen_at, models.DateTimeField()))
+            senders.append(sender)
+
+        cls.objects.bulk_update(senders, ["number_of_emails", "first_seen_at", "last_seen_at"])
+
+    @classmethod
+    def recompute_counts(cls, queryset=None):
+        """
+        Recompute the message counts and first/last seen dates of the senders from their messages.
+        :return: The number of updated senders.
+        """
+        messages = EmailMessage.objects.filter(email_sender=models.OuterRef("pk")).order_by().values("email_sender")
+        return (queryset if queryset is not None else cls.objects.all()).update(
+            number_of_emails=Coalesce(
+                models.Subquery(messages.annotate(count=models.Count("id")).values("count")), 0
+            ),
+            first_seen_at=models.Subquery(messages.annotate(first=models.Min("received_at")).values("first")),
+            last_seen_at=models.Subquery(messages.annotate(last=models.Max("received_at")).values("last")),
+        )
+
+
+class SenderDailyStat(models.Model):
+    """
+    Number of messages received from a sender per day (UTC), rolled up as messages are linked to senders or deleted.
+
+    Reports over any time window read a few rows per sender and day instead of every message.
+    """
+
+    email_account = models.ForeignKey("EmailAccount", on_delete=models.CASCADE, related_name="sender_daily_stats")
+    email_sender = models.ForeignKey("EmailMessageSender", on_delete=models.CASCADE, related_name="daily_stats")
+    # Domain of the sender address, for the top domains report
+    domain = models.CharField(max_length=5000)
+    day = models.DateField()
+    number_of_emails = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["email_sender", "day"], name="unique_sender_daily_stat_day"),
+        ]
+        indexes = [
+            # Reports only read this index
+            models.Index(
+                fields=["email_account", "day"],
+                include=["email_sender", "domain", "number_of_emails"],
+                name="sender_daily_stat_account_idx",
+            ),
+        ]
+
+    # Add to the count of (sender, day) pairs, creating the rows not stored yet, in one statement
+    UPDATE_COUNTS_SQL = """
+        INSERT INTO retriever_senderdailystat (email_account_id, email_sender_id, domain, day, number_of_emails)
+        SELECT sender.email_account_id, sender.id, SPLIT_PART(sender.email, '@', 2), changes.day, changes.count
+        FROM (VALUES {values}) AS changes (email_sender_id, day, count)
+        JOIN retriever_emailmessagesender AS sender ON sender.id = changes.email_sender_id
+        ON CONFLICT (email_sender_id, day) DO UPDATE
+        SET number_of_emails = retriever_senderdailystat.number_of_emails + EXCLUDED.number_of_emails
+    """
+
+    # Rebuild the rows of the senders of an account from their messages
+    RECOMPUTE_SQL = """
+        INSERT INTO retriever_senderdailystat (email_account_id, email_sender_id, domain, day, number_of_emails)
+        SELECT sender.email_account_id, sender.id, SPLIT_PART(sender.email, '@', 2), messages.day, messages.count
+        FROM (
+            SELECT email_sender_id, (received_at AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS count
+            FROM retriever_emailmessage
+            WHERE email_account_id = %s AND email_sender_id IS NOT NULL AND received_at IS NOT NULL
+            GROUP BY 1, 2
+        ) AS messages
+        JOIN retriever_emailmessagesender AS sender ON sender.id = messages.email_sender_id
+    """
+
+    @staticmethod
+    def get_day(received_at):
+        return received_at.astimezone(dt_timezone.utc).date() if received_at else None
+
+    @classmethod
+    def update_counts(cls, changes):
+        """
+        Apply changes to the daily counts of senders.
+
+        :param changes: The change of the count of each (sender ID, day) pair.
+        """
+        changes = sorted((key, count) for key, count in changes.items() if count)
+        with connection.cursor() as cursor:
+            for start in range(0, len(changes), BULK_CREATE_BATCH_SIZE):
+                chunk = changes[start : start + BULK_CREATE_BATCH_SIZE]
+                cursor.execute(
+                    cls.UPDATE_COUNTS_SQL.format(
+                        values=", ".join(["(%s::bigint, %s::date, %s::integer)"] * len(chunk))
+                    ),
+                    [param for (sender_id, day), count in chunk for param in (sender_id, day, count)],
+                )
+
+    @classmethod
+    def recompute(cls, email_account):
+        """
+        Rebuild the daily stats of the senders of an account from their messages.
+        """
+        with transaction.atomic():
+            cls.objects.filter(email_account=email_account).delete()
+            with connection.cursor() as cursor:
+                cursor.execute(cls.RECOMPUTE_SQL, [email_account.pk])
+
+    @classmethod
+    def _get_stats(cls, email_account, since=None, until=None):
+        stats = cls.objects.filter(email_account=email_account)
+        if since:
+            stats = stats.filter(day__gte=since)
+        if until:
+            stats = stats.filter(day__lte=until)
+        return stats.order_by()
+
+    @classmethod
+    def top_senders(cls, email_account, since=None, until=None, limit=20):
+        """
+        The senders of an account that sent the most messages.
+
+        :param email_account: The account.
+        :param since: First day of the window, included, or None for no limit.
+        :param until: Last day of the window, included, or None for no limit.
+        :param limit: Number of senders to return.
+        :return: The ID, email, name and number of emails of the senders, the largest number first.
+        """
+        if since is None and until is None:
+            # The all-time counts are stored on the senders
+            senders = email_account.email_message_senders.filter(number_of_emails__gt=0)
+            return list(
+                senders.order_by("-number_of_emails", "id").values("id", "email", "name", "number_of_emails")[
+                    :limit
+                ]
+            )
+
+        stats = (
+            cls._get_stats(email_account, since, until)
+            .values("email_sender")
+            .annotate(total=models.Sum("number_of_emails"))
+            .filter(total__gt=0)
+            .order_by("-total", "email_sender")[:limit]
+        )
+        totals = {stat["email_sender"]: stat["total"] for stat in stats}
+        senders = EmailMessageSender.objects.in_bulk(totals)
+        return [
+            {
+                "id": sender_id,
+                "email": senders[sender_id].email,
+                "name": senders[sender_id].name,
+                "number_of_emails": total,
+            }
+            for sender_id, total in totals.items()
+        ]
+
+    @classmethod
+    def top_domains(cls, email_account, since=None, until=None, limit=20):
+        """
+        The sender domains of an account that sent the most messages.
+
+        :param email_account: The account.
+        :param since: First day of the window, included, or None for no limit.
+        :param until: Last day of the window, included, or None for no limit.
+        :param limit: Number of domains to return.
+        :return: The domain, number of emails and number of senders of the domains, the largest number first.
+        """
+        stats = (
+            cls._get_stats(email_account, since, until)
+            .values("domain")
+            .annotate(total=models.Sum("number_of_emails"), senders=models.Count("email_sender", distinct=True))
+            .filter(total__gt=0)
+            .order_by("-total", "domain")[:limit]
+        )
+        return [
+            {"domain": stat["domain"], "number_of_emails": stat["total"], "number_of_senders": stat["senders"]}
+            for stat in stats
+        ]
@@ -1,2 +1,2 @@
-__all__ = ["GmailLoader"]
-from .gmail import GmailLoader
+__all__ = ["AsyncGmailLoader", "GmailLoader", "HistoryExpiredError"]
+from .gmail import AsyncGmailLoader, GmailLoader, HistoryExpiredError
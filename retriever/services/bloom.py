@@ -0,0 +1,43 @@
+__all__ = ["MessageIdFilter"]
+
+import io
+from typing import Iterable, Optional
+
+from pybloom_live import ScalableBloomFilter
+
+
+class MessageIdFilter:
+    """
+    Scalable Bloom filter of the message IDs stored for an account, kept as a few bytes per ID.
+
+    An ID the filter doesn't contain is surely not stored, so only the IDs it contains need an exact lookup, and
+    a few of those (`error_rate`) are false positives. IDs can't be removed, and the filter grows with the account.
+    """
+
+    def __init__(self, bloom: Optional[ScalableBloomFilter] = None, error_rate: float = 0.001):
+        """
+        :param bloom: The underlying filter, a new empty one by default.
+        :param error_rate: The rate of false positives of a new filter.
+        """
+        self.bloom = bloom or ScalableBloomFilter(
+            initial_capacity=10_000, error_rate=error_rate, mode=ScalableBloomFilter.LARGE_SET_GROWTH
+        )
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self.bloom
+
+    def __len__(self) -> int:
+        return len(self.bloom)
+
+    def add_many(self, message_ids: Iterable[str]) -> None:
+        for message_id in message_ids:
+            self.bloom.add(message_id)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MessageIdFilter":
+        return cls(ScalableBloomFilter.fromfile(io.BytesIO(data)))
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        self.bloom.tofile(buffer)
+        return buffer.getvalue()
@@ -0,0 +1,139 @@
+__all__ = ["EmailClassifier", "get_classifier"]
+
+import functools
+import hashlib
+import logging
+import re
+from typing import Any, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+from .metrics import increment, timed
+from .senders import parse_sender
+
+logger = logging.getLogger(__name__)
+
+PROMPT = """Classify each email below into exactly one of these categories: {categories}.
+Answer with one line per email formatted as "<number>: <category>", and nothing else.
+
+{emails}"""
+EMAIL_TEMPLATE = "### Email {number}\nFrom: {sender}\nSubject: {subject}\n{body}\n"
+
+URL_RE = re.compile(r"https?://\S+|www\.\S+")
+DIGITS_RE = re.compile(r"\d+")
+ANSWER_RE = re.compile(r"^\W*(?:email\s*)?(\d+)\s*[:.)\-]\s*(.+?)\W*$", re.IGNORECASE | re.MULTILINE)
+
+
+class EmailClassifier:
+    """
+    Sorts messages into categories with an LLM, several messages per prompt so a local model spends its time on
+    the messages rather than on the instructions.
+
+    Bodies are truncated to a token budget, and `get_hash` identifies what the model is shown, so results can be
+    cached and reused for messages with the same content (e.g. every issue of a newsletter).
+    """
+
+    def __init__(
+        self,
+        llm: Any,
+        model_name: str,
+        categories: Sequence[str],
+        batch_size: int = 8,
+        max_body_tokens: int = 256,
+        chars_per_token: int = 4,
+    ):
+        """
+        :param llm: A llama_index LLM, or anything with a `complete(prompt)` method returning an object with `text`.
+        :param model_name: The name of the model, part of the cache key of the results.
+        :param categories: The categories to choose from.
+        :param batch_size: Number of messages classified by one prompt.
+        :param max_body_tokens: Number of tokens of the body shown to the model.
+        :param chars_per_token: Characters per token, to apply the budget without the tokenizer of the model.
+        """
+        self.llm = llm
+        self.categories = [category.lower() for category in categories]
+        self.batch_size = batch_size
+        self.max_body_chars = max_body_tokens * chars_per_token
+        # Results of another model, other categories or another prompt are not reused
+        digest = hashlib.sha256("\n".join([model_name, *self.categories, PROMPT]).encode("utf-8")).hexdigest()
+        self.version = f"{model_name}#{digest[:8]}"
+
+    def prepare(self, sender: Optional[str], subject: Optional[str], body: Optional[str]) -> Tuple[str, str, str]:
+        """
+        Normalize what the model is shown of a message: its sender address, and its subject and the beginning of
+        its body with whitespace collapsed and links removed.
+        """
+        # Only the beginning of long bodies is normalized, whitespace aside it is all the model is shown
+        body = " ".join(URL_RE.sub("", (body or "")[: self.max_body_chars * 4]).split())[: self.max_body_chars]
+        return parse_sender(sender)[1], " ".join((subject or "").split()), body
+
+    def get_hash(self, sender: Optional[str], subject: Optional[str], body: Optional[str]) -> str:
+        """
+        Hash what the model is shown of a message, ignoring case and numbers (dates, issue numbers, amounts).
+        """
+        content = "\n".join(self.prepare(sender, subject, body)).lower()
+        return hashlib.sha256(DIGITS_RE.sub("0", content).encode("utf-8")).hexdigest()
+
+    def classify(self, emails: Sequence[Tuple[Optional[str], Optional[str], Optional[str]]]) -> List[Optional[str]]:
+        """
+        Classify messages, `batch_size` messages per prompt.
+
+        :param emails: The sender, subject and body of every message.
+        :return: The category of every message, None when the model gave no valid answer for it.
+        """
+        categories = []
+        for start in range(0, len(emails), self.batch_size):
+            categories += self._classify_batch(emails[start : start + self.batch_size])
+        return categories
+
+    def _classify_batch(self, emails) -> List[Optional[str]]:
+        prompt = PROMPT.format(
+            categories=", ".join(self.categories),
+            emails="\n".join(
+                EMAIL_TEMPLATE.format(number=number, sender=sender, subject=subject, body=body)
+                for number, (sender, subject, body) in enumerate(
+                    (self.prepare(*email) for email in emails), start=1
+                )
+            ),
+        )
+        try:
+            with timed("classifier_batch_seconds"):
+                answer = self.llm.complete(prompt).text
+        except Exception as e:
+            logger.warning("Can't classify %s messages: %s", len(emails), e)
+            return [None] * len(emails)
+
+        categories = self._parse_answer(answer, len(emails))
+        increment("classifier_messages_total", sum(c is not None for c in categories), result="classified")
+        increment("classifier_messages_total", sum(c is None for c in categories), result="invalid")
+        return categories
+
+    def _parse_answer(self, answer: str, number_of_emails: int) -> List[Optional[str]]:
+        categories = [None] * number_of_emails
+        for number, category in ANSWER_RE.findall(answer):
+            category = category.strip().lower()
+            if 1 <= int(number) <= number_of_emails and category in self.categories:
+                categories[int(number) - 1] = category
+        return categories
+
+
+@functools.lru_cache(maxsize=None)
+def get_classifier() -> EmailClassifier:
+    """
+    Get the process-wide classifier, backed by the local model served by Ollama.
+    """
+    from llama_index.llms import Ollama
+
+    llm = Ollama(
+        model=settings.CLASSIFIER_MODEL,
+        base_url=settings.CLASSIFIER_OLLAMA_URL,
+        temperature=0,
+        request_timeout=settings.CLASSIFIER_REQUEST_TIMEOUT,
+    )
+    return EmailClassifier(
+        llm,
+        model_name=settings.CLASSIFIER_MODEL,
+        categories=settings.CLASSIFIER_CATEGORIES,
+        batch_size=settings.CLASSIFIER_BATCH_SIZE,
+        max_body_tokens=settings.CLASSIFIER_MAX_BODY_TOKENS,
+    )
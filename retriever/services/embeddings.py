@@ -0,0 +1,327 @@
+__all__ = ["EmailEmbedder", "EmbeddingIndex", "get_embedder"]
+
+import fcntl
+import functools
+import os
+import re
+import struct
+from contextlib import contextmanager
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from .classifier import URL_RE
+from .metrics import timed
+
+ID_DTYPE = np.dtype("<i8")
+VECTOR_DTYPE = np.dtype("<f4")
+
+# Header of the vectors file: a magic string and the number of dimensions, padded to keep the rows aligned
+HEADER = struct.Struct("<8sI4x")
+MAGIC = b"EMBIDX01"
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale the rows to unit length, so the dot product of two rows is their cosine similarity.
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class EmailEmbedder:
+    """
+    Computes the vectors of messages, from their subject and the beginning of their body, with an embedding model.
+    """
+
+    def __init__(self, embed_model: Any, model_name: str, max_body_chars: int = 2000, batch_size: int = 32):
+        """
+        :param embed_model: A llama_index embedding model, or anything with a `get_text_embedding_batch(texts)`
+            method returning a list of vectors.
+        :param model_name: The name of the model, vectors of different models are kept in different indexes.
+        :param max_body_chars: Number of characters of the body embedded.
+        :param batch_size: Number of messages sent to the model at once.
+        """
+        self.embed_model = embed_model
+        self.max_body_chars = max_body_chars
+        self.batch_size = batch_size
+        self.version = re.sub(r"[^\w.-]+", "_", model_name)
+
+    def prepare(self, subject: Optional[str], body: Optional[str]) -> str:
+        """
+        Build the text embedded for a message: its subject and the beginning of its body, with whitespace collapsed
+        and links removed.
+        """
+        body = " ".join(URL_RE.sub("", (body or "")[: self.max_body_chars * 4]).split())[: self.max_body_chars]
+        return f"{' '.join((subject or '').split())}\n{body}"
+
+    def embed(self, emails: Sequence[Tuple[Optional[str], Optional[str]]]) -> np.ndarray:
+        """
+        Compute the unit vectors of messages, `batch_size` messages per call of the model.
+
+        :param emails: The subject and body of every message.
+        :return: A float32 matrix with a row per message.
+        """
+        vectors = []
+        for start in range(0, len(emails), self.batch_size):
+            texts = [self.prepare(*email) for email in emails[start : start + self.batch_size]]
+            with timed("embedding_batch_seconds"):
+                vectors += self.embed_model.get_text_embedding_batch(texts)
+        return normalize(np.asarray(vectors, dtype=VECTOR_DTYPE))
+
+
+class EmbeddingIndex:
+    """
+    Append-only matrix of the unit vectors of messages, stored as float32 rows in a file mapped in memory, with the
+    ID of the message of every row in a second file.
+
+    Queries scan the matrix `chunk_rows` rows at a time with NumPy, so their memory doesn't grow with the index, and
+    the page cache keeps the matrix of an active account in memory for every process. Writers append under an
+    exclusive lock, and readers map the rows present when they open the index, so they never see a partial append.
+
+    Compacting writes both files of a new generation of the index, and switches to it by replacing the file naming
+    the current generation, so a crash never leaves vectors and IDs of different generations.
+    """
+
+    def __init__(self, path: str, chunk_rows: int = 65536):
+        """
+        :param path: The path of the files of the index, without their extension.
+        :param chunk_rows: Number of rows scored at once by a query.
+        """
+        self.path = path
+        self.generation_path = f"{path}.generation"
+        self.lock_path = f"{path}.lock"
+        self.chunk_rows = chunk_rows
+
+    @property
+    def vectors_path(self) -> str:
+        return self._get_files_path(self._get_generation()) + ".vectors"
+
+    @property
+    def ids_path(self) -> str:
+        return self._get_files_path(self._get_generation()) + ".ids"
+
+    def __len__(self) -> int:
+        return len(self.open()[0])
+
+    def open(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Map the index in memory.
+        :return: The message IDs of the rows, and the matrix of their vectors.
+        """
+        with self._lock(fcntl.LOCK_SH):
+            dimensions = self._get_dimensions()
+            rows = self._get_rows(dimensions)
+            if not rows:
+                return np.empty(0, ID_DTYPE), np.empty((0, dimensions or 0), VECTOR_DTYPE)
+            return (
+                np.memmap(self.ids_path, dtype=ID_DTYPE, mode="r", shape=(rows,)),
+                np.memmap(
+                    self.vectors_path, dtype=VECTOR_DTYPE, mode="r", offset=HEADER.size, shape=(rows, dimensions)
+                ),
+            )
+
+    def missing(self, ids: Iterable[int]) -> List[int]:
+        """
+        Find the messages without a vector in the index.
+        """
+        ids = np.fromiter(ids, ID_DTYPE)
+        return ids[~np.isin(ids, self.open()[0])].tolist()
+
+    def get_vectors(self, ids: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Read the vectors of messages.
+        :return: The IDs of the messages found in the index, and their vectors.
+        """
+        stored_ids, vectors = self.open()
+        rows = np.flatnonzero(np.isin(stored_ids, np.fromiter(ids, ID_DTYPE)))
+        return np.asarray(stored_ids[rows]), np.asarray(vectors[rows])
+
+    def append(self, ids: Sequence[int], vectors: np.ndarray) -> int:
+        """
+        Append the vectors of the messages not in the index yet.
+
+        :param ids: The IDs of the messages.
+        :param vectors: Their unit vectors, a row per message.
+        :return: The number of appended rows.
+        """
+        ids = np.asarray(ids, ID_DTYPE)
+        vectors = np.asarray(vectors, VECTOR_DTYPE)
+        if not len(ids):
+            return 0
+
+        with self._lock(fcntl.LOCK_EX):
+            dimensions = self._get_dimensions()
+            if dimensions is None:
+                dimensions = vectors.shape[1]
+                with open(self.vectors_path, "wb") as f:
+                    f.write(HEADER.pack(MAGIC, dimensions))
+                open(self.ids_path, "wb").close()
+            if vectors.shape[1] != dimensions:
+                raise ValueError(f"Vectors of {vectors.shape[1]} dimensions added to an index of {dimensions}")
+
+            rows = self._get_rows(dimensions)
+            new = np.zeros(len(ids), dtype=bool)
+            new[np.unique(ids, return_index=True)[1]] = True
+            new &= ~np.isin(ids, np.fromfile(self.ids_path, ID_DTYPE, count=rows))
+            with open(self.vectors_path, "r+b") as vectors_file, open(self.ids_path, "r+b") as ids_file:
+                # Rows of an interrupted append are dropped first, so both files keep the same rows
+                vectors_file.truncate(HEADER.size + rows * dimensions * VECTOR_DTYPE.itemsize)
+                ids_file.truncate(rows * ID_DTYPE.itemsize)
+                vectors_file.seek(0, os.SEEK_END)
+                vectors_file.write(np.ascontiguousarray(vectors[new]).tobytes())
+                ids_file.seek(0, os.SEEK_END)
+                ids_file.write(ids[new].tobytes())
+        return int(new.sum())
+
+    def compact(self, ids: Iterable[int]) -> int:
+        """
+        Rewrite the index with the rows of the given messages only, e.g. the messages still stored.
+        :return: The number of removed rows.
+        """
+        ids = np.fromiter(ids, ID_DTYPE)
+        with self._lock(fcntl.LOCK_EX):
+            generation = self._get_generation()
+            dimensions = self._get_dimensions()
+            rows = self._get_rows(dimensions)
+            if not rows:
+                return 0
+            stored_ids = np.memmap(self.ids_path, dtype=ID_DTYPE, mode="r", shape=(rows,))
+            vectors = np.memmap(
+                self.vectors_path, dtype=VECTOR_DTYPE, mode="r", offset=HEADER.size, shape=(rows, dimensions)
+            )
+            files_path = self._get_files_path(generation + 1)
+            with open(f"{files_path}.vectors", "wb") as vectors_file, open(f"{files_path}.ids", "wb") as ids_file:
+                vectors_file.write(HEADER.pack(MAGIC, dimensions))
+                kept = 0
+                for start in range(0, rows, self.chunk_rows):
+                    chunk_ids = stored_ids[start : start + self.chunk_rows]
+                    keep = np.isin(chunk_ids, ids)
+                    vectors_file.write(
+                        np.ascontiguousarray(vectors[start : start + self.chunk_rows][keep]).tobytes()
+                    )
+                    ids_file.write(np.asarray(chunk_ids[keep]).tobytes())
+                    kept += int(keep.sum())
+                for f in (vectors_file, ids_file):
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            # Both files of the new generation are complete, switching to it is a single rename
+            with open(f"{self.generation_path}.tmp", "w") as f:
+                f.write(str(generation + 1))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f"{self.generation_path}.tmp", self.generation_path)
+            for extension in ("vectors", "ids"):
+                os.remove(f"{self._get_files_path(generation)}.{extension}")
+        return rows - kept
+
+    def search(
+        self, queries: np.ndarray, k: int = 10, exclude: Iterable[int] = (), min_score: Optional[float] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        Find the messages whose vectors are the most similar to each query vector, by cosine similarity.
+
+        Every chunk of rows is scored against all the queries with one matrix product, and only the `k` best rows
+        of each query are kept between chunks.
+
+        :param queries: Unit vectors, a row per query.
+        :param k: Number of messages returned per query.
+        :param exclude: IDs of messages never returned, e.g. the message of the query.
+        :param min_score: Lowest similarity of the returned messages.
+        :return: The ID and similarity of the most similar messages of every query, most similar first.
+        """
+        queries = np.atleast_2d(np.asarray(queries, VECTOR_DTYPE))
+        excluded = np.fromiter(exclude, ID_DTYPE)
+        best_scores = np.empty((0, len(queries)), VECTOR_DTYPE)
+        best_ids = np.empty((0, len(queries)), ID_DTYPE)
+
+        with timed("embedding_search_seconds"):
+            stored_ids, vectors = self.open()
+            for start in range(0, len(stored_ids), self.chunk_rows):
+                chunk_ids = np.asarray(stored_ids[start : start + self.chunk_rows])
+                scores = vectors[start : start + self.chunk_rows] @ queries.T
+                if len(excluded):
+                    scores[np.isin(chunk_ids, excluded)] = -np.inf
+                scores = np.concatenate([best_scores, scores])
+                candidate_ids = np.concatenate(
+                    [best_ids, np.broadcast_to(chunk_ids[:, None], (len(chunk_ids), len(queries)))]
+                )
+                if len(scores) > k:
+                    top = np.argpartition(-scores, k - 1, axis=0)[:k]
+                    scores, candidate_ids = np.take_along_axis(scores, top, 0), np.take_along_axis(
+                        candidate_ids, top, 0
+                    )
+                best_scores, best_ids = scores, candidate_ids
+
+        order = np.argsort(-best_scores, axis=0, kind="stable")
+        best_scores, best_ids = np.take_along_axis(best_scores, order, 0), np.take_along_axis(best_ids, order, 0)
+        # Excluded messages score -inf, and are only among the best rows of indexes with fewer than k other rows
+        min_score = np.nextafter(-np.inf, 0) if min_score is None else min_score
+        return [
+            [(int(i), float(score)) for i, score in zip(best_ids[:, q], best_scores[:, q]) if score >= min_score]
+            for q in range(len(queries))
+        ]
+
+    @contextmanager
+    def _lock(self, operation: int):
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _get_generation(self) -> int:
+        try:
+            with open(self.generation_path) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _get_files_path(self, generation: int) -> str:
+        return f"{self.path}.{generation}" if generation else self.path
+
+    def _get_dimensions(self) -> Optional[int]:
+        try:
+            with open(self.vectors_path, "rb") as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) < HEADER.size:
+            return None
+        magic, dimensions = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{self.vectors_path} is not an embedding index")
+        return dimensions
+
+    def _get_rows(self, dimensions: Optional[int]) -> int:
+        """
+        Count the rows present in both files, ignoring the end of an interrupted append.
+        """
+        if not dimensions:
+            return 0
+        vector_rows = (os.path.getsize(self.vectors_path) - HEADER.size) // (dimensions * VECTOR_DTYPE.itemsize)
+        return min(vector_rows, os.path.getsize(self.ids_path) // ID_DTYPE.itemsize)
+
+
+@functools.lru_cache(maxsize=None)
+def get_embedder() -> EmailEmbedder:
+    """
+    Get the process-wide embedder, backed by the local model served by Ollama.
+    """
+    from llama_index.embeddings import OllamaEmbedding
+
+    embed_model = OllamaEmbedding(
+        model_name=settings.EMBEDDING_MODEL,
+        base_url=settings.EMBEDDING_OLLAMA_URL,
+        embed_batch_size=settings.EMBEDDING_BATCH_SIZE,
+    )
+    return EmailEmbedder(
+        embed_model,
+        model_name=settings.EMBEDDING_MODEL,
+        max_body_chars=settings.EMBEDDING_MAX_BODY_CHARS,
+        batch_size=settings.EMBEDDING_BATCH_SIZE,
+    )
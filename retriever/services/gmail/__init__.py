@@ -1,2 +1,3 @@
-__all__ = ["GmailLoader"]
-from .gmail_loader import GmailLoader
+__all__ = ["AsyncGmailLoader", "GmailLoader", "HistoryExpiredError"]
+from .async_gmail_loader import AsyncGmailLoader
+from .gmail_loader import GmailLoader, HistoryExpiredError
@@ -0,0 +1,260 @@
+__all__ = ["AsyncGmailLoader"]
+
+import asyncio
+import contextlib
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from .gmail_loader import (
+    DEFAULT_METADATA_HEADERS,
+    QUOTA_UNITS,
+    RETRYABLE_STATUS_CODES,
+    get_retry_delay,
+    is_rate_limit_error,
+)
+from .parser import FAST, METADATA, RAW, GmailMessageParser
+
+logger = logging.getLogger(__name__)
+
+GMAIL_API_URL = "https://gmail.googleapis.com"
+
+
+class AsyncGmailLoaderError(Exception):
+    """
+    Raised when a Gmail API call fails with a non-retryable error, or keeps failing after the retries.
+    """
+
+    def __init__(self, status: int, content: bytes):
+        super().__init__(f"Gmail API call failed with status {status}: {content[:200]!r}")
+        self.status = status
+        self.content = content
+
+
+class AsyncGmailLoader(GmailMessageParser):
+    """
+    asyncio counterpart of `GmailLoader`, calling the Gmail REST API over a pool of keep-alive connections.
+
+    Up to `concurrency` requests are in flight at once, so one process can load a mailbox quickly without gevent.
+    Use it as an async context manager, which opens and closes the connection pool:
+
+        async with AsyncGmailLoader(token=token, concurrency=200) as loader:
+            async for messages, _ in loader.load_message_id_pages():
+                data = await loader.load_full_data_batch([m["id"] for m in messages])
+
+    Every request is charged to the rate limiter shared with the `GmailLoader` of the Celery workers, if any, so
+    both respect the quota of the mailbox when they run at the same time.
+    """
+
+    def __init__(
+        self,
+        query: Optional[str] = None,
+        results_per_page: Optional[int] = 10,
+        use_iterative_parser: Optional[bool] = False,
+        parser_engine: Optional[str] = FAST,
+        max_results: Optional[int] = 10,
+        token: Optional[Dict[str, Any]] = None,
+        concurrency: Optional[int] = 100,
+        max_retries: Optional[int] = 5,
+        message_format: Optional[str] = RAW,
+        metadata_headers: Optional[List[str]] = None,
+        base_url: Optional[str] = GMAIL_API_URL,
+        metrics: Optional[Any] = None,
+        metrics_key: Optional[Any] = None,
+        rate_limiter: Optional[Any] = None,
+        rate_limit_key: Optional[Any] = None,
+    ):
+        """
+        :param query: The query string to filter emails.
+        :param results_per_page: Number of results to return per page.
+        :param use_iterative_parser: Flag to use the iterative parser for email bodies.
+        :param parser_engine: "fast" (default), "legacy" or "iterative" body parsing engine.
+        :param max_results: Maximum number of results to fetch, None for all of them.
+        :param token: The authorized user token.
+        :param concurrency: Maximum number of requests in flight, and of pooled connections.
+        :param max_retries: How many times a rate limited or failed request is retried.
+        :param message_format: "raw" to download and parse whole messages, "metadata" to get only their headers.
+        :param metadata_headers: Headers to request with the "metadata" format.
+        :param base_url: The root URL of the API, e.g. to use a local fake server.
+        :param metrics: Records the latency, calls and errors of the API calls, and the parsing.
+        :param metrics_key: The account label of the recorded API calls.
+        :param rate_limiter: Limiter shared by every worker, charged with the quota units of each call.
+        :param rate_limit_key: The key of the mailbox in the limiter, as Gmail quotas are per user.
+        """
+        self.query = query
+        self.results_per_page = results_per_page
+        self.use_iterative_parser = use_iterative_parser
+        self.parser_engine = parser_engine
+        self.max_results = max_results
+        self.token = token
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.message_format = message_format
+        self.metadata_headers = metadata_headers or DEFAULT_METADATA_HEADERS
+        self.base_url = base_url.rstrip("/")
+        self.metrics = metrics
+        self.metrics_key = metrics_key
+        self.rate_limiter = rate_limiter
+        self.rate_limit_key = rate_limit_key
+        self.credentials = Credentials.from_authorized_user_info(token) if token else None
+        self.session = None
+        self._semaphore = None
+        self._refresh_lock = None
+
+    async def __aenter__(self) -> "AsyncGmailLoader":
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector, raise_for_status=False)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._refresh_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+        self.session = None
+
+    async def load_message_ids(self) -> List[Dict[str, Any]]:
+        """
+        List the messages matching the query.
+
+        :return: The listed messages, with their "id" and "threadId".
+        """
+        return [message async for messages, _ in self.load_message_id_pages() for message in messages]
+
+    async def load_message_id_pages(
+        self, page_token: Optional[str] = None
+    ) -> AsyncIterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Lazily list the messages matching the query, one page at a time, like `GmailLoader.load_message_id_pages`.
+
+        :param page_token: The token of the page to start from, None to start from the beginning.
+        :return: An async iterator of (messages of the page, token of the next page or None).
+        """
+        count = 0
+        while True:
+            params = {"maxResults": int(self.results_per_page)}
+            if self.query:
+                params["q"] = self.query
+            if page_token:
+                params["pageToken"] = page_token
+
+            results = await self._request("messages", params, "messages.list")
+            messages = results.get("messages", [])
+            page_token = results.get("nextPageToken")
+            count += len(messages)
+            yield messages, page_token
+
+            if not page_token or (self.max_results is not None and count >= self.max_results):
+                return
+
+    async def load_full_data(
+        self, message_id: str, message_format: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        message_format = message_format or self.message_format
+        params = [("format", message_format)]
+        if message_format == METADATA:
+            params += [("metadataHeaders", header) for header in self.metadata_headers]
+
+        message_data = await self._request(f"messages/{message_id}", params, "messages.get")
+        return self._parse_response(message_data, message_format)
+
+    async def load_full_data_batch(
+        self, message_ids: List[str], message_format: Optional[str] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Load many messages concurrently.
+
+        :param message_ids: The IDs of the messages to load.
+        :param message_format: Overrides the loader's `message_format` for these messages.
+        :return: The parsed messages in the order of `message_ids`, None where a message could not be loaded.
+        """
+
+        async def load(message_id):
+            try:
+                return await self.load_full_data(message_id, message_format=message_format)
+            except Exception as e:
+                logger.warning("Can't get message data for %s: %s", message_id, e)
+                return None
+
+        return list(await asyncio.gather(*(load(message_id) for message_id in message_ids)))
+
+    def get_token(self) -> Optional[Dict[str, Any]]:
+        if self.credentials:
+            self.token = json.loads(self.credentials.to_json())
+        return self.token
+
+    async def _request(self, path: str, params, method: str) -> Dict[str, Any]:
+        """
+        GET a path of the user's mailbox, retrying with exponential backoff when Gmail pushes back.
+
+        :param path: The path under `users/me/`.
+        :param params: The query parameters.
+        :param method: The API method of the request, for the metrics.
+        :return: The decoded JSON response.
+        """
+        url = f"{self.base_url}/gmail/v1/users/me/{path}"
+        refreshed = False
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_quota(method)
+            headers = {"Authorization": f"Bearer {await self._get_access_token()}"}
+            async with self._semaphore:
+                self._count("gmail_api_calls_total", method=method)
+                with self._timer("gmail_api_request_seconds", method=method):
+                    async with self.session.get(url, params=params, headers=headers) as response:
+                        if response.status == 200:
+                            return await response.json()
+                        status, content = response.status, await response.read()
+                        retry_after = response.headers.get("Retry-After")
+
+            self._count("gmail_api_errors_total", method=method, status=status)
+
+            if status == 401 and not refreshed:
+                await self._refresh_credentials()
+                refreshed = True
+            elif attempt == self.max_retries or not (
+                status in RETRYABLE_STATUS_CODES or is_rate_limit_error(status, content)
+            ):
+                raise AsyncGmailLoaderError(status, content)
+            else:
+                await self._back_off(get_retry_delay(attempt + 1, retry_after))
+
+        raise AsyncGmailLoaderError(status, content)
+
+    async def _acquire_quota(self, method: str) -> None:
+        self._count("gmail_quota_units_total", QUOTA_UNITS[method], method=method)
+        if self.rate_limiter:
+            with self._timer("gmail_rate_limit_wait_seconds"):
+                await self.rate_limiter.acquire_async(self.rate_limit_key, QUOTA_UNITS[method])
+
+    async def _back_off(self, delay: float) -> None:
+        """
+        Wait before retrying, and make every other worker using the same mailbox wait as well.
+        """
+        if self.rate_limiter:
+            await asyncio.to_thread(self.rate_limiter.back_off, self.rate_limit_key, delay)
+        await asyncio.sleep(delay)
+
+    async def _get_access_token(self) -> Optional[str]:
+        if self.credentials and not self.credentials.valid:
+            await self._refresh_credentials()
+        return self.credentials.token if self.credentials else None
+
+    async def _refresh_credentials(self) -> None:
+        # Only one coroutine refreshes the token, the others wait for it
+        token = self.credentials.token
+        async with self._refresh_lock:
+            if self.credentials.token == token:
+                with self._timer("gmail_token_refresh_seconds"):
+                    await asyncio.to_thread(self.credentials.refresh, Request())
+
+    def _timer(self, name: str, **labels: Any):
+        if not self.metrics:
+            return contextlib.nullcontext()
+        return self.metrics.timer(name, account=self.metrics_key, **labels)
+
+    def _count(self, name: str, amount: int = 1, **labels: Any) -> None:
+        if self.metrics:
+            self.metrics.increment(name, amount, account=self.metrics_key, **labels)
@@ -1,29 +1,136 @@
-__all__ = ["GmailLoader"]
+__all__ = ["GmailLoader", "HistoryExpiredError"]
 
 # inspired by https://github.com/run-llama/llama-hub/tree/956aa44b6dfa3e085b9b9a80c3caec0144b1bbbf/llama_hub/gmail
 
-import base64
-import email
+import contextlib
+import functools
 import json
-from typing import Any, Dict, List, Optional, Tuple, Union
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 from core.settings import SCOPES
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import Resource, build
+from googleapiclient.discovery import Resource, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 from llama_index.readers.base import BaseReader
 
-
-class GmailLoader(BaseReader):
+from .parser import FAST, FULL, METADATA, RAW, GmailMessageParser
+
+logger = logging.getLogger(__name__)
+
+# Gmail accepts at most 100 calls in a single batch request.
+# https://developers.google.com/gmail/api/guides/batch
+MAX_BATCH_SIZE = 100
+# Gmail accepts at most 1000 message IDs in a single batchModify or batchDelete call.
+# https://developers.google.com/gmail/api/reference/rest/v1/users.messages/batchModify
+MAX_MODIFY_BATCH_SIZE = 1000
+# Cost of each API method in quota units
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.delete": 10,
+    "messages.batchModify": 50,
+    "messages.batchDelete": 50,
+    "threads.get": 10,
+    "labels.list": 1,
+    "labels.create": 5,
+}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+# Windows of a partitioned listing are split in at most this many windows at once, then split again if needed
+MAX_PARTITION_SPLIT = 32
+# Headers requested with format="metadata", enough for sender analytics
+DEFAULT_METADATA_HEADERS = ["From", "To", "Cc", "Subject", "List-Unsubscribe"]
+# Scopes allowing to label, archive and trash messages, and the only one allowing to delete them permanently
+# https://developers.google.com/gmail/api/auth/scopes
+MODIFY_SCOPES = ["https://www.googleapis.com/auth/gmail.modify", "https://mail.google.com/"]
+DELETE_SCOPES = ["https://mail.google.com/"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_discovery_document() -> str:
+    """
+    Get the Gmail API discovery document shipped with googleapiclient, read once per process.
+    """
+    return get_static_doc("gmail", "v1")
+
+
+def is_rate_limit_error(status_code: int, content: bytes) -> bool:
+    """
+    Check whether a 403 response is a rate limit error, which is worth retrying unlike other 403 errors.
+    """
+    if status_code != 403:
+        return False
+    try:
+        reasons = {e.get("reason") for e in json.loads(content)["error"]["errors"]}
+    except (ValueError, KeyError, TypeError):
+        return False
+    return bool(reasons & RATE_LIMIT_REASONS)
+
+
+def get_retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    Exponential backoff with jitter between two retries, unless Gmail said how long to wait.
+
+    :param attempt: The number of the upcoming attempt, starting at 1.
+    :param retry_after: The Retry-After header of the failed response, if any.
+    :return: Seconds to wait.
+    """
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return min(2 ** (attempt - 1), 32) * random.uniform(1, 1.5)
+
+
+def get_date_query(query: Optional[str], after: int, before: int) -> str:
+    """
+    Restrict a search query to the messages received in a window of time.
+
+    The window is widened by a second at its start, so a message received on the bound between two windows is
+    listed whether Gmail compares it strictly or not; it may then be listed by both windows.
+
+    :param query: The search query, None for every message.
+    :param after: The start of the window, as a Unix timestamp, 0 for no start.
+    :param before: The end of the window, as a Unix timestamp.
+    """
+    terms = [query] if query else []
+    if after > 0:
+        terms.append(f"after:{after - 1}")
+    terms.append(f"before:{before}")
+    return " ".join(terms)
+
+
+class HistoryExpiredError(Exception):
+    """
+    Raised when the start history ID is too old for Gmail to return the changes since then.
+    """
+
+
+class GmailLoader(BaseReader, GmailMessageParser):
     def __init__(
         self,
         query: Optional[str] = None,
         results_per_page: Optional[int] = 10,
         use_iterative_parser: Optional[bool] = False,
+        parser_engine: Optional[str] = FAST,
         max_results: Optional[int] = 10,
         creds: Optional[Dict[str, Any]] = None,
         token: Optional[Dict[str, Any]] = None,
+        batch_size: Optional[int] = MAX_BATCH_SIZE,
+        max_retries: Optional[int] = 5,
+        message_format: Optional[str] = RAW,
+        metadata_headers: Optional[List[str]] = None,
+        rate_limiter: Optional[Any] = None,
+        rate_limit_key: Optional[Any] = None,
+        metrics: Optional[Any] = None,
     ):
         """
         Initialize the GmailReader with optional query parameters.
@@ -31,15 +138,32 @@ class GmailLoader(BaseReader):
         :param query: The query string to filter emails.
         :param results_per_page: Number of results to return per page.
         :param use_iterative_parser: Flag to use the iterative parser for email bodies.
+        :param parser_engine: "fast" (default), "legacy" or "iterative" body parsing engine.
         :param max_results: Maximum number of results to fetch.
+        :param batch_size: Number of calls grouped into one batch request (at most 100).
+        :param max_retries: How many times failed calls of a batch are retried.
+        :param message_format: "raw" to download and parse whole messages, "metadata" to get only their headers.
+        :param metadata_headers: Headers to request with the "metadata" format.
+        :param rate_limiter: Limiter shared by every worker, charged with the quota units of each call.
+        :param rate_limit_key: The key of the mailbox in the limiter, as Gmail quotas are per user.
+        :param metrics: Records the latency, calls, errors and quota units of the API calls, and the parsing.
         """
         self.query = query
         self.results_per_page = results_per_page
         self.use_iterative_parser = use_iterative_parser
+        self.parser_engine = parser_engine
         self.max_results = max_results
         self.service = None
         self.creds_json = creds
         self.token = token
+        self.credentials = None
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_retries = max_retries
+        self.message_format = message_format
+        self.metadata_headers = metadata_headers or DEFAULT_METADATA_HEADERS
+        self.rate_limiter = rate_limiter
+        self.rate_limit_key = rate_limit_key
+        self.metrics = metrics
 
     def load_data(self) -> list[dict[str, Any]]:
         """
@@ -59,13 +183,243 @@ class GmailLoader(BaseReader):
         self.service = self.service or self._build_service()
         return self._search_messages_id()
 
-    def load_full_data(self, message_id: str) -> dict[str, Any]:
+    def load_message_id_pages(
+        self, page_token: Optional[str] = None, query: Optional[str] = None
+    ) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Lazily list the messages matching the query, one page at a time.
+
+        Stops after `max_results` messages (all of them when None). The token returned with a page can be passed
+        back as `page_token` to resume an interrupted listing after that page.
+
+        :param page_token: The token of the page to start from, None to start from the beginning.
+        :param query: The search query, the query of the loader by default.
+        :return: An iterator of (messages of the page, token of the next page or None).
+        """
+        self.service = self.service or self._build_service()
+        query = query or self.query
+        count = 0
+        while True:
+            request = (
+                self.service.users()
+                .messages()
+                .list(userId="me", q=query, pageToken=page_token, maxResults=int(self.results_per_page))
+            )
+            results = self._execute(request, "messages.list")
+            messages = results.get("messages", [])
+            page_token = results.get("nextPageToken")
+            count += len(messages)
+            yield messages, page_token
+
+            if not page_token or (self.max_results is not None and count >= self.max_results):
+                return
+
+    def estimate_message_count(self, query: Optional[str] = None) -> int:
+        """
+        Estimate the number of messages matching a search query with a single call, without listing them.
+
+        :param query: The search query, the query of the loader by default.
+        """
+        self.service = self.service or self._build_service()
+        request = self.service.users().messages().list(userId="me", q=query or self.query, maxResults=1)
+        return int(self._execute(request, "messages.list").get("resultSizeEstimate", 0))
+
+    def partition_by_date(
+        self, after: int, before: int, partition_size: int, min_window: int = 3600
+    ) -> List[Tuple[int, int]]:
+        """
+        Split a window of time into windows of about `partition_size` messages matching the query, to list them in
+        parallel instead of following a single chain of pages.
+
+        Windows are split evenly by their estimated number of messages until they are small enough, so busy periods
+        get narrower windows than quiet ones. Consecutive small windows are merged, and windows estimated without
+        messages merged into their neighbours, so the windows always cover the whole window of time.
+
+        :param after: The start of the window, as a Unix timestamp.
+        :param before: The end of the window, as a Unix timestamp.
+        :param partition_size: The number of messages of a window to aim for.
+        :param min_window: Windows are not split below this number of seconds, whatever their size.
+        :return: The (after, before) windows, in chronological order.
+        """
+        windows, pending = [], [(after, before)]
+        while pending:
+            start, end = pending.pop()
+            count = self.estimate_message_count(get_date_query(self.query, start, end))
+            if count <= partition_size or end - start <= min_window:
+                windows.append((start, end, count))
+                continue
+            parts = max(min(-(-count // partition_size), MAX_PARTITION_SPLIT, (end - start) // min_window), 2)
+            bounds = [start + (end - start) * i // parts for i in range(parts)] + [end]
+            pending += zip(bounds, bounds[1:])
+
+        merged = []
+        for start, end, count in sorted(windows):
+            # Estimates are approximate, the messages of a window estimated empty are listed with a neighbour
+            if merged and (not count or not merged[-1][2] or merged[-1][2] + count <= partition_size):
+                merged[-1] = (merged[-1][0], end, merged[-1][2] + count)
+            else:
+                merged.append((start, end, count))
+        return [(start, end) for start, end, _ in merged]
+
+    def load_full_data(self, message_id: str, message_format: Optional[str] = None) -> dict[str, Any]:
+        self.service = self.service or self._build_service()
+        return self._get_message_data(message={"id": message_id}, message_format=message_format)
+
+    def load_full_data_batch(
+        self, message_ids: List[str], message_format: Optional[str] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Load full data for many messages, grouping up to `batch_size` gets into one batch request.
+
+        :param message_ids: The IDs of the messages to load.
+        :param message_format: Overrides the loader's `message_format` for these messages.
+        :return: The parsed messages in the order of `message_ids`, None where a message could not be loaded.
+        """
+        self.service = self.service or self._build_service()
+        results = {}
+        for start in range(0, len(message_ids), self.batch_size):
+            chunk = message_ids[start : start + self.batch_size]
+            results.update(self._get_messages_data_batch(chunk, message_format=message_format))
+
+        return [results.get(message_id) for message_id in message_ids]
+
+    def load_threads_batch(
+        self, thread_ids: List[str], message_format: Optional[str] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Load whole threads, with all their messages in a single `threads.get` call per thread, grouping up to
+        `batch_size` calls into one batch request.
+
+        A call costs 10 quota units whatever the number of messages, against 5 units per message with
+        `messages.get`, so this is worth it for threads of two messages or more.
+
+        :param thread_ids: The IDs of the threads to load.
+        :param message_format: "metadata" to get only the headers of the messages, any other format loads their
+            bodies with format="full", as `threads.get` has no "raw" format.
+        :return: The parsed threads in the order of `thread_ids`, None where a thread could not be loaded.
+        """
+        self.service = self.service or self._build_service()
+        thread_format = METADATA if (message_format or self.message_format) == METADATA else FULL
+        results = {}
+        for start in range(0, len(thread_ids), self.batch_size):
+            results.update(
+                self._execute_batch(
+                    thread_ids[start : start + self.batch_size],
+                    "threads.get",
+                    functools.partial(self._get_thread_request, thread_format=thread_format),
+                    functools.partial(self._parse_thread, message_format=thread_format),
+                )
+            )
+
+        return [results.get(thread_id) for thread_id in thread_ids]
+
+    def modify_messages(
+        self, message_ids: List[str], add_label_ids: List[str] = (), remove_label_ids: List[str] = ()
+    ) -> None:
+        """
+        Add and remove labels of many messages, `MAX_MODIFY_BATCH_SIZE` messages per `messages.batchModify` call,
+        e.g. remove "INBOX" to archive them, or add "TRASH" to move them to the trash.
+
+        :param message_ids: The IDs of the messages.
+        :param add_label_ids: The IDs of the labels to add.
+        :param remove_label_ids: The IDs of the labels to remove.
+        """
         self.service = self.service or self._build_service()
-        return self._get_message_data(message={"id": message_id})
+        body = {"addLabelIds": list(add_label_ids), "removeLabelIds": list(remove_label_ids)}
+        for start in range(0, len(message_ids), MAX_MODIFY_BATCH_SIZE):
+            chunk = message_ids[start : start + MAX_MODIFY_BATCH_SIZE]
+            request = self.service.users().messages().batchModify(userId="me", body={"ids": chunk, **body})
+            self._execute(request, "messages.batchModify")
+
+    def delete_messages(self, message_ids: List[str]) -> None:
+        """
+        Delete many messages permanently, skipping the trash, `MAX_MODIFY_BATCH_SIZE` messages per
+        `messages.batchDelete` call. Needs the "https://mail.google.com/" scope.
+
+        :param message_ids: The IDs of the messages.
+        """
+        self.service = self.service or self._build_service()
+        for start in range(0, len(message_ids), MAX_MODIFY_BATCH_SIZE):
+            chunk = message_ids[start : start + MAX_MODIFY_BATCH_SIZE]
+            request = self.service.users().messages().batchDelete(userId="me", body={"ids": chunk})
+            self._execute(request, "messages.batchDelete")
+
+    def get_label_ids(self, labels: List[str], create: bool = False) -> List[str]:
+        """
+        Find the IDs of labels, e.g. to modify messages with them.
+
+        :param labels: Names or IDs of labels, case insensitive. System labels ("INBOX", "TRASH", "UNREAD"...) have
+            their name as ID.
+        :param create: Create the labels missing from the mailbox, instead of leaving them out.
+        :return: The IDs of the labels.
+        """
+        if not labels:
+            return []
+        self.service = self.service or self._build_service()
+        label_ids = {}
+        for label in self._execute(self.service.users().labels().list(userId="me"), "labels.list").get(
+            "labels", []
+        ):
+            label_ids[label["name"].lower()] = label_ids[label["id"].lower()] = label["id"]
+
+        found = []
+        for label in labels:
+            if label.lower() not in label_ids and create:
+                request = self.service.users().labels().create(userId="me", body={"name": label})
+                label_ids[label.lower()] = self._execute(request, "labels.create")["id"]
+            if label.lower() in label_ids:
+                found.append(label_ids[label.lower()])
+        return found
+
+    def get_history_id(self) -> str:
+        """
+        Get the current history ID of the mailbox, to be used as the start of the next incremental sync.
+
+        :return: The mailbox history ID.
+        """
+        self.service = self.service or self._build_service()
+        return self._execute(self.service.users().getProfile(userId="me"), "getProfile")["historyId"]
+
+    def load_history(self, start_history_id: str) -> Tuple[List[Dict[str, Any]], str]:
+        """
+        Load the changes made to the mailbox since `start_history_id`.
+
+        :param start_history_id: The history ID of the last sync.
+        :return: The history records in chronological order, and the history ID to start the next sync from.
+        :raises HistoryExpiredError: If Gmail no longer keeps the history since `start_history_id`.
+        """
+        self.service = self.service or self._build_service()
+        records = []
+        page_token = None
+        while True:
+            request = (
+                self.service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=HISTORY_TYPES,
+                    maxResults=500,
+                    pageToken=page_token,
+                )
+            )
+            try:
+                results = self._execute(request, "history.list")
+            except HttpError as e:
+                if e.status_code == 404:
+                    raise HistoryExpiredError(f"History ID {start_history_id} is no longer available") from e
+                raise
+
+            records.extend(results.get("history", []))
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return records, results["historyId"]
 
     def get_token(self):
-        credentials, token = self._get_credentials()
-        return token
+        credentials, _ = self._get_credentials()
+        # The HTTP client refreshes the credentials in place when they expire, so read them back
+        self.token = json.loads(credentials.to_json())
+        return self.token
 
     def _build_service(self) -> Resource:
         """
@@ -74,7 +428,7 @@ class GmailLoader(BaseReader):
         :return: The Gmail API service resource.
         """
         credentials, _ = self._get_credentials()
-        return build("gmail", "v1", credentials=credentials)
+        return build_from_document(get_discovery_document(), credentials=credentials)
 
     def _get_credentials(self) -> tuple[Credentials | None | Any, dict[str, Any] | Any]:
         """
@@ -82,19 +436,22 @@ class GmailLoader(BaseReader):
 
         :return: The obtained user credentials.
         """
-        creds = None
-        if self.token:
-            creds = Credentials.from_authorized_user_info(self.token, SCOPES)
+        creds = self.credentials
+        if not creds and self.token:
+            # Refreshed with the scopes it was granted, the scopes requested changing only for new authorizations
+            creds = Credentials.from_authorized_user_info(self.token)
 
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+                with self._timer("gmail_token_refresh_seconds"):
+                    creds.refresh(Request())
             else:
                 flow = InstalledAppFlow.from_client_config(self.creds_json, SCOPES)
                 creds = flow.run_local_server(port=8080)
 
             self.token = json.loads(creds.to_json())
 
+        self.credentials = creds
         return creds, self.token
 
     def _search_messages_id(self) -> List[Dict[str, Any]]:
@@ -103,17 +460,7 @@ class GmailLoader(BaseReader):
 
         :return: A list of message data dictionaries.
         """
-        results = (
-            self.service.users()
-            .messages()
-            .list(userId="me", q=self.query, maxResults=int(self.results_per_page))
-            .execute()
-        )
-
-        messages = results.get("messages", [])
-        self._paginate_messages(messages, results)
-
-        return messages
+        return [message for messages, _ in self.load_message_id_pages() for message in messages]
 
     def _search_messages(self) -> List[Dict[str, Any]]:
         """
@@ -121,34 +468,7 @@ class GmailLoader(BaseReader):
 
         :return: A list of message data dictionaries.
         """
-        results = (
-            self.service.users()
-            .messages()
-            .list(userId="me", q=self.query, maxResults=int(self.results_per_page))
-            .execute()
-        )
-
-        messages = results.get("messages", [])
-        self._paginate_messages(messages, results)
-
-        return self._process_messages(messages)
-
-    def _paginate_messages(self, messages: List[Dict[str, Any]], results: Dict[str, Any]) -> None:
-        """
-        Paginate through message search results and append them to the messages list.
-
-        :param messages: The current list of messages.
-        :param results: The current page of search results.
-        """
-        while "nextPageToken" in results and len(messages) < self.max_results:
-            page_token = results["nextPageToken"]
-            results = (
-                self.service.users()
-                .messages()
-                .list(userId="me", q=self.query, pageToken=page_token, maxResults=int(self.results_per_page))
-                .execute()
-            )
-            messages.extend(results.get("messages", []))
+        return self._process_messages(self._search_messages_id())
 
     def _process_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
@@ -168,111 +488,212 @@ class GmailLoader(BaseReader):
 
         return result
 
-    def _get_message_data(self, message: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    def _get_message_data(
+        self, message: Dict[str, str], message_format: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
         """
         Retrieve and parse data for a single message.
 
         :param message: A dictionary representing a Gmail message.
+        :param message_format: Overrides the loader's `message_format`.
         :return: A dictionary with the message's details, or None if unable to parse.
         """
-        message_id = message["id"]
-        message_data = self.service.users().messages().get(userId="me", id=message_id, format="raw").execute()
-
-        parser = self._extract_message_body_iterative if self.use_iterative_parser else self._extract_message_body
-        body, subject, sender, recipient, copy = parser(message_data)
+        message_format = message_format or self.message_format
+        message_data = self._execute(self._get_message_request(message["id"], message_format), "messages.get")
+        return self._parse_response(message_data, message_format)
 
-        if not body:
-            return None
+    def _get_messages_data_batch(
+        self, message_ids: List[str], message_format: Optional[str] = None
+    ) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Retrieve and parse data for up to `batch_size` messages with a single batch request.
 
-        # https://developers.google.com/gmail/api/reference/rest/v1/users.messages
-        return {
-            "id": message_data.get("id", None),
-            "threadId": message_data.get("threadId", None),
-            "snippet": message_data.get("snippet", None),
-            "internalDate": message_data.get("internalDate", None),
-            "body": body,
-            "labelIds": message_data.get("labelIds", None),
-            "historyId": message_data.get("historyId", None),
-            "subject": subject,
-            "sender": sender,
-            "recipient": recipient,
-            "copy": copy,
-        }
+        :param message_ids: The IDs of the messages to retrieve.
+        :param message_format: Overrides the loader's `message_format`.
+        :return: A dictionary mapping each message ID to its parsed data, or None if unable to load it.
+        """
+        message_format = message_format or self.message_format
+        return self._execute_batch(
+            message_ids,
+            "messages.get",
+            functools.partial(self._get_message_request, message_format=message_format),
+            functools.partial(self._parse_response, message_format=message_format),
+        )
 
-    def _remove_message_with_id(self, message_id: str) -> None:
+    def _execute_batch(
+        self, ids: List[str], method: str, get_request: Callable[[str], Any], parse: Callable[[Dict[str, Any]], Any]
+    ) -> Dict[str, Any]:
         """
-        Remove a message from the user's Gmail account.
+        Send one call per ID in a single batch request.
 
-        :param message_id: The ID of the message to remove.
+        Calls that fail with a retryable error (rate limits, server errors) are sent again in a new batch,
+        without repeating the calls that already succeeded.
+
+        :param ids: The IDs of the resources to retrieve.
+        :param method: The API method of the calls, as named in `QUOTA_UNITS`.
+        :param get_request: Builds the unexecuted request of an ID.
+        :param parse: Parses the resource returned for an ID.
+        :return: A dictionary mapping each ID to its parsed resource, or None if unable to load it.
         """
-        self.service.users().messages().delete(userId="me", id=message_id).execute()
+        results = {}
+        pending = list(dict.fromkeys(ids))
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = self._parse_batch_response(request_id, response, parse)
+                return
+
+            self._count("gmail_api_errors_total", method=method, status=getattr(exception, "status_code", None))
+            if self._is_retryable_error(exception):
+                failed.append(request_id)
+            else:
+                logger.warning("Can't get data for %s: %s", request_id, exception)
+                results[request_id] = None
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._back_off(get_retry_delay(attempt))
+
+            failed = []
+            batch = self.service.new_batch_http_request(callback=callback)
+            for request_id in pending:
+                batch.add(get_request(request_id), request_id=request_id)
+
+            # Each call of a batch is charged as if it was sent on its own
+            self._acquire_quota(method, calls=len(pending))
+            self._count("gmail_api_calls_total", len(pending), method=method)
+            try:
+                with self._timer("gmail_api_request_seconds", method=method):
+                    batch.execute()
+            except HttpError as e:
+                self._count("gmail_api_errors_total", len(pending), method=method, status=e.status_code)
+                if not self._is_retryable_error(e):
+                    raise
+                failed = [request_id for request_id in pending if request_id not in results]
 
-    def _extract_message_body_iterative(
-        self, message: Dict[str, Any], is_top_level: bool = True
-    ) -> Union[Dict[str, Any], str]:
+            pending = failed
+            if not pending:
+                break
+
+        for request_id in pending:
+            logger.warning("Giving up on %s after %s retries", request_id, self.max_retries)
+            results[request_id] = None
+
+        return results
+
+    @staticmethod
+    def _parse_batch_response(
+        request_id: str, response: Dict[str, Any], parse: Callable[[Dict[str, Any]], Any]
+    ) -> Optional[Any]:
         """
-        Iteratively extract the body and other details from a message.
+        Parse one response of a batch request without failing the rest of the batch.
 
-        :param message: The message to parse.
-        :param is_top_level: Whether this is the top level of the message (controls parsing logic).
-        :return: A dictionary with the email's details, or the body text if not top level.
+        :param request_id: The ID of the requested resource.
+        :param response: The resource returned by Gmail.
+        :param parse: Parses the resource.
+        :return: The parsed resource, or None if unable to parse it.
         """
-        if is_top_level and "raw" in message:
-            body = base64.urlsafe_b64decode(message["raw"].encode("utf-8"))
-            mime_msg = email.message_from_bytes(body)
-        else:
-            mime_msg = message
+        try:
+            return parse(response)
+        except Exception as e:
+            logger.warning("Can't parse %s: %s", request_id, e)
+            return None
 
-        subject, sender, recipient, copy = None, None, None, None
+    def _get_message_request(self, message_id: str, message_format: str):
+        """
+        Build the `messages.get` request for a single message.
 
-        # Extract email details at the top level
-        if is_top_level:
-            subject = mime_msg["Subject"]
-            sender = mime_msg["From"]
-            recipient = mime_msg["To"]
-            copy = mime_msg["Cc"]
+        :param message_id: The ID of the message.
+        :param message_format: "raw" or "metadata".
+        :return: The unexecuted request.
+        """
+        if message_format == METADATA:
+            return (
+                self.service.users()
+                .messages()
+                .get(userId="me", id=message_id, format=METADATA, metadataHeaders=self.metadata_headers)
+            )
+        return self.service.users().messages().get(userId="me", id=message_id, format=RAW)
 
-        body_text = ""
-        if mime_msg.get_content_type() == "text/plain":
-            plain_text = mime_msg.get_payload(decode=True)
-            charset = mime_msg.get_content_charset("utf-8")
-            body_text = plain_text.decode(charset)
+    def _get_thread_request(self, thread_id: str, thread_format: str):
+        """
+        Build the `threads.get` request for a single thread.
 
-        elif mime_msg.get_content_maintype() == "multipart":
-            for part in mime_msg.get_payload():
-                body_text += self._extract_message_body_iterative(part, is_top_level=False)
+        :param thread_id: The ID of the thread.
+        :param thread_format: "full" or "metadata".
+        :return: The unexecuted request.
+        """
+        if thread_format == METADATA:
+            return (
+                self.service.users()
+                .threads()
+                .get(userId="me", id=thread_id, format=METADATA, metadataHeaders=self.metadata_headers)
+            )
+        return self.service.users().threads().get(userId="me", id=thread_id, format=FULL)
 
-        if is_top_level:
-            return subject, sender, recipient, body_text, copy
-        else:
-            return body_text
+    def _execute(self, request, method: str) -> Any:
+        """
+        Execute a request within the rate limit, retrying with exponential backoff when Gmail pushes back.
 
-    @staticmethod
-    def _extract_message_body(
-        message: Dict[str, str]
-    ) -> Tuple[str, Optional[str], Optional[str], Optional[str], Optional[str]]:
+        :param request: The unexecuted request.
+        :param method: The API method of the request, as named in `QUOTA_UNITS`.
+        :return: The response of the request.
         """
-        Extract the body and other details from a message.
+        retry_after = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._back_off(get_retry_delay(attempt, retry_after))
 
-        :param message: The message to parse.
-        :return: A tuple containing the body, subject, sender, recipient, and copy of the message.
+            self._acquire_quota(method)
+            self._count("gmail_api_calls_total", method=method)
+            try:
+                with self._timer("gmail_api_request_seconds", method=method):
+                    return request.execute()
+            except HttpError as e:
+                self._count("gmail_api_errors_total", method=method, status=e.status_code)
+                if attempt == self.max_retries or not self._is_retryable_error(e):
+                    raise
+                retry_after = e.resp.get("retry-after")
+
+    def _acquire_quota(self, method: str, calls: int = 1) -> None:
+        self._count("gmail_quota_units_total", QUOTA_UNITS[method] * calls, method=method)
+        if self.rate_limiter:
+            with self._timer("gmail_rate_limit_wait_seconds"):
+                self.rate_limiter.acquire(self.rate_limit_key, QUOTA_UNITS[method] * calls)
+
+    def _timer(self, name: str, **labels: Any):
+        if not self.metrics:
+            return contextlib.nullcontext()
+        return self.metrics.timer(name, account=self.rate_limit_key, **labels)
+
+    def _count(self, name: str, amount: int = 1, **labels: Any) -> None:
+        if self.metrics:
+            self.metrics.increment(name, amount, account=self.rate_limit_key, **labels)
+
+    def _back_off(self, delay: float) -> None:
         """
-        from bs4 import BeautifulSoup
+        Wait before retrying, and make every other worker using the same mailbox wait as well.
+        """
+        if self.rate_limiter:
+            self.rate_limiter.back_off(self.rate_limit_key, delay)
+        time.sleep(delay)
 
-        try:
-            body = base64.urlsafe_b64decode(message["raw"].encode("utf-8"))
-            mime_msg = email.message_from_bytes(body)
+    @staticmethod
+    def _is_retryable_error(error: Exception) -> bool:
+        """
+        Check whether a failed call is worth sending again.
 
-            # If the message body contains HTML, parse it with BeautifulSoup
-            if "text/html" in mime_msg:
-                soup = BeautifulSoup(body, "html.parser")
-                body = soup.get_text()
+        :param error: The exception raised for the call.
+        :return: True for rate limit and transient server errors.
+        """
+        if not isinstance(error, HttpError):
+            return False
+        return error.status_code in RETRYABLE_STATUS_CODES or is_rate_limit_error(error.status_code, error.content)
 
-            subject = mime_msg["Subject"]
-            sender = mime_msg["From"]
-            recipient = mime_msg["To"]
-            copy = mime_msg["Cc"]
+    def _remove_message_with_id(self, message_id: str) -> None:
+        """
+        Remove a message from the user's Gmail account.
 
-            return body.decode("utf-8", errors="replace"), subject, sender, recipient, copy
-        except Exception as e:
-            raise Exception("Can't parse message body" + str(e))
+        :param message_id: The ID of the message to remove.
+        """
+        self._execute(self.service.users().messages().delete(userId="me", id=message_id), "messages.delete")
@@ -0,0 +1,423 @@
+__all__ = [
+    "GmailMessageParser",
+    "RAW",
+    "METADATA",
+    "FULL",
+    "FAST",
+    "LEGACY",
+    "ITERATIVE",
+    "extract_best_text",
+    "extract_payload_text",
+    "html_to_text",
+    "iter_leaf_parts",
+    "split_entity",
+]
+
+import base64
+import binascii
+import codecs
+import email
+import html
+import quopri
+import re
+from email.header import decode_header, make_header
+from email.message import Message
+from email.parser import BytesHeaderParser
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+RAW = "raw"
+METADATA = "metadata"
+# The only format carrying bodies that `threads.get` supports, as it has no "raw" format
+FULL = "full"
+
+# Body parsing engines
+FAST = "fast"
+LEGACY = "legacy"
+ITERATIVE = "iterative"
+
+HEADER_PARSER = BytesHeaderParser()
+
+# Elements without visible text, tags breaking lines, and any other tag
+SKIPPED_ELEMENTS_RE = re.compile(
+    r"<(script|style|head|title|template|noscript)\b.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL
+)
+BLOCK_TAG_RE = re.compile(r"<(?:br|/?(?:p|div|tr|li|ul|ol|table|h[1-6]|blockquote))\b[^>]*>", re.IGNORECASE)
+TAG_RE = re.compile(r"<[^>]*>")
+
+
+def html_to_text(document: str) -> str:
+    """
+    Convert an HTML document to its visible text, with a few regular expression passes instead of a DOM.
+    """
+    text = SKIPPED_ELEMENTS_RE.sub("", document)
+    text = BLOCK_TAG_RE.sub("\n", text)
+    text = html.unescape(TAG_RE.sub("", text))
+    # str.split collapses whitespace much faster than a regular expression
+    return "\n".join(filter(None, (" ".join(line.split()) for line in text.split("\n"))))
+
+
+def split_entity(data: bytes) -> Tuple[Message, bytes]:
+    """
+    Parse the headers of a MIME entity, leaving its body untouched.
+
+    :param data: The bytes of the entity.
+    :return: The headers, as a `Message` without payload, and the body bytes.
+    """
+    if data.startswith(b"\r\n"):
+        return Message(), data[2:]
+    if data.startswith(b"\n"):
+        return Message(), data[1:]
+
+    crlf, lf = data.find(b"\r\n\r\n"), data.find(b"\n\n")
+    if crlf != -1 and (lf == -1 or crlf < lf):
+        return HEADER_PARSER.parsebytes(data[:crlf]), data[crlf + 4 :]
+    if lf != -1:
+        return HEADER_PARSER.parsebytes(data[:lf]), data[lf + 2 :]
+    return HEADER_PARSER.parsebytes(data), b""
+
+
+def iter_leaf_parts(headers: Message, body: bytes) -> Iterator[Tuple[Message, bytes]]:
+    """
+    Walk the MIME tree of an entity once, yielding the headers and the still encoded body of every leaf part.
+
+    Multipart bodies are split on their boundary with byte searches, so the payload of a part (e.g. a large
+    attachment) is never parsed line by line nor decoded unless the caller decides to.
+    """
+    boundary = headers.get_boundary() if headers.get_content_maintype() == "multipart" else None
+    if not boundary:
+        yield headers, body
+        return
+
+    for segment in body.split(b"--" + boundary.encode("utf-8", errors="replace"))[1:]:
+        if segment.startswith(b"--"):
+            break
+        # Drop the end of the delimiter line, and the line break that belongs to the next delimiter
+        segment = segment[segment.find(b"\n") + 1 :]
+        if segment.endswith(b"\r\n"):
+            segment = segment[:-2]
+        elif segment.endswith(b"\n"):
+            segment = segment[:-1]
+        yield from iter_leaf_parts(*split_entity(segment))
+
+
+def decode_body(headers: Message, body: bytes) -> str:
+    """
+    Decode the body of a leaf part to text, using its transfer encoding and its charset when Python knows it.
+    """
+    encoding = headers.get("Content-Transfer-Encoding", "").strip().lower()
+    try:
+        if encoding == "base64":
+            body = binascii.a2b_base64(body)
+        elif encoding == "quoted-printable":
+            body = quopri.decodestring(body)
+    except (binascii.Error, ValueError):
+        pass
+
+    return decode_text(body, headers.get_content_charset())
+
+
+def decode_text(body: bytes, charset: Optional[str]) -> str:
+    """
+    Decode bytes with their declared charset, falling back to utf-8 when it is missing or unknown to Python.
+    """
+    charset = charset or "utf-8"
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = "utf-8"
+    return body.decode(charset, errors="replace")
+
+
+def decode_header_value(value: Optional[str]) -> Optional[str]:
+    """
+    Decode an RFC 2047 encoded header (e.g. "=?utf-8?b?...?="), keeping it as is if it is malformed.
+    """
+    if value is None or "=?" not in value:
+        return value
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, UnicodeDecodeError, ValueError):
+        return value
+
+
+def extract_best_text(headers: Message, body: bytes) -> str:
+    """
+    Return the best text of a message: its first non-empty text/plain part, or else its first text/html part
+    converted to text. Attachments are skipped without being decoded.
+
+    :param headers: The top-level headers of the message.
+    :param body: The body of the message, as returned by `split_entity`.
+    """
+    html_part = None
+    for part_headers, part_body in iter_leaf_parts(headers, body):
+        if part_headers.get_content_disposition() == "attachment" or part_headers.get_filename():
+            continue
+
+        content_type = part_headers.get_content_type()
+        if content_type == "text/plain":
+            text = decode_body(part_headers, part_body)
+            if text.strip():
+                return text
+        elif content_type == "text/html" and html_part is None:
+            html_part = part_headers, part_body
+
+    return html_to_text(decode_body(*html_part)) if html_part is not None else ""
+
+
+def iter_payload_parts(payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Walk the parsed MIME tree of a message fetched with format="full", yielding its leaf parts in order.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get("parts"):
+            stack.extend(reversed(part["parts"]))
+        else:
+            yield part
+
+
+def decode_payload_part(part: Dict[str, Any]) -> str:
+    """
+    Decode the body of a leaf part of a "full" payload, which Gmail already decoded from its transfer encoding.
+    """
+    headers = Message()
+    for header in part.get("headers", []):
+        if header["name"].lower() == "content-type":
+            headers["Content-Type"] = header["value"]
+    body = base64.urlsafe_b64decode(part["body"]["data"].encode("utf-8"))
+    return decode_text(body, headers.get_content_charset())
+
+
+def extract_payload_text(payload: Dict[str, Any]) -> str:
+    """
+    Same as `extract_best_text`, for the parsed payload of a message fetched with format="full". Attachments
+    only carry an "attachmentId" there, so they are never downloaded.
+    """
+    html_part = None
+    for part in iter_payload_parts(payload):
+        if part.get("filename") or "data" not in part.get("body", {}):
+            continue
+
+        if part.get("mimeType") == "text/plain":
+            text = decode_payload_part(part)
+            if text.strip():
+                return text
+        elif part.get("mimeType") == "text/html" and html_part is None:
+            html_part = part
+
+    return html_to_text(decode_payload_part(html_part)) if html_part is not None else ""
+
+
+def get_resource_size(message_data: Dict[str, Any]) -> int:
+    """
+    Approximate size of a downloaded message resource: its decoded size in the "raw" format, Gmail's estimate of
+    the message size otherwise.
+    """
+    if "raw" in message_data:
+        return len(message_data["raw"]) * 3 // 4
+    return int(message_data.get("sizeEstimate", 0))
+
+
+class GmailMessageParser:
+    """
+    Turns the message resources returned by the Gmail API into the dictionaries returned by the loaders.
+
+    Expects `parser_engine`, `use_iterative_parser` and `metrics` attributes on the instance.
+    """
+
+    def _parse_response(self, message_data: Dict[str, Any], message_format: str) -> Optional[Dict[str, Any]]:
+        if not self.metrics:
+            return self._parse_message(message_data, message_format)
+
+        with self.metrics.timer("message_parse_seconds", format=message_format):
+            parsed = self._parse_message(message_data, message_format)
+        self.metrics.increment("message_bytes_total", get_resource_size(message_data), format=message_format)
+        return parsed
+
+    def _parse_message(self, message_data: Dict[str, Any], message_format: str) -> Optional[Dict[str, Any]]:
+        if message_format == METADATA:
+            return self._parse_message_metadata(message_data)
+        if message_format == FULL:
+            return self._parse_message_payload(message_data)
+        return self._parse_message_data(message_data)
+
+    def _parse_thread(self, thread_data: Dict[str, Any], message_format: str) -> Dict[str, Any]:
+        """
+        Parse a thread resource returned by `threads.get`.
+
+        :param thread_data: The thread resource, fetched with format="full" or "metadata".
+        :param message_format: The format the thread was fetched with.
+        :return: A dictionary with the thread's "id", "historyId" and parsed "messages", oldest first.
+        """
+        return {
+            "id": thread_data.get("id", None),
+            "historyId": thread_data.get("historyId", None),
+            "messages": [
+                self._parse_response(message, message_format) for message in thread_data.get("messages", [])
+            ],
+        }
+
+    @staticmethod
+    def _parse_message_metadata(message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Parse a message resource fetched with format="metadata", without any body.
+
+        :param message_data: The message resource, fetched with format="metadata".
+        :return: A dictionary with the message's details.
+        """
+        headers = {}
+        for header in message_data.get("payload", {}).get("headers", []):
+            headers.setdefault(header["name"].lower(), header["value"])
+
+        return {
+            "id": message_data.get("id", None),
+            "threadId": message_data.get("threadId", None),
+            "snippet": message_data.get("snippet", None),
+            "internalDate": message_data.get("internalDate", None),
+            "labelIds": message_data.get("labelIds", None),
+            "historyId": message_data.get("historyId", None),
+            "subject": decode_header_value(headers.get("subject")),
+            "sender": decode_header_value(headers.get("from")),
+            "recipient": decode_header_value(headers.get("to")),
+            "copy": decode_header_value(headers.get("cc")),
+            "listUnsubscribe": headers.get("list-unsubscribe"),
+        }
+
+    @classmethod
+    def _parse_message_payload(cls, message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Parse a message resource fetched with format="full", whose MIME tree Gmail already parsed.
+
+        :param message_data: The message resource, fetched with format="full".
+        :return: A dictionary with the message's details.
+        """
+        data = cls._parse_message_metadata(message_data)
+        data["body"] = extract_payload_text(message_data.get("payload", {}))
+        return data
+
+    def _parse_message_data(self, message_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Parse a raw message resource returned by Gmail.
+
+        :param message_data: The message resource, fetched with format="raw".
+        :return: A dictionary with the message's details, or None if unable to parse.
+        """
+        engine = ITERATIVE if self.use_iterative_parser else self.parser_engine
+        parser = {
+            FAST: self._extract_message_body_fast,
+            LEGACY: self._extract_message_body,
+            ITERATIVE: self._extract_message_body_iterative,
+        }[engine]
+        body, subject, sender, recipient, copy = parser(message_data)
+
+        if body is None:
+            return None
+
+        # https://developers.google.com/gmail/api/reference/rest/v1/users.messages
+        return {
+            "id": message_data.get("id", None),
+            "threadId": message_data.get("threadId", None),
+            "snippet": message_data.get("snippet", None),
+            "internalDate": message_data.get("internalDate", None),
+            "body": body,
+            "labelIds": message_data.get("labelIds", None),
+            "historyId": message_data.get("historyId", None),
+            "subject": subject,
+            "sender": sender,
+            "recipient": recipient,
+            "copy": copy,
+        }
+
+    def _extract_message_body_iterative(
+        self, message: Dict[str, Any], is_top_level: bool = True
+    ) -> Union[Dict[str, Any], str]:
+        """
+        Iteratively extract the body and other details from a message.
+
+        :param message: The message to parse.
+        :param is_top_level: Whether this is the top level of the message (controls parsing logic).
+        :return: A dictionary with the email's details, or the body text if not top level.
+        """
+        if is_top_level and "raw" in message:
+            body = base64.urlsafe_b64decode(message["raw"].encode("utf-8"))
+            mime_msg = email.message_from_bytes(body)
+        else:
+            mime_msg = message
+
+        subject, sender, recipient, copy = None, None, None, None
+
+        # Extract email details at the top level
+        if is_top_level:
+            subject = mime_msg["Subject"]
+            sender = mime_msg["From"]
+            recipient = mime_msg["To"]
+            copy = mime_msg["Cc"]
+
+        body_text = ""
+        if mime_msg.get_content_type() == "text/plain":
+            plain_text = mime_msg.get_payload(decode=True)
+            charset = mime_msg.get_content_charset("utf-8")
+            body_text = plain_text.decode(charset)
+
+        elif mime_msg.get_content_maintype() == "multipart":
+            for part in mime_msg.get_payload():
+                body_text += self._extract_message_body_iterative(part, is_top_level=False)
+
+        if is_top_level:
+            return body_text, subject, sender, recipient, copy
+        else:
+            return body_text
+
+    @staticmethod
+    def _extract_message_body(
+        message: Dict[str, str]
+    ) -> Tuple[str, Optional[str], Optional[str], Optional[str], Optional[str]]:
+        """
+        Extract the body and other details from a message.
+
+        :param message: The message to parse.
+        :return: A tuple containing the body, subject, sender, recipient, and copy of the message.
+        """
+        from bs4 import BeautifulSoup
+
+        try:
+            body = base64.urlsafe_b64decode(message["raw"].encode("utf-8"))
+            mime_msg = email.message_from_bytes(body)
+
+            # If the message body contains HTML, parse it with BeautifulSoup
+            if any(part.get_content_type() == "text/html" for part in mime_msg.walk()):
+                soup = BeautifulSoup(body, "html.parser")
+                body = soup.get_text().encode("utf-8")
+
+            subject = mime_msg["Subject"]
+            sender = mime_msg["From"]
+            recipient = mime_msg["To"]
+            copy = mime_msg["Cc"]
+
+            return body.decode("utf-8", errors="replace"), subject, sender, recipient, copy
+        except Exception as e:
+            raise Exception("Can't parse message body" + str(e))
+
+    @staticmethod
+    def _extract_message_body_fast(
+        message: Dict[str, str]
+    ) -> Tuple[str, Optional[str], Optional[str], Optional[str], Optional[str]]:
+        """
+        Extract the body and other details from a message, with a single walk of its MIME tree that leaves
+        attachments untouched.
+
+        :param message: The message to parse.
+        :return: A tuple containing the body, subject, sender, recipient, and copy of the message.
+        """
+        try:
+            headers, body = split_entity(base64.urlsafe_b64decode(message["raw"].encode("utf-8")))
+            return (
+                extract_best_text(headers, body),
+                decode_header_value(headers["Subject"]),
+                decode_header_value(headers["From"]),
+                decode_header_value(headers["To"]),
+                decode_header_value(headers["Cc"]),
+            )
+        except Exception as e:
+            raise Exception("Can't parse message body" + str(e))
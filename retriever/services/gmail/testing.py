@@ -0,0 +1,353 @@
+"""
+In-memory stand-in for the Gmail API `Resource`, used by the tests to exercise `GmailLoader` without credentials.
+"""
+import base64
+import email
+import json
+from email.message import EmailMessage, Message
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import httplib2
+from aiohttp import web
+from googleapiclient.errors import HttpError
+
+SYSTEM_LABELS = ["INBOX", "SPAM", "TRASH", "UNREAD", "STARRED", "IMPORTANT", "SENT", "DRAFT"]
+
+
+def make_raw_message(
+    subject: str = "Hello",
+    sender: str = "Sender Name <sender@example.com>",
+    recipient: str = "me@example.com",
+    body: str = "Hello there",
+    html: Optional[str] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    Build a base64url encoded MIME message, as returned by `messages.get` with format="raw".
+    """
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = sender
+    message["To"] = recipient
+    for name, value in (headers or {}).items():
+        message[name] = value
+    message.set_content(body)
+    if html is not None:
+        message.add_alternative(html, subtype="html")
+    return base64.urlsafe_b64encode(message.as_bytes()).decode("utf-8")
+
+
+def make_payload(mime_msg: Message) -> Dict[str, Any]:
+    """
+    Convert a MIME message to the parsed "payload" returned with format="full", attachments left out as IDs.
+    """
+    payload = {
+        "mimeType": mime_msg.get_content_type(),
+        "filename": mime_msg.get_filename() or "",
+        "headers": [{"name": k, "value": v} for k, v in mime_msg.items()],
+    }
+    if mime_msg.is_multipart():
+        payload["body"] = {"size": 0}
+        payload["parts"] = [make_payload(part) for part in mime_msg.get_payload()]
+        return payload
+
+    data = mime_msg.get_payload(decode=True) or b""
+    if payload["filename"]:
+        payload["body"] = {"attachmentId": f"attachment-{len(data)}", "size": len(data)}
+    else:
+        payload["body"] = {"data": base64.urlsafe_b64encode(data).decode("utf-8"), "size": len(data)}
+    return payload
+
+
+def make_http_error(status: int, reason: str = "backendError") -> HttpError:
+    content = json.dumps({"error": {"code": status, "errors": [{"reason": reason}]}}).encode("utf-8")
+    return HttpError(httplib2.Response({"status": status}), content)
+
+
+class FakeRequest:
+    def __init__(self, handler):
+        self.handler = handler
+
+    def execute(self):
+        return self.handler()
+
+
+class FakeBatchRequest:
+    def __init__(self, service: "FakeGmailService", callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, request_id: str):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.calls.append(("batch", len(self.requests)))
+        for request_id, request in self.requests:
+            try:
+                response, exception = request.execute(), None
+            except HttpError as e:
+                response, exception = None, e
+            self.callback(request_id, response, exception)
+
+
+class FakeMessagesResource:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def get(self, userId: str, id: str, format: str = "full", metadataHeaders: Optional[List[str]] = None):
+        def handler():
+            self.service.calls.append(("messages.get", id))
+            self.service.raise_pending_failure(id)
+            return self.service.get_message(id, format, metadataHeaders)
+
+        return FakeRequest(handler)
+
+    def list(self, userId: str, q: Optional[str] = None, maxResults: int = 100, pageToken: Optional[str] = None):
+        def handler():
+            self.service.calls.append(("messages.list", pageToken))
+            ids = [i for i in self.service.raw_messages if self.service.matches(i, q)]
+            start = int(pageToken or 0)
+            page = ids[start : start + maxResults]
+            results = {
+                "messages": [{"id": i, "threadId": self.service.get_thread_id(i)} for i in page],
+                "resultSizeEstimate": len(ids),
+            }
+            if start + maxResults < len(ids):
+                results["nextPageToken"] = str(start + maxResults)
+            return results
+
+        return FakeRequest(handler)
+
+    def batchModify(self, userId: str, body: Dict[str, Any]):
+        def handler():
+            self.service.calls.append(("messages.batchModify", len(body["ids"])))
+            for message_id in body["ids"]:
+                labels = self.service.label_ids.setdefault(message_id, [])
+                labels[:] = [label for label in labels if label not in body.get("removeLabelIds", [])]
+                labels += [label for label in body.get("addLabelIds", []) if label not in labels]
+
+        return FakeRequest(handler)
+
+    def batchDelete(self, userId: str, body: Dict[str, Any]):
+        def handler():
+            self.service.calls.append(("messages.batchDelete", len(body["ids"])))
+            for message_id in body["ids"]:
+                self.service.raw_messages.pop(message_id, None)
+
+        return FakeRequest(handler)
+
+
+class FakeLabelsResource:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def list(self, userId: str):
+        def handler():
+            self.service.calls.append(("labels.list", None))
+            labels = self.service.mailbox_labels.items()
+            return {"labels": [{"id": label_id, "name": name} for label_id, name in labels]}
+
+        return FakeRequest(handler)
+
+    def create(self, userId: str, body: Dict[str, Any]):
+        def handler():
+            self.service.calls.append(("labels.create", body["name"]))
+            label_id = f"Label_{len(self.service.mailbox_labels)}"
+            self.service.mailbox_labels[label_id] = body["name"]
+            return {"id": label_id, "name": body["name"]}
+
+        return FakeRequest(handler)
+
+
+class FakeThreadsResource:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def get(self, userId: str, id: str, format: str = "full", metadataHeaders: Optional[List[str]] = None):
+        def handler():
+            self.service.calls.append(("threads.get", id))
+            self.service.raise_pending_failure(id)
+            message_ids = [i for i in self.service.raw_messages if self.service.get_thread_id(i) == id]
+            if not message_ids:
+                raise make_http_error(404, "notFound")
+            messages = [self.service.get_message(i, format, metadataHeaders) for i in message_ids]
+            return {"id": id, "historyId": str(self.service.history_id), "messages": messages}
+
+        return FakeRequest(handler)
+
+
+class FakeHistoryResource:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def list(
+        self, userId: str, startHistoryId: str, maxResults: int = 100, pageToken: Optional[str] = None, **kwargs
+    ):
+        def handler():
+            self.service.calls.append(("history.list", startHistoryId))
+            if int(startHistoryId) < self.service.oldest_history_id:
+                raise make_http_error(404, "notFound")
+            records = [r for r in self.service.history_records if int(r["id"]) > int(startHistoryId)]
+            start = int(pageToken or 0)
+            results = {"history": records[start : start + maxResults], "historyId": str(self.service.history_id)}
+            if start + maxResults < len(records):
+                results["nextPageToken"] = str(start + maxResults)
+            return results
+
+        return FakeRequest(handler)
+
+
+class FakeRateLimiter:
+    """
+    Records the quota charged and the pauses requested by a loader, without waiting.
+    """
+
+    def __init__(self):
+        self.acquired = []
+        self.back_offs = []
+
+    def acquire(self, key, cost=1):
+        self.acquired.append((key, cost))
+
+    async def acquire_async(self, key, cost=1):
+        self.acquired.append((key, cost))
+
+    def back_off(self, key, seconds):
+        self.back_offs.append((key, seconds))
+
+
+class FakeGmailService:
+    """
+    Mimics the subset of `build("gmail", "v1")` used by `GmailLoader`.
+
+    :param messages: Raw (base64url) messages keyed by message ID.
+    :param failures: HTTP status codes, or (status code, reason) tuples, to raise in order for the next calls
+        concerning a message ID.
+    :param history: History records returned by `history.list`, each with an increasing "id".
+    :param history_id: The current history ID of the mailbox.
+    :param oldest_history_id: Start history IDs below this one are answered with 404.
+    :param threads: Message IDs keyed by thread ID, messages of no thread being alone in "thread-<message ID>".
+    :param labels: Names of the labels of the mailbox keyed by label ID, besides the system labels.
+    """
+
+    def __init__(
+        self,
+        messages: Dict[str, str],
+        failures: Optional[Dict[str, List[Union[int, Tuple[int, str]]]]] = None,
+        history: Optional[List[Dict[str, Any]]] = None,
+        history_id: int = 1,
+        oldest_history_id: int = 0,
+        threads: Optional[Dict[str, List[str]]] = None,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.raw_messages = dict(messages)
+        self.failures = {k: list(v) for k, v in (failures or {}).items()}
+        self.history_records = history or []
+        self.history_id = history_id
+        self.oldest_history_id = oldest_history_id
+        self.thread_ids = {m: t for t, message_ids in (threads or {}).items() for m in message_ids}
+        self.mailbox_labels = {**{label: label for label in SYSTEM_LABELS}, **(labels or {})}
+        # Labels of the messages modified by `batchModify`
+        self.label_ids: Dict[str, List[str]] = {}
+        self.access_token = "token"
+        self.calls: List[Any] = []
+
+    def raise_pending_failure(self, key: str):
+        if self.failures.get(key):
+            failure = self.failures[key].pop(0)
+            raise make_http_error(*failure) if isinstance(failure, tuple) else make_http_error(failure)
+
+    def get_thread_id(self, message_id: str) -> str:
+        return self.thread_ids.get(message_id, f"thread-{message_id}")
+
+    def matches(self, message_id: str, query: Optional[str]) -> bool:
+        """
+        Whether a message matches the `after:` and `before:` terms of a search query, other terms being ignored.
+        Messages without a Date header are received at timestamp 0.
+        """
+        mime_msg = email.message_from_bytes(base64.urlsafe_b64decode(self.raw_messages[message_id]))
+        received_at = parsedate_to_datetime(mime_msg["Date"]).timestamp() if mime_msg["Date"] else 0
+        for term in (query or "").split():
+            name, _, value = term.partition(":")
+            if (name == "after" and received_at <= int(value)) or (name == "before" and received_at >= int(value)):
+                return False
+        return True
+
+    def get_message(self, message_id: str, format: str, metadata_headers: Optional[List[str]]) -> Dict[str, Any]:
+        """
+        Build the message resource returned by `messages.get` and `threads.get` in the requested format.
+        """
+        if message_id not in self.raw_messages:
+            raise make_http_error(404, "notFound")
+        message = {"id": message_id, "threadId": self.get_thread_id(message_id)}
+        mime_msg = email.message_from_bytes(base64.urlsafe_b64decode(self.raw_messages[message_id]))
+        if mime_msg["Date"]:
+            message["internalDate"] = str(int(parsedate_to_datetime(mime_msg["Date"]).timestamp() * 1000))
+        if format == "metadata":
+            names = {name.lower() for name in metadata_headers or []}
+            headers = [{"name": k, "value": v} for k, v in mime_msg.items() if k.lower() in names]
+            message["payload"] = {"headers": headers}
+        elif format == "full":
+            message["payload"] = make_payload(mime_msg)
+        else:
+            message["raw"] = self.raw_messages[message_id]
+        return message
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return FakeMessagesResource(self)
+
+    def threads(self):
+        return FakeThreadsResource(self)
+
+    def history(self):
+        return FakeHistoryResource(self)
+
+    def labels(self):
+        return FakeLabelsResource(self)
+
+    def getProfile(self, userId: str):
+        return FakeRequest(lambda: {"emailAddress": "me@example.com", "historyId": str(self.history_id)})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+
+def make_fake_gmail_app(service: FakeGmailService) -> web.Application:
+    """
+    Serve a `FakeGmailService` over HTTP with the routes of the Gmail REST API, for `AsyncGmailLoader`.
+    """
+
+    async def handle(request: web.Request, fake_request: FakeRequest) -> web.Response:
+        if request.headers.get("Authorization") != f"Bearer {service.access_token}":
+            return web.json_response({"error": {"code": 401}}, status=401)
+        try:
+            return web.json_response(fake_request.execute())
+        except HttpError as e:
+            return web.Response(status=e.status_code, body=e.content, content_type="application/json")
+
+    async def list_messages(request: web.Request) -> web.Response:
+        query = request.query
+        fake_request = service.messages().list(
+            userId="me", q=query.get("q"), maxResults=int(query["maxResults"]), pageToken=query.get("pageToken")
+        )
+        return await handle(request, fake_request)
+
+    async def get_message(request: web.Request) -> web.Response:
+        query = request.query
+        fake_request = service.messages().get(
+            userId="me",
+            id=request.match_info["id"],
+            format=query.get("format", "full"),
+            metadataHeaders=query.getall("metadataHeaders", []),
+        )
+        return await handle(request, fake_request)
+
+    app = web.Application()
+    app.router.add_get("/gmail/v1/users/me/messages", list_messages)
+    app.router.add_get("/gmail/v1/users/me/messages/{id}", get_message)
+    return app
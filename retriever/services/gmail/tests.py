@@ -1,8 +1,27 @@
+import base64
+import email
+import io
+import re
+from datetime import datetime, timezone
+from email.message import EmailMessage as MIMEMessage
+from email.utils import format_datetime
+from unittest import mock
+
+from aiohttp.test_utils import TestServer
 from core.settings import GMAIL_CREDS_PATH, GMAIL_TOKEN_PATH
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
 from retriever.constants import GMAIL
-from retriever.models import EmailMessage
+from retriever.management.commands.load_messages_async import Command
+from retriever.models import EmailAccount, EmailMessage
+from retriever.services.gmail import AsyncGmailLoader, GmailLoader
+from retriever.services.gmail.gmail_loader import get_date_query
+from retriever.services.gmail.testing import (
+    FakeGmailService,
+    FakeRateLimiter,
+    make_fake_gmail_app,
+    make_raw_message,
+)
 
 
 class GmailReaderTest(TestCase):
@@ -33,3 +52,407 @@ class GmailReaderTest(TestCase):
 
         # THEN we should be able to load emails.
         self.assertIsNotNone(EmailMessage.objects.filter(email_account=email_account))
+
+
+class GmailLoaderBatchTest(SimpleTestCase):
+    def setUp(self):
+        self.raw_messages = {f"m{i}": make_raw_message(subject=f"Subject {i}") for i in range(5)}
+
+    def _get_loader(self, service, **kwargs):
+        loader = GmailLoader(**kwargs)
+        loader.service = service
+        return loader
+
+    def test_load_full_data_batch_keeps_input_order(self):
+        # GIVEN a loader that batches two messages per request
+        service = FakeGmailService(self.raw_messages)
+        loader = self._get_loader(service, batch_size=2)
+
+        # WHEN loading the messages in a custom order
+        message_ids = ["m3", "m0", "m4", "m1", "m2"]
+        data = loader.load_full_data_batch(message_ids)
+
+        # THEN results follow the input order, using three batch requests
+        self.assertEqual([d["id"] for d in data], message_ids)
+        self.assertEqual([d["subject"] for d in data], [f"Subject {i[1]}" for i in message_ids])
+        self.assertEqual([c for c in service.calls if c[0] == "batch"], [("batch", 2), ("batch", 2), ("batch", 1)])
+
+    @mock.patch("retriever.services.gmail.gmail_loader.time.sleep")
+    def test_load_full_data_batch_retries_only_failed_calls(self, sleep):
+        # GIVEN a message rate limited once and a message that does not exist
+        service = FakeGmailService(self.raw_messages, failures={"m1": [429]})
+        loader = self._get_loader(service)
+
+        # WHEN loading them in one batch
+        data = loader.load_full_data_batch(["m0", "m1", "missing"])
+
+        # THEN only the rate limited call is sent again, and the missing message is None
+        self.assertEqual([d and d["id"] for d in data], ["m0", "m1", None])
+        self.assertEqual([c for c in service.calls if c[0] == "batch"], [("batch", 3), ("batch", 1)])
+        sleep.assert_called_once()
+
+
+class GmailLoaderMetadataTest(SimpleTestCase):
+    def test_load_full_data_with_metadata_format_skips_body(self):
+        # GIVEN a message with a List-Unsubscribe header
+        raw_message = make_raw_message(
+            subject="Weekly news",
+            sender="News <news@example.com>",
+            headers={"List-Unsubscribe": "<mailto:unsubscribe@example.com>"},
+        )
+        service = FakeGmailService({"m0": raw_message})
+        loader = GmailLoader(message_format="metadata")
+        loader.service = service
+
+        # WHEN loading it
+        data = loader.load_full_data_batch(["m0"])[0]
+
+        # THEN only the headers are returned
+        self.assertNotIn("body", data)
+        self.assertEqual(data["subject"], "Weekly news")
+        self.assertEqual(data["sender"], "News <news@example.com>")
+        self.assertEqual(data["listUnsubscribe"], "<mailto:unsubscribe@example.com>")
+
+    def test_encoded_headers_are_decoded_like_in_the_full_format(self):
+        # GIVEN a message with RFC 2047 encoded subject and sender
+        service = FakeGmailService({"m0": make_raw_message(subject="Café", sender="Zoë <zoe@example.com>")})
+        loader = GmailLoader()
+        loader.service = service
+
+        # WHEN loading it with headers only, whole, and parsing its resource in the full format
+        data = [loader.load_full_data_batch(["m0"], message_format=f)[0] for f in ("metadata", "raw")]
+        data.append(loader._parse_response(service.get_message("m0", "full", None), "full"))
+
+        # THEN the headers are the same
+        self.assertEqual({(d["subject"], d["sender"]) for d in data}, {("Café", "Zoë <zoe@example.com>")})
+
+
+class GmailLoaderThreadTest(SimpleTestCase):
+    def test_load_threads_batch_gets_every_message_of_a_thread_at_once(self):
+        # GIVEN a thread of three messages, one with an attachment, and a rate limiter
+        raw_messages = {f"m{i}": make_raw_message(subject=f"Re: Plans {i}", body=f"Reply {i}") for i in range(3)}
+        mime_msg = MIMEMessage()
+        mime_msg["Subject"] = "=?utf-8?b?Q2Fmw6k=?="
+        mime_msg.set_content("<p>Caf\xe9</p>", subtype="html", charset="iso-8859-1")
+        mime_msg.add_attachment(b"secret", maintype="text", subtype="plain", filename="notes.txt")
+        raw_messages["m3"] = base64.urlsafe_b64encode(mime_msg.as_bytes()).decode("utf-8")
+        service = FakeGmailService(raw_messages, threads={"t0": ["m0", "m1", "m2"], "t1": ["m3"]})
+        rate_limiter = FakeRateLimiter()
+        loader = GmailLoader(rate_limiter=rate_limiter, rate_limit_key="account")
+        loader.service = service
+
+        # WHEN loading the threads
+        threads = loader.load_threads_batch(["t0", "t1"])
+
+        # THEN each thread was fetched with a single call, charged 10 units, in the "full" format
+        self.assertEqual(
+            [c for c in service.calls if c[0] == "threads.get"], [("threads.get", "t0"), ("threads.get", "t1")]
+        )
+        self.assertEqual(rate_limiter.acquired, [("account", 20)])
+        self.assertEqual([m["id"] for m in threads[0]["messages"]], ["m0", "m1", "m2"])
+        self.assertEqual([m["body"].strip() for m in threads[0]["messages"]], ["Reply 0", "Reply 1", "Reply 2"])
+
+        # THEN bodies are decoded with their charset, skipping attachments, and headers are decoded
+        self.assertEqual(threads[1]["messages"][0]["body"], "Café")
+        self.assertEqual(threads[1]["messages"][0]["subject"], "Café")
+
+    def test_load_threads_batch_with_metadata_format(self):
+        # GIVEN a thread of two messages
+        service = FakeGmailService(
+            {f"m{i}": make_raw_message(subject=f"Subject {i}") for i in range(2)}, threads={"t0": ["m0", "m1"]}
+        )
+        loader = GmailLoader(message_format="metadata")
+        loader.service = service
+
+        # WHEN loading the headers only
+        thread = loader.load_threads_batch(["t0"])[0]
+
+        # THEN the messages come without body
+        self.assertEqual([m["subject"] for m in thread["messages"]], ["Subject 0", "Subject 1"])
+        self.assertNotIn("body", thread["messages"][0])
+
+
+class GmailLoaderListingTest(SimpleTestCase):
+    def test_load_message_id_pages_is_lazy(self):
+        # GIVEN a mailbox with five messages listed two by two
+        service = FakeGmailService({f"m{i}": make_raw_message() for i in range(5)})
+        loader = GmailLoader(results_per_page=2, max_results=None)
+        loader.service = service
+
+        # WHEN reading the first page only
+        pages = loader.load_message_id_pages()
+        messages, page_token = next(pages)
+
+        # THEN a single list call was made
+        self.assertEqual([m["id"] for m in messages], ["m0", "m1"])
+        self.assertEqual(page_token, "2")
+        self.assertEqual(len(service.calls), 1)
+
+        # THEN the other pages follow, the last one without a next page
+        self.assertEqual([token for _, token in pages], ["4", None])
+
+
+@mock.patch("retriever.services.gmail.gmail_loader.time.sleep")
+class GmailLoaderRateLimitTest(SimpleTestCase):
+    def _get_loader(self, service):
+        self.rate_limiter = FakeRateLimiter()
+        loader = GmailLoader(rate_limiter=self.rate_limiter, rate_limit_key="account")
+        loader.service = service
+        return loader
+
+    def test_calls_are_charged_in_quota_units(self, sleep):
+        # GIVEN a loader with a rate limiter
+        loader = self._get_loader(FakeGmailService({f"m{i}": make_raw_message() for i in range(3)}))
+
+        # WHEN listing the messages and loading them in a batch
+        loader.load_message_ids()
+        loader.load_full_data_batch(["m0", "m1", "m2"])
+
+        # THEN the list is charged 5 units, and the batch 5 units per message
+        self.assertEqual(self.rate_limiter.acquired, [("account", 5), ("account", 15)])
+        sleep.assert_not_called()
+
+    def test_rate_limited_call_backs_off_for_every_worker(self, sleep):
+        # GIVEN a message rate limited twice
+        loader = self._get_loader(
+            FakeGmailService({"m0": make_raw_message()}, failures={"m0": [429, (403, "userRateLimitExceeded")]})
+        )
+
+        # WHEN loading it
+        data = loader.load_full_data("m0")
+
+        # THEN it is retried after growing, shared pauses
+        self.assertEqual(data["id"], "m0")
+        self.assertEqual(len(self.rate_limiter.acquired), 3)
+        delays = [seconds for _, seconds in self.rate_limiter.back_offs]
+        self.assertEqual(len(delays), 2)
+        self.assertLess(delays[0], delays[1])
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], delays)
+
+
+class GmailLoaderPartitionTest(SimpleTestCase):
+    def setUp(self):
+        def at(*date):
+            return {"Date": format_datetime(datetime(*date, tzinfo=timezone.utc))}
+
+        # An undated message, one in 2023, and a burst of 6 messages in a morning
+        messages = {"undated": make_raw_message(), "old": make_raw_message(headers=at(2023, 6, 1))}
+        messages.update({f"m{hour}": make_raw_message(headers=at(2024, 1, 1, hour)) for hour in range(6)})
+        self.service = FakeGmailService(messages)
+        self.loader = GmailLoader(results_per_page=2, max_results=None)
+        self.loader.service = self.service
+        self.before = int(datetime(2024, 2, 1, tzinfo=timezone.utc).timestamp())
+
+    def test_windows_are_sized_by_estimated_counts(self):
+        # WHEN partitioning the mailbox in windows of 3 messages
+        windows = self.loader.partition_by_date(0, self.before, partition_size=3)
+
+        # THEN the busy morning is split in narrower windows than the quiet years, each of 3 messages at most
+        listed = [
+            [m["id"] for page, _ in self.loader.load_message_id_pages(query=get_date_query(None, *w)) for m in page]
+            for w in windows
+        ]
+        self.assertEqual([len(ids) for ids in listed], [3, 3, 2])
+        self.assertEqual(sorted(sum(listed, [])), sorted(self.service.raw_messages))
+        self.assertEqual(windows, sorted(windows))
+        self.assertLessEqual(windows[1][1] - windows[1][0], 3 * 3600)
+
+    def test_windows_tile_the_partitioned_window(self):
+        # GIVEN windows of time with quiet periods estimated without messages, and one without messages at all
+        after = int(datetime(2023, 1, 1, tzinfo=timezone.utc).timestamp())
+        for start, end in [(after, self.before), (0, self.before), (self.before, self.before + 86400)]:
+            # WHEN partitioning them
+            windows = self.loader.partition_by_date(start, end, partition_size=2)
+
+            # THEN the windows cover the whole window of time, without gaps or overlaps
+            self.assertEqual(windows[0][0], start)
+            self.assertEqual(windows[-1][1], end)
+            self.assertTrue(all(a[1] == b[0] for a, b in zip(windows, windows[1:])))
+
+    def test_date_query(self):
+        self.assertEqual(get_date_query("from:me", 100, 200), "from:me after:99 before:200")
+        self.assertEqual(get_date_query(None, 0, 200), "before:200")
+
+
+class GmailLoaderModifyTest(SimpleTestCase):
+    def setUp(self):
+        self.service = FakeGmailService(
+            {f"m{i}": make_raw_message() for i in range(2500)}, labels={"Label_1": "Newsletters"}
+        )
+        self.rate_limiter = FakeRateLimiter()
+        self.loader = GmailLoader(rate_limiter=self.rate_limiter, rate_limit_key="account")
+        self.loader.service = self.service
+
+    def test_modify_and_delete_messages_1000_at_a_time(self):
+        message_ids = list(self.service.raw_messages)
+
+        # WHEN archiving 2500 messages, then deleting them
+        self.loader.modify_messages(message_ids, remove_label_ids=["INBOX"], add_label_ids=["Label_1"])
+        self.loader.delete_messages(message_ids)
+
+        # THEN 3 calls of each were made, charged 50 quota units each
+        self.assertEqual(
+            self.service.calls,
+            [("messages.batchModify", 1000), ("messages.batchModify", 1000), ("messages.batchModify", 500)]
+            + [("messages.batchDelete", 1000), ("messages.batchDelete", 1000), ("messages.batchDelete", 500)],
+        )
+        self.assertEqual(self.rate_limiter.acquired, [("account", 50)] * 6)
+        self.assertEqual(self.service.label_ids["m2499"], ["Label_1"])
+        self.assertFalse(self.service.raw_messages)
+
+    def test_get_label_ids_by_name_creating_missing_labels(self):
+        # WHEN resolving system and user labels, by name or ID
+        label_ids = self.loader.get_label_ids(["inbox", "newsletters", "Label_1", "Receipts"])
+
+        # THEN unknown labels are left out
+        self.assertEqual(label_ids, ["INBOX", "Label_1", "Label_1"])
+
+        # WHEN creating the missing ones
+        label_ids = self.loader.get_label_ids(["Receipts", "Newsletters"], create=True)
+
+        # THEN they are created once
+        self.assertEqual(label_ids, ["Label_9", "Label_1"])
+        self.assertEqual(self.service.mailbox_labels["Label_9"], "Receipts")
+        self.assertEqual(
+            [c for c in self.service.calls if c[0] == "labels.create"], [("labels.create", "Receipts")]
+        )
+
+
+@mock.patch("retriever.services.gmail.async_gmail_loader.asyncio.sleep", new=mock.AsyncMock())
+class AsyncGmailLoaderTest(SimpleTestCase):
+    token = {
+        "token": "token",
+        "refresh_token": "refresh",
+        "client_id": "id",
+        "client_secret": "secret",
+        "expiry": "2999-01-01T00:00:00Z",
+    }
+
+    async def test_load_message_ids_and_full_data(self):
+        # GIVEN a fake Gmail server with five messages, one of them rate limited once
+        raw_messages = {f"m{i}": make_raw_message(subject=f"Subject {i}") for i in range(5)}
+        service = FakeGmailService(raw_messages, failures={"m2": [429]})
+
+        # WHEN listing and loading them concurrently
+        async with TestServer(make_fake_gmail_app(service)) as server:
+            base_url = str(server.make_url(""))
+            async with AsyncGmailLoader(
+                token=self.token, results_per_page=2, max_results=None, base_url=base_url
+            ) as loader:
+                messages = await loader.load_message_ids()
+                data = await loader.load_full_data_batch([m["id"] for m in messages] + ["missing"])
+
+        # THEN every page is listed and the messages come back in order
+        self.assertEqual([m["id"] for m in messages], list(raw_messages))
+        self.assertEqual([d and d["subject"] for d in data], [f"Subject {i}" for i in range(5)] + [None])
+
+    async def test_pages_are_listed_lazily_and_quota_is_shared(self):
+        # GIVEN a fake Gmail server with five messages, one of them rate limited once, and a shared rate limiter
+        raw_messages = {f"m{i}": make_raw_message() for i in range(5)}
+        service = FakeGmailService(raw_messages, failures={"m2": [429]})
+        rate_limiter = FakeRateLimiter()
+
+        # WHEN listing them page by page, and loading each page
+        pages = []
+        async with TestServer(make_fake_gmail_app(service)) as server:
+            async with AsyncGmailLoader(
+                token=self.token,
+                results_per_page=2,
+                max_results=None,
+                base_url=str(server.make_url("")),
+                rate_limiter=rate_limiter,
+                rate_limit_key="account",
+            ) as loader:
+                async for messages, _ in loader.load_message_id_pages():
+                    pages.append([m["id"] for m in messages])
+                    await loader.load_full_data_batch(pages[-1])
+
+        # THEN the pages come one by one, and every request, retries included, is charged to the mailbox
+        self.assertEqual(pages, [["m0", "m1"], ["m2", "m3"], ["m4"]])
+        self.assertEqual(rate_limiter.acquired, [("account", 5)] * (3 + 5 + 1))
+        self.assertEqual(len(rate_limiter.back_offs), 1)
+
+    async def test_metadata_format(self):
+        # GIVEN a fake Gmail server
+        service = FakeGmailService({"m0": make_raw_message(subject="Hi")})
+
+        # WHEN loading the headers only
+        async with TestServer(make_fake_gmail_app(service)) as server:
+            base_url = str(server.make_url(""))
+            async with AsyncGmailLoader(token=self.token, message_format="metadata", base_url=base_url) as loader:
+                data = await loader.load_full_data("m0")
+
+        # THEN no body is returned
+        self.assertEqual(data["subject"], "Hi")
+        self.assertNotIn("body", data)
+
+
+class LoadMessagesAsyncCommandTest(TestCase):
+    async def test_unfilled_messages_are_loaded_a_chunk_at_a_time(self):
+        # GIVEN a fake Gmail server with five messages, and an account
+        service = FakeGmailService({f"m{i}": make_raw_message(subject=f"Subject {i}") for i in range(5)})
+        email_account = await EmailAccount.objects.acreate(email="me@example.com", service_type=GMAIL)
+
+        # WHEN listing and loading them in chunks of 2 messages
+        stdout = io.StringIO()
+        async with TestServer(make_fake_gmail_app(service)) as server:
+            loader = AsyncGmailLoader(
+                token=AsyncGmailLoaderTest.token, max_results=None, base_url=str(server.make_url(""))
+            )
+            failed = await Command(stdout=stdout)._load(email_account, loader, chunk_size=2)
+
+        # THEN every message is loaded, and the progress is reported against the count taken first
+        self.assertEqual(failed, 0)
+        self.assertEqual(
+            sorted([m async for m in EmailMessage.objects.values_list("subject", flat=True)]),
+            [f"Subject {i}" for i in range(5)],
+        )
+        self.assertEqual(re.findall(r"Loaded \S+", stdout.getvalue()), ["Loaded 2/5", "Loaded 4/5", "Loaded 5/5"])
+
+
+class FastParserTest(SimpleTestCase):
+    def _parse(self, mime_msg):
+        loader = GmailLoader()
+        raw = base64.urlsafe_b64encode(mime_msg.as_bytes()).decode("utf-8")
+        return loader._parse_message_data({"id": "m0", "raw": raw})
+
+    def test_plain_text_is_preferred_and_attachments_skipped(self):
+        # GIVEN a message with HTML and plain alternatives, and an attachment
+        mime_msg = MIMEMessage()
+        mime_msg["Subject"] = "=?utf-8?b?Q2Fmw6k=?="
+        mime_msg.set_content("Plain body")
+        mime_msg.add_alternative("<p>HTML body</p>", subtype="html")
+        mime_msg.add_attachment(b"secret text", maintype="text", subtype="plain", filename="notes.txt")
+
+        # WHEN parsing it
+        data = self._parse(mime_msg)
+
+        # THEN the plain part is the body and the encoded subject is decoded
+        self.assertEqual(data["body"].strip(), "Plain body")
+        self.assertEqual(data["subject"], "Café")
+
+    def test_html_is_converted_with_its_charset(self):
+        # GIVEN an HTML only message encoded in latin-1
+        mime_msg = MIMEMessage()
+        mime_msg.set_content(
+            "<html><head><style>p {}</style></head><body><p>Caf\xe9</p><script>x()</script></body></html>",
+            subtype="html",
+            charset="iso-8859-1",
+        )
+
+        # WHEN parsing it
+        data = self._parse(mime_msg)
+
+        # THEN only the visible text is kept
+        self.assertEqual(data["body"], "Café")
+
+    def test_unknown_charset_falls_back_to_utf8(self):
+        # GIVEN a message declaring a charset Python does not know
+        raw = b"Subject: Hi\r\nContent-Type: text/plain; charset=x-unknown\r\n\r\nHello\r\n"
+        mime_msg = email.message_from_bytes(raw)
+
+        # WHEN parsing it
+        data = self._parse(mime_msg)
+
+        # THEN the body is still decoded
+        self.assertEqual(data["body"].strip(), "Hello")
@@ -0,0 +1,283 @@
+__all__ = ["Metrics", "get_metrics", "increment", "timed", "timed_write"]
+
+import functools
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Type and description of every metric
+METRICS = {
+    "gmail_api_request_seconds": ("histogram", "Latency of Gmail API requests, a batch request counting once"),
+    "gmail_api_calls_total": ("counter", "Gmail API calls, every call of a batch request counting once"),
+    "gmail_api_errors_total": ("counter", "Failed Gmail API calls, by HTTP status"),
+    "gmail_quota_units_total": ("counter", "Gmail quota units charged"),
+    "gmail_rate_limit_wait_seconds": ("histogram", "Time spent waiting for quota from the shared rate limiter"),
+    "gmail_token_refresh_seconds": ("histogram", "Latency of OAuth token refreshes"),
+    "message_parse_seconds": ("histogram", "Time spent parsing a message resource"),
+    "message_bytes_total": ("counter", "Size of the downloaded message resources"),
+    "db_write_seconds": ("histogram", "Duration of the bulk writes of the pipeline"),
+    "db_rows_total": ("counter", "Rows handled by the bulk writes of the pipeline"),
+    "classifier_batch_seconds": ("histogram", "Duration of the inference of a batch of messages by the classifier"),
+    "classifier_messages_total": ("counter", "Messages classified, from the cache, by the model, or not at all"),
+    "embedding_batch_seconds": (
+        "histogram",
+        "Duration of the inference of a batch of messages by the embedding model",
+    ),
+    "embedding_search_seconds": ("histogram", "Duration of the similarity queries over an embedding index"),
+    "celery_task_seconds": ("histogram", "Duration of Celery tasks"),
+    "celery_tasks_total": ("counter", "Finished Celery tasks, by state"),
+}
+
+# Parts of a stored sample, besides the upper bounds of the histogram buckets
+VALUE, SUM, COUNT, INF = "value", "sum", "count", "+Inf"
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _percentile(buckets: List[tuple], count: float, quantile: float) -> Optional[float]:
+    """
+    Estimate a percentile as the upper bound of the bucket holding it, None without samples.
+    """
+    if not count:
+        return None
+    cumulative = 0
+    for upper_bound, bucket_count in buckets:
+        cumulative += bucket_count
+        if cumulative >= quantile * count:
+            return upper_bound
+    return math.inf
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the pipeline.
+
+    Samples are added up in memory and flushed every `flush_interval` seconds (and after every Celery task) into a
+    Redis hash shared by every process, so the metrics endpoint of the web server reports the work of all the
+    workers. Without a Redis client, the samples only stay in memory, e.g. in tests.
+    """
+
+    def __init__(
+        self,
+        client: Optional[redis.Redis] = None,
+        key: str = "metrics",
+        flush_interval: float = 10,
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        """
+        :param client: The Redis client holding the samples of every process.
+        :param key: The Redis hash of the samples.
+        :param flush_interval: Seconds between two flushes of the samples to Redis.
+        :param buckets: Upper bounds of the histogram buckets.
+        """
+        self.client = client
+        self.key = key
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self._pending = defaultdict(float)
+        self._local = defaultdict(float)
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def increment(self, name: str, amount: float = 1, **labels: Any) -> None:
+        self._add({(name, self._labels(labels), VALUE): amount})
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        labels = self._labels(labels)
+        upper_bound = next((str(b) for b in self.buckets if value <= b), INF)
+        self._add({(name, labels, upper_bound): 1, (name, labels, SUM): value, (name, labels, COUNT): 1})
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        """
+        Observe the duration of the block in the histogram `name`, whether it raises or not.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def flush(self) -> None:
+        """
+        Add the samples of this process to the shared ones. Metrics are best effort, failures are only logged.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+
+        if self.client is None:
+            for key, amount in pending.items():
+                self._local[key] += amount
+            return
+
+        pipeline = self.client.pipeline(transaction=False)
+        for (name, labels, part), amount in pending.items():
+            pipeline.hincrbyfloat(self.key, json.dumps([name, labels, part]), amount)
+        try:
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning("Can't flush %s metric samples: %s", len(pending), e)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._pending.clear()
+            self._local.clear()
+        if self.client is not None:
+            self.client.delete(self.key)
+
+    def collect(self) -> Dict[str, Dict[tuple, Dict[str, float]]]:
+        """
+        Read the samples of every process.
+
+        :return: The parts of every sample ("value" for counters, "sum", "count" and bucket bounds for histograms)
+            by metric name and labels.
+        """
+        self.flush()
+        if self.client is None:
+            stored = list(self._local.items())
+        else:
+            stored = [
+                (tuple(json.loads(field)), float(amount)) for field, amount in self.client.hgetall(self.key).items()
+            ]
+
+        samples = defaultdict(lambda: defaultdict(dict))
+        for (name, labels, part), amount in stored:
+            samples[name][tuple(map(tuple, labels))][part] = amount
+        return samples
+
+    def render(self) -> str:
+        """
+        Format the samples in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, samples in sorted(self.collect().items()):
+            metric_type, description = METRICS.get(name, ("untyped", ""))
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            for labels, parts in sorted(samples.items()):
+                labels = dict(labels)
+                if metric_type != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(parts.get(VALUE, 0))}")
+                    continue
+                cumulative = 0
+                for upper_bound in [*map(str, self.buckets), INF]:
+                    cumulative += parts.get(upper_bound, 0)
+                    lines.append(
+                        f"{name}_bucket{_format_labels({**labels, 'le': upper_bound})} {_format_value(cumulative)}"
+                    )
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(parts.get(SUM, 0))}")
+                lines.append(f"{name}_count{_format_labels(labels)} {_format_value(parts.get(COUNT, 0))}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        Summarize every sample for people: the value of counters, and the count, mean and estimated percentiles of
+        histograms.
+        """
+        rows = []
+        for name, samples in sorted(self.collect().items()):
+            metric_type, description = METRICS.get(name, ("untyped", ""))
+            for labels, parts in sorted(samples.items()):
+                row = {"name": name, "description": description, "labels": ", ".join(f"{k}={v}" for k, v in labels)}
+                if metric_type == "histogram":
+                    count = parts.get(COUNT, 0)
+                    buckets = [(b, parts.get(str(b), 0)) for b in self.buckets]
+                    row.update(
+                        count=int(count),
+                        total=parts.get(SUM, 0),
+                        mean=parts.get(SUM, 0) / count if count else None,
+                        p50=_percentile(buckets, count, 0.5),
+                        p95=_percentile(buckets, count, 0.95),
+                    )
+                else:
+                    row.update(count=parts.get(VALUE, 0))
+                rows.append(row)
+        return rows
+
+    def _add(self, amounts: Dict[tuple, float]) -> None:
+        with self._lock:
+            for key, amount in amounts.items():
+                self._pending[key] += amount
+            due = time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    @staticmethod
+    def _labels(labels: Dict[str, Any]) -> tuple:
+        return tuple(sorted((name, "" if value is None else str(value)) for name, value in labels.items()))
+
+
+@functools.lru_cache(maxsize=None)
+def get_metrics() -> Optional[Metrics]:
+    """
+    Get the process-wide metrics, or None if they are disabled.
+    """
+    if not settings.METRICS_ENABLED:
+        return None
+
+    return Metrics(redis.Redis.from_url(settings.METRICS_REDIS_URL), flush_interval=settings.METRICS_FLUSH_INTERVAL)
+
+
+@contextmanager
+def timed(name: str, **labels: Any) -> Iterator[None]:
+    """
+    Observe the duration of the block in the histogram `name` of the process-wide metrics, if they are enabled.
+    """
+    metrics = get_metrics()
+    if metrics is None:
+        yield
+        return
+    with metrics.timer(name, **labels):
+        yield
+
+
+def increment(name: str, amount: float = 1, **labels: Any) -> None:
+    """
+    Increment the counter `name` of the process-wide metrics, if they are enabled.
+    """
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.increment(name, amount, **labels)
+
+
+def timed_write(operation: str) -> Callable:
+    """
+    Decorate a bulk write method taking its rows as first argument, to record its duration and number of rows in
+    the process-wide metrics.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(owner, rows, *args, **kwargs):
+            with timed("db_write_seconds", operation=operation):
+                result = method(owner, rows, *args, **kwargs)
+            increment("db_rows_total", len(rows), operation=operation)
+            return result
+
+        return wrapper
+
+    return decorator
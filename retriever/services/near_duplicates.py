@@ -0,0 +1,98 @@
+__all__ = ["MinHasher", "get_min_hasher"]
+
+import functools
+import hashlib
+import re
+import zlib
+from typing import List, Optional
+
+import numpy as np
+from django.conf import settings
+
+from .classifier import DIGITS_RE, URL_RE
+
+# Largest prime below 2**32: hashed shingles and coefficients stay below it, so products fit in 64 bits
+PRIME = np.uint64(4294967291)
+WORD_RE = re.compile(r"\w+")
+
+
+class MinHasher:
+    """
+    MinHash signatures of texts, to find near-duplicates (e.g. the issues of a newsletter) without comparing texts.
+
+    The share of equal values of two signatures estimates the Jaccard similarity of the word shingles of the texts.
+    Signatures are cut in `bands` bands: texts sharing a band are candidates, which finds pairs more similar than
+    about (1 / bands) ** (1 / rows per band) with few comparisons.
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, shingle_size: int = 5, max_chars: int = 10_000):
+        """
+        :param num_perm: Number of hash functions, i.e. of values of a signature.
+        :param bands: Number of bands of a signature, dividing `num_perm`.
+        :param shingle_size: Number of consecutive words of a shingle.
+        :param max_chars: Number of characters of a text hashed.
+        """
+        if num_perm % bands:
+            raise ValueError(f"{bands} bands don't divide {num_perm} hash functions")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_chars = max_chars
+        # Signatures are only comparable when computed with the same hash functions, hence the fixed seed
+        rng = np.random.default_rng(1)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)[:, None]
+
+    def get_shingles(self, text: str) -> np.ndarray:
+        """
+        Hash the shingles of a text, ignoring case, links and numbers (dates, issue numbers, amounts).
+        """
+        words = WORD_RE.findall(DIGITS_RE.sub("0", URL_RE.sub("", text[: self.max_chars].lower())))
+        shingles = {
+            " ".join(words[i : i + self.shingle_size]) for i in range(max(len(words) - self.shingle_size, 0) + 1)
+        }
+        shingles.discard("")
+        return np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), np.uint64, len(shingles))
+
+    def get_signature(self, text: Optional[str]) -> Optional[bytes]:
+        """
+        :return: The signature of the text as uint32 values, None for a text without words.
+        """
+        shingles = self.get_shingles(text or "")
+        if not len(shingles):
+            return None
+        return ((self.a * (shingles % PRIME) + self.b) % PRIME).min(axis=1).astype("<u4").tobytes()
+
+    def get_bands(self, signature: bytes) -> List[int]:
+        """
+        Hash every band of a signature with its position, as signed 64 bits integers to store.
+        """
+        values = np.frombuffer(signature, "<u4")
+        return [
+            int.from_bytes(
+                hashlib.blake2b(
+                    values[band * self.rows : (band + 1) * self.rows].tobytes(), digest_size=8, salt=bytes([band])
+                ).digest(),
+                "little",
+                signed=True,
+            )
+            for band in range(self.bands)
+        ]
+
+    @staticmethod
+    def get_similarity(signature: bytes, other: bytes) -> float:
+        """
+        Estimate the Jaccard similarity of the texts of two signatures.
+        """
+        return float(np.mean(np.frombuffer(signature, "<u4") == np.frombuffer(other, "<u4")))
+
+
+@functools.lru_cache(maxsize=None)
+def get_min_hasher() -> Optional[MinHasher]:
+    """
+    Get the process-wide MinHasher, or None if near-duplicate detection is disabled.
+    """
+    if not settings.NEAR_DUPLICATES_ENABLED:
+        return None
+
+    return MinHasher()
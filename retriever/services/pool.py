@@ -0,0 +1,59 @@
+__all__ = ["LoaderPool", "loader_pool"]
+
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterator, Optional
+
+
+class LoaderPool:
+    """
+    Process-wide pool of ready-to-use loaders, keyed by email account.
+
+    Building a loader (credentials, API client, HTTP connections) is much more expensive than the calls made with it,
+    so loaders are kept after use and handed to the next caller for the same account. A loader is only used by one
+    thread or greenlet at a time, since the underlying HTTP clients are not safe to share between concurrent callers;
+    the lock is a plain `threading.Lock`, which gevent monkey-patching turns into a greenlet-aware one.
+    """
+
+    def __init__(self, max_idle_per_key: int = 100):
+        """
+        :param max_idle_per_key: Maximum number of idle loaders kept for one account.
+        """
+        self.max_idle_per_key = max_idle_per_key
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Iterator[Any]:
+        """
+        Borrow a loader for `key`, building one with `factory` if none is idle.
+
+        The loader goes back to the pool when the block exits normally, and is dropped if it raised.
+        """
+        loader = self._acquire(key) or factory()
+        yield loader
+        self._release(key, loader)
+
+    def clear(self, key: Optional[Hashable] = None) -> None:
+        """
+        Drop the idle loaders of `key`, or of every account, e.g. after its credentials changed.
+        """
+        with self._lock:
+            if key is None:
+                self._idle.clear()
+            else:
+                self._idle.pop(key, None)
+
+    def _acquire(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def _release(self, key: Hashable, loader: Any) -> None:
+        with self._lock:
+            if len(self._idle[key]) < self.max_idle_per_key:
+                self._idle[key].append(loader)
+
+
+loader_pool = LoaderPool()
@@ -0,0 +1,116 @@
+__all__ = ["TokenBucketRateLimiter", "get_rate_limiter"]
+
+import asyncio
+import functools
+import time
+from typing import Hashable, Optional, Tuple
+
+import redis
+from django.conf import settings
+
+# Reserve `cost` tokens from the bucket and return how long the caller has to wait before using them.
+# The bucket may go into debt, so calls costing more than the bucket capacity (e.g. large batches) still go through,
+# and make the following callers wait accordingly. While the pause key exists nothing is reserved, and the caller
+# is told to wait until it expires and try again.
+RESERVE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+
+local paused = redis.call("PTTL", KEYS[2])
+if paused > 0 then
+    return {0, tostring(paused / 1000)}
+end
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+local tokens = tonumber(state[1]) or capacity
+local timestamp = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate) - cost
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "timestamp", now)
+redis.call("EXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return {1, tostring(math.max(0, -tokens) / rate)}
+"""
+
+
+class TokenBucketRateLimiter:
+    """
+    Token bucket shared by every worker through Redis, with one bucket per key (e.g. per email account).
+
+    The bucket refills at `rate` tokens per second up to `capacity`, and callers are charged the cost of their call
+    (quota units for Gmail). `back_off` pauses every caller of a key, when the API pushes back.
+    """
+
+    def __init__(self, client: redis.Redis, rate: float, capacity: float, prefix: str = "rate-limit"):
+        """
+        :param client: The Redis client holding the buckets.
+        :param rate: Tokens added per second.
+        :param capacity: Maximum number of tokens, i.e. the allowed burst.
+        :param prefix: Prefix of the Redis keys.
+        """
+        self.client = client
+        self.rate = rate
+        self.capacity = capacity
+        self.prefix = prefix
+        self._reserve = client.register_script(RESERVE_SCRIPT)
+
+    def acquire(self, key: Hashable, cost: float = 1) -> None:
+        """
+        Block until `cost` tokens of the bucket of `key` are available, and consume them.
+        """
+        while True:
+            reserved, wait = self.reserve(key, cost)
+            if wait > 0:
+                time.sleep(wait)
+            if reserved:
+                return
+
+    async def acquire_async(self, key: Hashable, cost: float = 1) -> None:
+        """
+        Wait until `cost` tokens of the bucket of `key` are available without blocking the event loop, and consume
+        them.
+        """
+        while True:
+            reserved, wait = await asyncio.to_thread(self.reserve, key, cost)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if reserved:
+                return
+
+    def reserve(self, key: Hashable, cost: float = 1) -> Tuple[bool, float]:
+        """
+        Reserve `cost` tokens of the bucket of `key`, unless it is paused.
+        :return: Whether the tokens were reserved, and the seconds to wait before using them or trying again.
+        """
+        reserved, wait = self._reserve(keys=self._keys(key), args=[self.rate, self.capacity, cost])
+        return bool(int(reserved)), float(wait)
+
+    def back_off(self, key: Hashable, seconds: float) -> None:
+        """
+        Pause every caller of `key` for `seconds`, unless a longer pause is already running.
+        """
+        bucket_key, pause_key = self._keys(key)
+        milliseconds = int(seconds * 1000)
+        if milliseconds > 0 and self.client.pttl(pause_key) < milliseconds:
+            self.client.set(pause_key, 1, px=milliseconds)
+
+    def _keys(self, key: Hashable):
+        return [f"{self.prefix}:{key}", f"{self.prefix}:{key}:paused"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_rate_limiter() -> Optional[TokenBucketRateLimiter]:
+    """
+    Get the process-wide limiter of Gmail API calls, or None if rate limiting is disabled.
+    """
+    if not settings.GMAIL_RATE_LIMIT_ENABLED:
+        return None
+
+    return TokenBucketRateLimiter(
+        redis.Redis.from_url(settings.RATE_LIMIT_REDIS_URL),
+        rate=settings.GMAIL_QUOTA_UNITS_PER_SECOND,
+        capacity=settings.GMAIL_QUOTA_UNITS_BURST,
+        prefix="gmail-quota",
+    )
@@ -0,0 +1,31 @@
+__all__ = ["parse_addresses", "parse_sender"]
+
+import functools
+from email.utils import getaddresses, parseaddr
+from typing import Iterable, Optional, Set, Tuple
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_sender(header: Optional[str]) -> Tuple[str, str]:
+    """
+    Split a From header into the display name and the normalized (lowercase) address of the sender.
+
+    The same headers come back again and again (newsletters, notifications), so results are cached.
+
+    :param header: The From header, e.g. "Sender Name <sender@example.com>" or "sender@example.com".
+    :return: The name and the address, empty strings when missing.
+    """
+    if not header:
+        return "", ""
+    name, address = parseaddr(header)
+    return name.strip(), address.strip().lower()
+
+
+def parse_addresses(headers: Iterable[Optional[str]]) -> Set[str]:
+    """
+    Collect the normalized (lowercase) addresses of address headers (From, To, Cc), each holding one or more.
+
+    :param headers: The headers, None for missing ones.
+    :return: The distinct addresses.
+    """
+    return {address.strip().lower() for _, address in getaddresses([h for h in headers if h]) if address.strip()}
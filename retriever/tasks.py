@@ -1,6 +1,36 @@
 # tasks.py
+import time
+from collections import defaultdict
+
 from celery import shared_task
+from celery.signals import task_postrun, task_prerun
 from django.apps import apps
+from django.conf import settings
+
+from retriever.services.gmail.gmail_loader import MAX_MODIFY_BATCH_SIZE
+from retriever.services.metrics import get_metrics
+
+# Start time of the tasks running in this process, by task ID
+_task_starts = {}
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    _task_starts[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    """
+    Record the duration and state of every task, and flush the metrics of the worker.
+    """
+    start = _task_starts.pop(task_id, None)
+    metrics = get_metrics()
+    if metrics is None or start is None:
+        return
+    metrics.observe("celery_task_seconds", time.perf_counter() - start, task=task.name, state=state)
+    metrics.increment("celery_tasks_total", task=task.name, state=state)
+    metrics.flush()
 
 
 @shared_task(rate_limit="100/s")
@@ -8,3 +38,301 @@ def fill_full_data(obj_id, model_name):
     model = apps.get_model("retriever", model_name)
     obj = model.objects.get(id=obj_id)
     obj.load_full_data()
+
+
+@shared_task(rate_limit="100/s")
+def fill_metadata(obj_id, model_name):
+    model = apps.get_model("retriever", model_name)
+    obj = model.objects.get(id=obj_id)
+    obj.load_metadata()
+
+
+@shared_task
+def fill_full_data_batch(obj_ids, model_name, message_format=None):
+    """
+    Load the data of a chunk of objects at once.
+    :return: The number of updated objects, and the IDs of the objects that could not be loaded or no longer exist.
+    """
+    model = apps.get_model("retriever", model_name)
+    objs = list(model.objects.filter(id__in=obj_ids).select_related("email_account"))
+    failed_ids = model.load_full_data_batch(objs, message_format=message_format)
+    if model_name == "EmailMessage":
+        _embed_on_ingest(set(obj_ids) - set(failed_ids))
+    missing_ids = set(obj_ids) - {obj.id for obj in objs}
+    return {"updated": len(objs) - len(failed_ids), "failed": failed_ids + sorted(missing_ids)}
+
+
+@shared_task
+def fill_threads_batch(thread_ids, email_account_id, message_format=None):
+    """
+    Load a chunk of threads of an account, with all their messages.
+    :return: The number of loaded threads, and the IDs of the threads that could not be loaded.
+    """
+    email_account = apps.get_model("retriever", "EmailAccount").objects.get(id=email_account_id)
+    failed_ids = apps.get_model("retriever", "EmailThread").load_threads_batch(
+        email_account, thread_ids, message_format=message_format
+    )
+    _embed_on_ingest(
+        email_account.email_messages.filter(thread_id__in=set(thread_ids) - set(failed_ids)).values_list(
+            "id", flat=True
+        )
+    )
+    return {"updated": len(thread_ids) - len(failed_ids), "failed": failed_ids}
+
+
+@shared_task
+def schedule_syncs():
+    """
+    Queue the sync of the accounts due, run periodically by Celery beat.
+    :return: The number of queued syncs.
+    """
+    email_accounts = apps.get_model("retriever", "EmailAccount").claim_due_syncs(
+        limit=settings.SYNC_MAX_ACCOUNTS_PER_TICK
+    )
+    for email_account in email_accounts:
+        sync_email_account.delay(email_account.id)
+    return {"queued": len(email_accounts)}
+
+
+@shared_task
+def sync_email_account(email_account_id):
+    """
+    Sync an account claimed by `schedule_syncs`, load the data of up to `SYNC_MAX_MESSAGES_PER_RUN` of its messages
+    not loaded yet, the newest first, then schedule its next sync. The first sync of an account lists it by windows
+    of time instead, when `SYNC_PARTITIONED_LISTING` is set.
+    :return: The changes applied by the sync (None after a full resync), and the number of loaded messages.
+    """
+    email_account = apps.get_model("retriever", "EmailAccount").objects.get(id=email_account_id)
+    if not email_account.history_id and settings.SYNC_PARTITIONED_LISTING:
+        # The account stays held until the last window is listed
+        return list_email_messages_partitioned(email_account_id)
+
+    changes, loaded, backlog = None, 0, False
+    try:
+        changes = email_account.sync_email_messages(results_per_page=500, max_results=None)
+        email_message_ids = list(
+            email_account.email_messages.filter(subject__isnull=True)
+            .order_by("-id")
+            .values_list("id", flat=True)[: settings.SYNC_MAX_MESSAGES_PER_RUN]
+        )
+        for start in range(0, len(email_message_ids), settings.FILL_FULL_DATA_CHUNK_SIZE):
+            chunk = email_message_ids[start : start + settings.FILL_FULL_DATA_CHUNK_SIZE]
+            loaded += fill_full_data_batch(chunk, "EmailMessage")["updated"]
+        # Messages that can't be loaded are left for later syncs, they don't make the next one due at once
+        backlog = len(email_message_ids) == settings.SYNC_MAX_MESSAGES_PER_RUN and loaded > 0
+    finally:
+        email_account.schedule_next_sync(added=changes and changes["added"], backlog=backlog)
+    return {"changes": changes, "loaded": loaded}
+
+
+@shared_task
+def list_email_messages_partitioned(email_account_id, partition_size=None):
+    """
+    Split the listing of an account in windows of time of about `partition_size` messages, and queue a
+    `list_email_messages_window` task per window.
+    :return: The number of queued windows.
+    """
+    email_account = apps.get_model("retriever", "EmailAccount").objects.get(id=email_account_id)
+    windows = email_account.start_partitioned_listing(partition_size)
+    for after, before in windows:
+        list_email_messages_window.delay(email_account_id, email_account.list_history_id, after, before)
+    if not windows:
+        email_account.schedule_next_sync()
+    return {"windows": len(windows)}
+
+
+@shared_task
+def list_email_messages_window(email_account_id, list_history_id, after, before):
+    """
+    List a window of time of a partitioned listing, and schedule the next sync of the account after the last window.
+    :return: The number of newly stored messages.
+    """
+    email_account = apps.get_model("retriever", "EmailAccount").objects.get(id=email_account_id)
+    added = email_account.load_message_ids_window(after, before)
+    if email_account.finish_list_window(list_history_id, after):
+        # The data of the listed messages is loaded by the next syncs
+        email_account.schedule_next_sync(backlog=True)
+    return {"added": added}
+
+
+@shared_task
+def classify_email_messages(email_message_ids):
+    """
+    Classify a chunk of messages.
+    :return: The number of classified messages, and the IDs of the messages left unclassified.
+    """
+    model = apps.get_model("retriever", "EmailMessage")
+    email_messages = list(
+        model.objects.filter(id__in=email_message_ids).select_related(
+            "body_content", "cluster__representative__body_content"
+        )
+    )
+    failed_ids = apps.get_model("retriever", "EmailClassification").classify(email_messages)
+    return {"updated": len(email_messages) - len(failed_ids), "failed": failed_ids}
+
+
+@shared_task
+def embed_email_messages(email_message_ids):
+    """
+    Append the vectors of a chunk of loaded messages to the embedding indexes of their accounts.
+    :return: The number of indexed messages, and the IDs of the messages the model could not embed.
+    """
+    model = apps.get_model("retriever", "EmailMessage")
+    email_messages = list(
+        model.objects.filter(id__in=email_message_ids, subject__isnull=False).select_related(
+            "email_account", "body_content"
+        )
+    )
+    failed_ids = model.update_embeddings(email_messages)
+    return {"updated": len(email_messages) - len(failed_ids), "failed": failed_ids}
+
+
+@shared_task
+def modify_email_messages(email_message_ids, add_labels=(), remove_labels=()):
+    """
+    Add and remove labels of a chunk of messages, in their mailboxes and in the database.
+    :return: The number of modified messages.
+    """
+    email_messages = apps.get_model("retriever", "EmailMessage").objects.filter(id__in=email_message_ids)
+    return {"updated": email_messages.modify_labels(add_labels, remove_labels)}
+
+
+@shared_task
+def delete_email_messages_from_mailbox(email_message_ids):
+    """
+    Delete a chunk of messages permanently, from their mailboxes and from the database.
+    :return: The number of deleted messages.
+    """
+    email_messages = apps.get_model("retriever", "EmailMessage").objects.filter(id__in=email_message_ids)
+    return {"deleted": email_messages.delete_from_mailbox()}
+
+
+def _embed_on_ingest(email_message_ids):
+    """
+    Queue the embedding of freshly loaded messages, if `EMBEDDINGS_ON_INGEST` is set.
+    """
+    if settings.EMBEDDINGS_ON_INGEST:
+        _enqueue_chunks(email_message_ids, settings.EMBED_CHUNK_SIZE, embed_email_messages.delay)
+
+
+def enqueue_fill_full_data(queryset, chunk_size=None, message_format=None):
+    """
+    Queue `fill_full_data_batch` tasks for the objects of the queryset, `chunk_size` objects per task.
+    :return: The number of queued tasks.
+    """
+    chunk_size = chunk_size or settings.FILL_FULL_DATA_CHUNK_SIZE
+    model_name = queryset.model.__name__
+    obj_ids = queryset.values_list("id", flat=True).iterator(chunk_size=chunk_size)
+    return _enqueue_chunks(
+        obj_ids, chunk_size, lambda chunk: fill_full_data_batch.delay(chunk, model_name, message_format)
+    )
+
+
+def enqueue_fill_threads(queryset, chunk_size=None, message_format=None):
+    """
+    Queue the loading of the messages of the queryset thread by thread.
+
+    A thread costs 10 quota units against 5 per message, so threads with several of the messages are loaded by
+    `fill_threads_batch` tasks, `chunk_size` threads per task, and the other messages by `fill_full_data_batch` tasks.
+    :return: The number of queued tasks.
+    """
+    chunk_size = chunk_size or settings.FILL_THREADS_CHUNK_SIZE
+    message_ids = defaultdict(list)
+    for message_id, email_account_id, thread_id in queryset.values_list(
+        "id", "email_account_id", "thread_id"
+    ).iterator(chunk_size=settings.FILL_FULL_DATA_CHUNK_SIZE):
+        message_ids[email_account_id, thread_id].append(message_id)
+
+    thread_ids, single_message_ids = defaultdict(list), []
+    for (email_account_id, thread_id), ids in message_ids.items():
+        if thread_id and len(ids) > 1:
+            thread_ids[email_account_id].append(thread_id)
+        else:
+            single_message_ids += ids
+
+    tasks = _enqueue_chunks(
+        single_message_ids,
+        settings.FILL_FULL_DATA_CHUNK_SIZE,
+        lambda chunk: fill_full_data_batch.delay(chunk, "EmailMessage", message_format),
+    )
+    for email_account_id, account_thread_ids in thread_ids.items():
+        tasks += _enqueue_chunks(
+            account_thread_ids,
+            chunk_size,
+            lambda chunk: fill_threads_batch.delay(chunk, email_account_id, message_format),
+        )
+    return tasks
+
+
+def enqueue_classify_email_messages(queryset, chunk_size=None):
+    """
+    Queue `classify_email_messages` tasks for the messages of the queryset, `chunk_size` messages per task.
+    :return: The number of queued tasks.
+    """
+    chunk_size = chunk_size or settings.CLASSIFY_CHUNK_SIZE
+    email_message_ids = queryset.values_list("id", flat=True).iterator(chunk_size=chunk_size)
+    return _enqueue_chunks(email_message_ids, chunk_size, classify_email_messages.delay)
+
+
+def enqueue_embed_email_messages(queryset, chunk_size=None):
+    """
+    Queue `embed_email_messages` tasks for the messages of the queryset missing from the embedding indexes,
+    `chunk_size` messages per task.
+    :return: The number of queued tasks.
+    """
+    chunk_size = chunk_size or settings.EMBED_CHUNK_SIZE
+    message_ids = defaultdict(list)
+    for message_id, email_account_id in queryset.values_list("id", "email_account_id").iterator(
+        chunk_size=chunk_size
+    ):
+        message_ids[email_account_id].append(message_id)
+
+    tasks = 0
+    for email_account in apps.get_model("retriever", "EmailAccount").objects.filter(id__in=message_ids):
+        missing_ids = email_account.get_embedding_index().missing(message_ids[email_account.id])
+        tasks += _enqueue_chunks(missing_ids, chunk_size, embed_email_messages.delay)
+    return tasks
+
+
+def enqueue_modify_email_messages(queryset, add_labels=(), remove_labels=()):
+    """
+    Queue `modify_email_messages` tasks for the messages of the queryset, as many messages per task as Gmail
+    modifies per API call.
+    :return: The number of queued tasks.
+    """
+    add_labels, remove_labels = list(add_labels), list(remove_labels)
+    email_message_ids = queryset.values_list("id", flat=True).iterator(chunk_size=MAX_MODIFY_BATCH_SIZE)
+    return _enqueue_chunks(
+        email_message_ids,
+        MAX_MODIFY_BATCH_SIZE,
+        lambda chunk: modify_email_messages.delay(chunk, add_labels, remove_labels),
+    )
+
+
+def enqueue_delete_email_messages_from_mailbox(queryset):
+    """
+    Queue `delete_email_messages_from_mailbox` tasks for the messages of the queryset, as many messages per task as
+    Gmail deletes per API call.
+    :return: The number of queued tasks.
+    """
+    email_message_ids = queryset.values_list("id", flat=True).iterator(chunk_size=MAX_MODIFY_BATCH_SIZE)
+    return _enqueue_chunks(email_message_ids, MAX_MODIFY_BATCH_SIZE, delete_email_messages_from_mailbox.delay)
+
+
+def _enqueue_chunks(ids, chunk_size, enqueue):
+    """
+    Call `enqueue` with consecutive chunks of `chunk_size` IDs.
+    :return: The number of chunks.
+    """
+    chunk, tasks = [], 0
+    for obj_id in ids:
+        chunk.append(obj_id)
+        if len(chunk) == chunk_size:
+            enqueue(chunk)
+            chunk, tasks = [], tasks + 1
+
+    if chunk:
+        enqueue(chunk)
+        tasks += 1
+
+    return tasks
@@ -0,0 +1,1370 @@
+import io
+import os
+import re
+import tempfile
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest import mock
+
+import numpy as np
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from google.oauth2.credentials import Credentials
+from llama_index.llms import CompletionResponse
+
+from retriever.constants import GMAIL
+from retriever.models import (
+    EmailAccount,
+    EmailAccountMessageIdFilter,
+    EmailClassification,
+    EmailMessage,
+    EmailMessageBody,
+    EmailMessageCluster,
+    EmailMessageSender,
+    EmailThread,
+    SenderDailyStat,
+)
+from retriever.services.classifier import EmailClassifier
+from retriever.services.embeddings import EmailEmbedder, EmbeddingIndex, normalize
+from retriever.services.gmail import GmailLoader
+from retriever.services.gmail.testing import FakeGmailService, make_raw_message
+from retriever.services.metrics import Metrics
+from retriever.services.pool import loader_pool
+from retriever.tasks import (
+    classify_email_messages,
+    delete_email_messages_from_mailbox,
+    embed_email_messages,
+    enqueue_embed_email_messages,
+    enqueue_fill_full_data,
+    enqueue_fill_threads,
+    fill_full_data_batch,
+    list_email_messages_window,
+    modify_email_messages,
+    schedule_syncs,
+    sync_email_account,
+)
+
+
+class FakeServiceMixin:
+    def setUp(self):
+        self.email_account = EmailAccount.objects.create(email="me@example.com", service_type=GMAIL)
+        self.addCleanup(loader_pool.clear)
+
+    def use_service(self, service, scopes=None, **kwargs):
+        """
+        Make the email account load its messages from `service` instead of Gmail, with a token granted `scopes`.
+        """
+
+        def build_loader(*args, **loader_kwargs):
+            loader = GmailLoader(**{**loader_kwargs, **kwargs})
+            loader.service = service
+            loader.credentials = Credentials(token="token", scopes=scopes)
+            return loader
+
+        patcher = mock.patch.object(EmailAccount, "_build_loader", side_effect=build_loader)
+        self.build_loader = patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class SyncEmailMessagesTest(FakeServiceMixin, TestCase):
+    def _message(self, message_id, label_ids=("INBOX",)):
+        return {"message": {"id": message_id, "threadId": f"thread-{message_id}", "labelIds": list(label_ids)}}
+
+    def test_first_sync_lists_messages_and_stores_history_id(self):
+        # GIVEN a mailbox with three messages and no previous sync
+        self.use_service(FakeGmailService({f"m{i}": make_raw_message() for i in range(3)}, history_id=42))
+
+        # WHEN syncing
+        self.email_account.sync_email_messages()
+
+        # THEN every message is listed and the history ID is kept for the next sync
+        self.assertEqual(self.email_account.email_messages.count(), 3)
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.history_id, "42")
+
+    def test_incremental_sync_applies_only_changes(self):
+        # GIVEN two stored messages and a history adding, deleting and relabeling messages
+        self.email_account.history_id = "10"
+        self.email_account.save()
+        EmailMessage.objects.create(external_id="old", email_account=self.email_account)
+        EmailMessage.objects.create(external_id="kept", email_account=self.email_account, label_ids=["INBOX"])
+        history = [
+            {"id": "11", "messagesAdded": [self._message("new")]},
+            {"id": "12", "messagesDeleted": [self._message("old")]},
+            {"id": "13", "labelsRemoved": [self._message("kept", label_ids=[])]},
+            {"id": "14", "messagesAdded": [self._message("gone")]},
+            {"id": "15", "messagesDeleted": [self._message("gone")]},
+        ]
+        service = FakeGmailService({}, history=history, history_id=15)
+        self.use_service(service)
+
+        # WHEN syncing
+        changes = self.email_account.sync_email_messages()
+
+        # THEN only the history is requested and applied
+        self.assertEqual(changes, {"added": 1, "deleted": 1, "updated": 1})
+        self.assertNotIn("messages.list", [c[0] for c in service.calls])
+        self.assertEqual(
+            set(self.email_account.email_messages.values_list("external_id", flat=True)), {"new", "kept"}
+        )
+        self.assertEqual(self.email_account.email_messages.get(external_id="kept").label_ids, [])
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.history_id, "15")
+
+    def test_expired_history_falls_back_to_full_resync(self):
+        # GIVEN a stored history ID older than what Gmail keeps
+        self.email_account.history_id = "1"
+        self.email_account.save()
+        service = FakeGmailService({"m0": make_raw_message()}, history_id=50, oldest_history_id=20)
+        self.use_service(service)
+
+        # WHEN syncing
+        self.email_account.sync_email_messages()
+
+        # THEN the mailbox is listed again and the history ID moves forward
+        self.assertIn("messages.list", [c[0] for c in service.calls])
+        self.assertEqual(self.email_account.email_messages.count(), 1)
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.history_id, "50")
+
+    def test_expired_history_resync_lists_everything_and_deletes_the_missing_messages(self):
+        # GIVEN a stored history ID too old, a message deleted from the mailbox since, and 15 messages left
+        self.email_account.history_id = "1"
+        self.email_account.save()
+        EmailMessage.objects.create(external_id="deleted", email_account=self.email_account)
+        EmailMessage.objects.create(external_id="m0", email_account=self.email_account)
+        service = FakeGmailService(
+            {f"m{i}": make_raw_message() for i in range(15)}, history_id=50, oldest_history_id=20
+        )
+        self.use_service(service)
+
+        # WHEN syncing with the default page size and number of results
+        self.email_account.sync_email_messages()
+
+        # THEN every page is listed, the deleted message is removed, and the history ID moves forward
+        self.assertEqual(
+            set(self.email_account.email_messages.values_list("external_id", flat=True)),
+            {f"m{i}" for i in range(15)},
+        )
+        self.assertEqual([c[0] for c in service.calls].count("messages.list"), 2)
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.history_id, "50")
+
+
+class SyncSchedulerTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        self.email_account.token = {"token": "token"}
+        self.email_account.save()
+
+    def _account(self, email, **kwargs):
+        return EmailAccount.objects.create(email=email, service_type=GMAIL, token={"token": "token"}, **kwargs)
+
+    @mock.patch("retriever.tasks.sync_email_account.delay")
+    def test_due_accounts_are_claimed_once_longest_overdue_first(self, delay):
+        # GIVEN a new account, an overdue one, and accounts not to sync
+        overdue = self._account("overdue@example.com", next_sync_at=self.now - timedelta(hours=1))
+        later = self._account("later@example.com", next_sync_at=self.now + timedelta(minutes=1))
+        self._account("inactive@example.com", is_active=False)
+        syncing = self._account("syncing@example.com", sync_lease_until=self.now + timedelta(minutes=1))
+        EmailAccount.objects.create(email="unauthorized@example.com", service_type=GMAIL)
+
+        # WHEN claiming the accounts due
+        claimed = EmailAccount.claim_due_syncs(now=self.now)
+
+        # THEN the new account and the overdue one are held, and can't be claimed again until they are released
+        self.assertEqual(claimed, [self.email_account, overdue])
+        self.assertEqual(claimed[0].sync_lease_until, self.now + timedelta(hours=1))
+        self.assertEqual(EmailAccount.claim_due_syncs(now=self.now), [])
+
+        # WHEN the scheduler runs after the leases expired
+        with mock.patch("retriever.models.timezone.now", return_value=self.now + timedelta(hours=2)):
+            self.assertEqual(schedule_syncs(), {"queued": 4})
+
+        # THEN a sync is queued per account, the accounts never synced first
+        self.assertEqual(
+            [c.args[0] for c in delay.call_args_list], [self.email_account.id, syncing.id, overdue.id, later.id]
+        )
+
+    def test_interval_follows_the_arrival_rate(self):
+        # GIVEN an account synced at noon
+        self.email_account.schedule_next_sync(now=self.now)
+        self.assertEqual(self.email_account.next_sync_at, self.now + timedelta(seconds=120))
+
+        # WHEN 10 messages arrived in the next hour
+        self.email_account.schedule_next_sync(added=10, now=self.now + timedelta(hours=1))
+
+        # THEN the next sync is due when about 5 more messages should have arrived
+        self.assertEqual(self.email_account.message_arrival_rate, 10)
+        self.assertEqual(self.email_account.sync_interval, timedelta(minutes=30))
+
+        # WHEN no message arrives anymore
+        self.email_account.schedule_next_sync(added=0, now=self.now + timedelta(hours=1, minutes=30))
+
+        # THEN syncs slow down, up to the longest interval
+        self.assertAlmostEqual(self.email_account.message_arrival_rate, 7)
+        self.assertEqual(self.email_account.sync_interval, timedelta(hours=5 / 7))
+        for hours in range(2, 30):
+            self.email_account.schedule_next_sync(added=0, now=self.now + timedelta(hours=hours))
+        self.assertEqual(self.email_account.sync_interval, timedelta(hours=6))
+
+    @override_settings(SYNC_MAX_MESSAGES_PER_RUN=3, SYNC_PARTITIONED_LISTING=False)
+    def test_large_backlogs_are_loaded_over_several_syncs(self):
+        # GIVEN a mailbox of 5 messages, never synced
+        service = FakeGmailService(
+            {f"m{i}": make_raw_message(subject=f"Subject {i}") for i in range(5)}, history_id=7
+        )
+        self.use_service(service)
+
+        # WHEN syncing it
+        with mock.patch("retriever.models.timezone.now", return_value=self.now):
+            result = sync_email_account(self.email_account.id)
+
+        # THEN it is listed, only the 3 newest messages are loaded, and the next sync is due at once
+        self.assertEqual(result, {"changes": None, "loaded": 3})
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.history_id, "7")
+        self.assertEqual(self.email_account.next_sync_at, self.now)
+        self.assertIsNone(self.email_account.sync_lease_until)
+
+        # WHEN syncing it again an hour later
+        with mock.patch("retriever.models.timezone.now", return_value=self.now + timedelta(hours=1)):
+            result = sync_email_account(self.email_account.id)
+
+        # THEN only the history is requested, the other messages are loaded, and the idle mailbox is synced later
+        self.assertEqual(result, {"changes": {"added": 0, "deleted": 0, "updated": 0}, "loaded": 2})
+        self.assertEqual([c[0] for c in service.calls].count("messages.list"), 1)
+        self.assertFalse(self.email_account.email_messages.filter(subject__isnull=True).exists())
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.next_sync_at, self.now + timedelta(hours=7))
+
+    @override_settings(LIST_PARTITION_SIZE=2)
+    def test_first_sync_lists_windows_of_time_in_parallel(self):
+        # GIVEN a mailbox of 5 messages received on different days, never synced
+        service = FakeGmailService(
+            {
+                f"m{day}": make_raw_message(headers={"Date": format_datetime(self.now - timedelta(days=day))})
+                for day in range(5)
+            },
+            history_id=7,
+        )
+        self.use_service(service)
+        self.email_account.sync_lease_until = self.now + timedelta(hours=1)
+        self.email_account.save()
+
+        # WHEN syncing it, the windows being queued
+        with mock.patch("retriever.tasks.list_email_messages_window.delay") as delay:
+            result = sync_email_account(self.email_account.id)
+
+        # THEN the mailbox is split in windows of 2 messages at most, and the account is held until they are listed
+        self.assertEqual(result, {"windows": 3})
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.list_history_id, "7")
+        self.assertEqual(self.email_account.list_windows_left, [c.args[2] for c in delay.call_args_list])
+        self.assertIsNone(self.email_account.history_id)
+        self.assertIsNotNone(self.email_account.sync_lease_until)
+
+        # WHEN the windows are listed in any order, one of them twice, and a window of an older listing
+        windows = [c.args for c in delay.call_args_list]
+        for args in [windows[2], windows[0], windows[0], (self.email_account.id, "3", *windows[1][2:]), windows[1]]:
+            list_email_messages_window(*args)
+
+        # THEN every message is stored once, and the listing ends with the last window
+        self.assertEqual(
+            sorted(self.email_account.email_messages.values_list("external_id", flat=True)),
+            ["m0", "m1", "m2", "m3", "m4"],
+        )
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.history_id, "7")
+        self.assertEqual((self.email_account.list_history_id, self.email_account.list_windows_left), (None, []))
+        self.assertTrue(all(f"m{day}" in self.email_account.message_id_filter for day in range(5)))
+
+        # THEN the account is released, and due at once to load the messages
+        self.assertIsNone(self.email_account.sync_lease_until)
+        self.assertLessEqual(self.email_account.next_sync_at, self.email_account.last_synced_at)
+
+
+class LoadMetadataTest(FakeServiceMixin, TestCase):
+    def test_load_metadata_keeps_body_for_later(self):
+        # GIVEN a listed message
+        self.use_service(FakeGmailService({"m0": make_raw_message(subject="Hi", body="Long body")}))
+        email_message = EmailMessage.objects.create(external_id="m0", email_account=self.email_account)
+
+        # WHEN loading only its metadata
+        email_message.load_metadata()
+
+        # THEN headers are stored without the body, which can be loaded afterwards
+        email_message.refresh_from_db()
+        self.assertEqual(email_message.subject, "Hi")
+        self.assertIsNone(email_message.body)
+
+        email_message.load_full_data()
+        email_message.refresh_from_db()
+        self.assertIn("Long body", email_message.body)
+
+
+class LoaderPoolTest(FakeServiceMixin, TestCase):
+    def test_loader_is_reused_and_token_saved_only_when_changed(self):
+        # GIVEN two listed messages
+        self.use_service(FakeGmailService({"m0": make_raw_message(), "m1": make_raw_message()}))
+        first = EmailMessage.objects.create(external_id="m0", email_account=self.email_account)
+        second = EmailMessage.objects.create(external_id="m1", email_account=self.email_account)
+
+        # WHEN loading the first one, the new token is stored on the account
+        first.load_full_data()
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.token["token"], "token")
+
+        # THEN loading the second one reuses the loader, and only stores its body and sender, puts it in the cluster
+        # of the first one (lock of the account, SELECT of the candidates, UPDATE of the count), updates its row and
+        # the sender count, in a savepoint
+        second.email_account = self.email_account
+        with self.assertNumQueries(11):
+            second.load_full_data()
+        self.assertEqual(self.build_loader.call_count, 1)
+
+
+class FillFullDataBatchTest(FakeServiceMixin, TestCase):
+    def test_fill_full_data_batch_reports_failures(self):
+        # GIVEN three listed messages, one of them deleted from the mailbox
+        service = FakeGmailService({f"m{i}": make_raw_message(subject=f"Subject {i}") for i in range(2)})
+        self.use_service(service)
+        email_messages = [
+            EmailMessage.objects.create(external_id=external_id, email_account=self.email_account)
+            for external_id in ("m0", "m1", "deleted")
+        ]
+        obj_ids = [email_message.id for email_message in email_messages]
+
+        # WHEN filling them in one chunk (select, first token write, INSERT and SELECT of the bodies and of the
+        # senders, lock of the account, SELECT and INSERT of the clusters, one bulk UPDATE of the messages and one of
+        # the sender counts, in a savepoint)
+        with self.assertNumQueries(13):
+            result = fill_full_data_batch(obj_ids + [0], "EmailMessage")
+
+        # THEN the messages are loaded with one batch request, and the failures are reported
+        self.assertEqual(result, {"updated": 2, "failed": [obj_ids[2], 0]})
+        self.assertEqual([c for c in service.calls if c[0] == "batch"], [("batch", 3)])
+        self.assertEqual(
+            list(EmailMessage.objects.order_by("id").values_list("subject", flat=True)),
+            ["Subject 0", "Subject 1", None],
+        )
+
+    @mock.patch("retriever.tasks.fill_full_data_batch.delay")
+    def test_enqueue_fill_full_data_sends_chunks(self, delay):
+        # GIVEN five messages
+        for i in range(5):
+            EmailMessage.objects.create(external_id=f"m{i}", email_account=self.email_account)
+
+        # WHEN queueing them two by two
+        tasks = enqueue_fill_full_data(EmailMessage.objects.order_by("id"), chunk_size=2)
+
+        # THEN three tasks are sent
+        self.assertEqual(tasks, 3)
+        self.assertEqual([len(c.args[0]) for c in delay.call_args_list], [2, 2, 1])
+
+
+class LoadIdsToEmailMessagesTest(FakeServiceMixin, TestCase):
+    def test_listing_is_stored_page_by_page_and_resumable(self):
+        # GIVEN a mailbox with five messages
+        service = FakeGmailService({f"m{i}": make_raw_message() for i in range(5)})
+        self.use_service(service)
+
+        # WHEN listing is interrupted after two pages of two messages
+        self.email_account.load_ids_to_email_messages(results_per_page=2, max_results=4)
+
+        # THEN those pages are stored and the token of the next page is kept
+        self.assertEqual(self.email_account.email_messages.count(), 4)
+        self.email_account.refresh_from_db()
+        self.assertEqual(self.email_account.list_page_token, "4")
+
+        # WHEN resuming the listing
+        self.email_account.load_ids_to_email_messages(results_per_page=2, max_results=None, resume=True)
+
+        # THEN only the remaining page is requested
+        self.assertEqual(self.email_account.email_messages.count(), 5)
+        self.assertEqual([c for c in service.calls if c[0] == "messages.list"][-1], ("messages.list", "4"))
+        self.email_account.refresh_from_db()
+        self.assertIsNone(self.email_account.list_page_token)
+
+    def test_listing_again_does_not_duplicate_messages(self):
+        # GIVEN an already listed mailbox
+        self.use_service(FakeGmailService({f"m{i}": make_raw_message() for i in range(3)}))
+        self.email_account.load_ids_to_email_messages()
+
+        # WHEN listing it again
+        self.email_account.load_ids_to_email_messages()
+
+        # THEN every message is stored once
+        self.assertEqual(self.email_account.email_messages.count(), 3)
+
+    def test_only_ids_in_the_bloom_filter_are_looked_up(self):
+        # GIVEN a listed mailbox, whose Bloom filter of stored IDs is saved
+        self.use_service(FakeGmailService({f"m{i}": make_raw_message() for i in range(3)}))
+        self.email_account.load_ids_to_email_messages()
+        email_account = EmailAccount.objects.get(id=self.email_account.id)
+        self.assertIn("m0", email_account.message_id_filter)
+
+        # WHEN storing new messages only, THEN they are inserted without lookup
+        with self.assertNumQueries(1):
+            new_messages = email_account.store_message_ids([{"id": "m3", "threadId": "t"}])
+        self.assertEqual([d["id"] for d in new_messages], ["m3"])
+
+        # WHEN storing known and new messages, THEN only the known ones are looked up
+        with self.assertNumQueries(2):
+            new_messages = email_account.store_message_ids([{"id": i, "threadId": "t"} for i in ("m0", "m1", "m4")])
+        self.assertEqual([d["id"] for d in new_messages], ["m4"])
+
+    def test_bloom_filter_false_positives_are_stored(self):
+        # GIVEN a Bloom filter containing an ID which is not stored
+        self.email_account.message_id_filter.add_many(["m0"])
+
+        # WHEN storing that message
+        self.email_account.store_message_ids([{"id": "m0", "threadId": "t"}])
+
+        # THEN it is stored after the exact lookup
+        self.assertEqual(self.email_account.email_messages.get().external_id, "m0")
+
+    def test_concurrent_bloom_filter_saves_keep_every_id(self):
+        # GIVEN a saved Bloom filter, and two processes storing different messages
+        self.email_account.rebuild_message_id_filter()
+        first, second = (EmailAccount.objects.get(id=self.email_account.id) for _ in range(2))
+        first.store_message_ids([{"id": "m0", "threadId": "t"}])
+        second.store_message_ids([{"id": "m1", "threadId": "t"}])
+
+        # WHEN both save their filter
+        first.save_message_id_filter()
+        second.save_message_id_filter()
+
+        # THEN the saved filter contains the IDs of both
+        email_account = EmailAccount.objects.get(id=self.email_account.id)
+        self.assertIn("m0", email_account.message_id_filter)
+        self.assertIn("m1", email_account.message_id_filter)
+
+        # WHEN saving again without new IDs, THEN nothing is written
+        with self.assertNumQueries(0):
+            second.save_message_id_filter()
+
+    def test_rebuild_message_id_filters_command(self):
+        # GIVEN messages stored without Bloom filter
+        EmailMessage.objects.create(external_id="m0", email_account=self.email_account)
+
+        # WHEN rebuilding the filters
+        call_command("rebuild_message_id_filters", stdout=io.StringIO())
+
+        # THEN the saved filter contains the stored IDs
+        email_account = EmailAccount.objects.get(id=self.email_account.id)
+        self.assertTrue(EmailAccountMessageIdFilter.objects.filter(email_account=email_account).exists())
+        self.assertIn("m0", email_account.message_id_filter)
+
+
+class EmailMessageBodyTest(FakeServiceMixin, TestCase):
+    def test_bodies_are_deduplicated_across_accounts(self):
+        # GIVEN messages of two accounts, two of them with the same body
+        other_account = EmailAccount.objects.create(email="other@example.com", service_type=GMAIL)
+        body = "Thanks for subscribing! " * 100
+        first = EmailMessage.objects.create(external_id="m0", email_account=self.email_account, body=body)
+        second = EmailMessage.objects.create(external_id="m0", email_account=other_account, body=body)
+        third = EmailMessage.objects.create(external_id="m1", email_account=self.email_account, body="Hi")
+
+        # THEN the shared body is stored once and compressed
+        self.assertEqual(first.body_content_id, second.body_content_id)
+        self.assertNotEqual(first.body_content_id, third.body_content_id)
+        self.assertEqual(EmailMessageBody.objects.count(), 2)
+        self.assertLess(len(EmailMessageBody.objects.get(id=first.body_content_id).content), len(body))
+
+        # THEN the body reads back transparently
+        self.assertEqual(EmailMessage.objects.select_related("body_content").get(id=second.id).body, body)
+
+    def test_delete_unused_keeps_shared_bodies(self):
+        # GIVEN two messages sharing a body, and a message with its own body
+        for external_id, body in (("m0", "shared"), ("m1", "shared"), ("m2", "own")):
+            EmailMessage.objects.create(external_id=external_id, email_account=self.email_account, body=body)
+
+        # WHEN deleting one message of each body
+        self.email_account.email_messages.filter(external_id__in=["m0", "m2"]).delete()
+
+        # THEN only the body without messages is deleted
+        self.assertEqual(EmailMessageBody.delete_unused(), 1)
+        self.assertEqual(self.email_account.email_messages.get().body, "shared")
+
+
+class LinkSendersTest(FakeServiceMixin, TestCase):
+    def test_senders_are_linked_when_data_is_stored(self):
+        # GIVEN messages from the same address written differently, and from an address without display name
+        senders = ["News <News@Example.com>", "news@example.com", "alerts@example.com", "Weekly <news@example.com>"]
+        self.use_service(
+            FakeGmailService({f"m{i}": make_raw_message(sender=sender) for i, sender in enumerate(senders)})
+        )
+        email_messages = [
+            EmailMessage.objects.create(external_id=f"m{i}", email_account=self.email_account) for i in range(4)
+        ]
+
+        # WHEN loading them in two chunks
+        EmailMessage.load_full_data_batch(email_messages[:2])
+        EmailMessage.load_full_data_batch(email_messages[2:])
+
+        # THEN one sender is stored per address, named after the first header seen
+        self.assertEqual(
+            list(self.email_account.email_message_senders.order_by("email").values_list("email", "name")),
+            [("alerts@example.com", ""), ("news@example.com", "News")],
+        )
+        self.assertEqual(
+            [m.email_sender.email for m in self.email_account.email_messages.order_by("external_id")],
+            ["news@example.com", "news@example.com", "alerts@example.com", "news@example.com"],
+        )
+
+    def test_senders_are_per_account(self):
+        # GIVEN messages of two accounts from the same address
+        other_account = EmailAccount.objects.create(email="other@example.com", service_type=GMAIL)
+        email_messages = [
+            EmailMessage(external_id="m0", email_account=account, sender="news@example.com")
+            for account in (self.email_account, other_account)
+        ]
+
+        # WHEN linking their senders
+        EmailMessageSender.link_senders(email_messages)
+
+        # THEN each account has its own sender
+        self.assertNotEqual(email_messages[0].email_sender_id, email_messages[1].email_sender_id)
+        self.assertEqual(other_account.email_message_senders.get().id, email_messages[1].email_sender_id)
+
+
+class LoadedSendersMixin(FakeServiceMixin):
+    def _date(self, day):
+        return datetime(2024, 1, day, tzinfo=timezone.utc)
+
+    def _load(self, senders_and_days):
+        self.use_service(
+            FakeGmailService(
+                {
+                    f"m{i}": make_raw_message(sender=sender, headers={"Date": format_datetime(self._date(day))})
+                    for i, (sender, day) in enumerate(senders_and_days)
+                }
+            )
+        )
+        email_messages = [
+            EmailMessage.objects.create(external_id=f"m{i}", email_account=self.email_account)
+            for i in range(len(senders_and_days))
+        ]
+        EmailMessage.load_full_data_batch(email_messages)
+
+
+class SenderCountsTest(LoadedSendersMixin, TestCase):
+    def _counts(self):
+        return {
+            sender.email: (sender.number_of_emails, sender.first_seen_at, sender.last_seen_at)
+            for sender in self.email_account.email_message_senders.all()
+        }
+
+    def test_counts_follow_ingestion_relinking_and_deletion(self):
+        # GIVEN three messages from a sender and one from another
+        self._load([("a@example.com", 3), ("a@example.com", 1), ("b@example.com", 2), ("a@example.com", 2)])
+
+        # THEN the counts and dates are stored on the senders
+        self.assertEqual(
+            self._counts(),
+            {
+                "a@example.com": (3, self._date(1), self._date(3)),
+                "b@example.com": (1, self._date(2), self._date(2)),
+            },
+        )
+
+        # WHEN a message is loaded again with another sender, and two messages are deleted
+        email_message = self.email_account.email_messages.get(external_id="m0")
+        email_message.sender = "b@example.com"
+        with transaction.atomic():
+            EmailMessageSender.link_senders([email_message])
+            email_message.save()
+        self.email_account.email_messages.filter(external_id="m1").delete()
+        self.email_account.email_messages.get(external_id="m2").delete()
+
+        # THEN the counts follow, while the dates keep the messages seen so far
+        self.assertEqual(
+            self._counts(),
+            {
+                "a@example.com": (1, self._date(1), self._date(3)),
+                "b@example.com": (1, self._date(2), self._date(3)),
+            },
+        )
+
+    def test_recompute_command_repairs_counts(self):
+        # GIVEN counts that drifted from the messages
+        self._load([("a@example.com", 1), ("a@example.com", 2)])
+        self.email_account.email_message_senders.update(number_of_emails=10, first_seen_at=None)
+
+        # WHEN recomputing them
+        call_command("recompute_sender_counts", email=self.email_account.email, stdout=io.StringIO())
+
+        # THEN they match the messages again
+        self.assertEqual(self._counts(), {"a@example.com": (2, self._date(1), self._date(2))})
+
+
+class TopSendersTest(LoadedSendersMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self._load(
+            [
+                ("news@shop.com", 1),
+                ("news@shop.com", 2),
+                ("deals@shop.com", 2),
+                ("deals@shop.com", 3),
+                ("deals@shop.com", 3),
+                ("friend@mail.org", 3),
+            ]
+        )
+
+    def _top_senders(self, **kwargs):
+        senders = SenderDailyStat.top_senders(self.email_account, **kwargs)
+        return [(sender["email"], sender["number_of_emails"]) for sender in senders]
+
+    def _top_domains(self, **kwargs):
+        domains = SenderDailyStat.top_domains(self.email_account, **kwargs)
+        return [(domain["domain"], domain["number_of_emails"], domain["number_of_senders"]) for domain in domains]
+
+    def test_reports_over_time_windows(self):
+        # THEN all-time and windowed reports are read from the stored counts
+        self.assertEqual(self._top_senders(), [("deals@shop.com", 3), ("news@shop.com", 2), ("friend@mail.org", 1)])
+        self.assertEqual(
+            self._top_senders(since=self._date(2).date(), until=self._date(2).date()),
+            [("news@shop.com", 1), ("deals@shop.com", 1)],
+        )
+        self.assertEqual(self._top_domains(), [("shop.com", 5, 2), ("mail.org", 1, 1)])
+        self.assertEqual(self._top_domains(since=self._date(3).date()), [("shop.com", 2, 1), ("mail.org", 1, 1)])
+
+    def test_deletion_updates_rollups_and_recompute_matches(self):
+        # WHEN deleting the messages of a day
+        self.email_account.email_messages.filter(received_at=self._date(3)).delete()
+
+        # THEN they are gone from the reports
+        self.assertEqual(
+            self._top_senders(since=self._date(1).date()), [("news@shop.com", 2), ("deals@shop.com", 1)]
+        )
+        incremental = set(SenderDailyStat.objects.filter(number_of_emails__gt=0).values_list("email_sender", "day"))
+
+        # THEN rebuilding the rollups from the messages gives the same rows
+        SenderDailyStat.recompute(self.email_account)
+        self.assertEqual(set(SenderDailyStat.objects.values_list("email_sender", "day")), incremental)
+
+    def test_top_senders_command(self):
+        # WHEN showing the top domains
+        stdout = io.StringIO()
+        call_command("top_senders", self.email_account.email, domains=True, limit=1, stdout=stdout)
+
+        # THEN the busiest domain is shown
+        self.assertEqual(stdout.getvalue().split(), ["5", "shop.com", "(2", "senders)"])
+
+
+class SearchTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        messages = {
+            "subject": make_raw_message(subject="Your invoice is ready", body="See attached."),
+            "body": make_raw_message(subject="Monthly update", body="The invoice for March was paid."),
+            "sender": make_raw_message(subject="Hello", sender="Billing <invoices@shop.com>", body="Hi"),
+            "other": make_raw_message(subject="Lunch?", body="Are you free on Friday?"),
+        }
+        self.use_service(FakeGmailService(messages))
+        EmailMessage.load_full_data_batch(
+            [EmailMessage.objects.create(external_id=i, email_account=self.email_account) for i in messages]
+        )
+
+    def test_search_ranks_subject_matches_first(self):
+        # WHEN searching for a word present in a subject and a body
+        email_messages = EmailMessage.objects.search("invoices")
+
+        # THEN both match, the subject match first
+        self.assertEqual([m.external_id for m in email_messages], ["subject", "body"])
+
+        # THEN the web search syntax is supported
+        self.assertEqual([m.external_id for m in EmailMessage.objects.search("invoice -paid")], ["subject"])
+
+    def test_admin_search_matches_headers_and_bodies(self):
+        # GIVEN the admin of the messages
+        model_admin = admin.site._registry[EmailMessage]
+        request = RequestFactory().get("/")
+
+        # WHEN searching for part of a sender address and for a word of a body
+        by_sender, _ = model_admin.get_search_results(request, EmailMessage.objects.all(), "shop.co")
+        by_body, _ = model_admin.get_search_results(request, EmailMessage.objects.all(), "friday")
+
+        # THEN the messages are found
+        self.assertEqual([m.external_id for m in by_sender], ["sender"])
+        self.assertEqual([m.external_id for m in by_body], ["other"])
+
+    def test_admin_search_keeps_the_filters_and_ranks_by_relevance(self):
+        # GIVEN messages of several categories, and an admin
+        EmailMessage.objects.filter(external_id__in=["subject", "sender"]).update(category="finance")
+        EmailMessage.objects.filter(external_id__in=["body", "other"]).update(category="personal")
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+
+        # WHEN searching the finance messages
+        response = self.client.get(
+            reverse("admin:retriever_emailmessage_changelist"), {"category__exact": "finance", "q": "invoice"}
+        )
+
+        # THEN only they are listed, the subject match first, and not the matching body of another category
+        self.assertEqual([m.external_id for m in response.context["cl"].result_list], ["subject", "sender"])
+
+    def test_update_search_vectors_command_indexes_old_messages(self):
+        # GIVEN messages stored before search vectors were maintained
+        EmailMessage.objects.update(search_vector=None)
+
+        # WHEN building their search vectors
+        call_command("update_search_vectors", stdout=io.StringIO())
+
+        # THEN their bodies are searchable
+        self.assertEqual([m.external_id for m in EmailMessage.objects.search("friday")], ["other"])
+
+
+class LoadThreadsTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        messages = {
+            "m0": make_raw_message(
+                subject="Trip", sender="Ann <Ann@example.com>", headers={"Date": "Mon, 01 Jan 2024 10:00:00 +0000"}
+            ),
+            "m1": make_raw_message(
+                subject="Re: Trip",
+                sender="Bob <bob@example.com>",
+                recipient="ann@example.com, Carl <carl@example.com>",
+                body="Sounds good",
+                headers={"Date": "Tue, 02 Jan 2024 10:00:00 +0000"},
+            ),
+            "m2": make_raw_message(subject="Alone"),
+        }
+        self.service = FakeGmailService(messages, threads={"t0": ["m0", "m1"]})
+        self.use_service(self.service)
+
+    def test_load_threads_batch_stores_every_message_and_aggregates(self):
+        # GIVEN only the first message of the thread is listed
+        EmailMessage.objects.create(external_id="m0", thread_id="t0", email_account=self.email_account)
+
+        # WHEN loading the thread
+        failed_ids = EmailThread.load_threads_batch(self.email_account, ["t0", "missing"])
+
+        # THEN the thread was loaded with a single call, the missing thread failed
+        self.assertEqual(failed_ids, ["missing"])
+        self.assertEqual(
+            [c for c in self.service.calls if c[0] != "batch"], [("threads.get", "t0"), ("threads.get", "missing")]
+        )
+
+        # THEN both messages are stored with their body, sender and thread
+        email_thread = EmailThread.objects.get(external_id="t0")
+        email_messages = email_thread.email_messages.order_by("received_at")
+        self.assertEqual([m.external_id for m in email_messages], ["m0", "m1"])
+        self.assertEqual(email_messages[1].body.strip(), "Sounds good")
+        self.assertEqual(email_messages[1].email_sender.email, "bob@example.com")
+
+        # THEN the thread keeps its aggregates
+        self.assertEqual(email_thread.subject, "Trip")
+        self.assertEqual(email_thread.number_of_messages, 2)
+        self.assertEqual(
+            email_thread.participants, ["ann@example.com", "bob@example.com", "carl@example.com", "me@example.com"]
+        )
+        self.assertEqual(email_thread.last_message_at, datetime(2024, 1, 2, 10, tzinfo=timezone.utc))
+
+    @mock.patch("retriever.tasks.fill_threads_batch.delay")
+    @mock.patch("retriever.tasks.fill_full_data_batch.delay")
+    def test_enqueue_fill_threads_only_loads_threads_of_several_messages(self, fill_full_data_batch_delay, delay):
+        # GIVEN the listed messages, two of them in the same thread
+        self.email_account.load_ids_to_email_messages()
+
+        # WHEN queueing their loading
+        tasks = enqueue_fill_threads(EmailMessage.objects.all())
+
+        # THEN the thread is loaded as a whole, and the message alone in its thread with messages.get
+        self.assertEqual(tasks, 2)
+        delay.assert_called_once_with(["t0"], self.email_account.id, None)
+        m2 = EmailMessage.objects.get(external_id="m2")
+        fill_full_data_batch_delay.assert_called_once_with([m2.id], "EmailMessage", None)
+
+
+class MetricsTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics = Metrics()
+        for target in (
+            "retriever.models.get_metrics",
+            "retriever.services.metrics.get_metrics",
+            "retriever.tasks.get_metrics",
+            "retriever.views.get_metrics",
+        ):
+            patcher = mock.patch(target, return_value=self.metrics)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _samples(self, name, label):
+        """
+        The parts of the samples of a metric, by the value of one of their labels.
+        """
+        return {dict(labels)[label]: parts for labels, parts in self.metrics.collect()[name].items()}
+
+    def test_render_in_prometheus_text_format(self):
+        # GIVEN a counter and a histogram
+        self.metrics.increment("gmail_quota_units_total", 1_234_567, account=1, method="messages.get")
+        for seconds in (0.003, 0.2, 100):
+            self.metrics.observe("gmail_api_request_seconds", seconds, account=1, method='a "quoted" method')
+
+        # WHEN rendering them
+        lines = self.metrics.render().splitlines()
+
+        # THEN counters are exact and histogram buckets cumulative, with escaped labels
+        self.assertIn("# TYPE gmail_quota_units_total counter", lines)
+        self.assertIn('gmail_quota_units_total{account="1",method="messages.get"} 1234567', lines)
+        labels = 'account="1",method="a \\"quoted\\" method"'
+        self.assertIn(f'gmail_api_request_seconds_bucket{{{labels},le="0.005"}} 1', lines)
+        self.assertIn(f'gmail_api_request_seconds_bucket{{{labels},le="0.25"}} 2', lines)
+        self.assertIn(f'gmail_api_request_seconds_bucket{{{labels},le="+Inf"}} 3', lines)
+        self.assertIn(f"gmail_api_request_seconds_count{{{labels}}} 3", lines)
+
+        # THEN the summary estimates the percentiles from the buckets
+        row = next(r for r in self.metrics.summary() if r["name"] == "gmail_api_request_seconds")
+        self.assertEqual((row["count"], row["p50"], row["p95"]), (3, 0.25, float("inf")))
+
+    def test_loading_records_api_calls_parsing_and_writes(self):
+        # GIVEN a loader recording its metrics
+        self.use_service(FakeGmailService({f"m{i}": make_raw_message() for i in range(3)}), metrics=self.metrics)
+
+        # WHEN listing and loading the messages
+        self.email_account.load_ids_to_email_messages()
+        EmailMessage.load_full_data_batch(list(self.email_account.email_messages.all()))
+
+        # THEN the calls, quota units, parsed messages and written rows are recorded
+        calls = self._samples("gmail_api_calls_total", "method")
+        self.assertEqual(
+            {method: parts["value"] for method, parts in calls.items()}, {"messages.list": 1, "messages.get": 3}
+        )
+        self.assertEqual(sum(p["value"] for p in self._samples("gmail_quota_units_total", "method").values()), 20)
+        self.assertEqual(self._samples("message_parse_seconds", "format")["raw"]["count"], 3)
+        self.assertGreater(self._samples("message_bytes_total", "format")["raw"]["value"], 0)
+        rows = {
+            operation: parts["value"] for operation, parts in self._samples("db_rows_total", "operation").items()
+        }
+        self.assertEqual(rows, {"store_message_ids": 3, "store_full_data": 3, "save_bodies": 3, "link_senders": 3})
+
+    def test_celery_tasks_are_recorded(self):
+        # GIVEN a listed message
+        self.use_service(FakeGmailService({"m0": make_raw_message()}))
+        email_message = EmailMessage.objects.create(external_id="m0", email_account=self.email_account)
+
+        # WHEN running a task
+        fill_full_data_batch.apply(args=([email_message.id], "EmailMessage"))
+
+        # THEN its duration and state are recorded
+        task = self._samples("celery_task_seconds", "task")["retriever.tasks.fill_full_data_batch"]
+        self.assertEqual(task["count"], 1)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_metrics_endpoint_and_admin_summary(self):
+        # GIVEN a recorded write
+        self.metrics.observe("db_write_seconds", 0.02, operation="store_full_data")
+
+        # WHEN scraping the endpoint without and with the token
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+
+        # THEN the samples are served as text
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('db_write_seconds_count{operation="store_full_data"} 1', response.content.decode())
+
+        # THEN staff users see the summary in the admin
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        response = self.client.get("/admin/metrics/")
+        self.assertContains(response, "db_write_seconds")
+        self.assertContains(response, "operation=store_full_data")
+
+
+class FakeLLM:
+    """
+    Answers "newsletter" for the emails of a prompt mentioning "unsubscribe", and "personal" for the others.
+    """
+
+    def __init__(self, answer=None):
+        self.answer = answer
+        self.prompts = []
+
+    def complete(self, prompt):
+        self.prompts.append(prompt)
+        emails = prompt.split("### Email ")[1:]
+        categories = ["newsletter" if "unsubscribe" in email.lower() else "personal" for email in emails]
+        return CompletionResponse(
+            text=self.answer or "\n".join(f"{i}: {category}" for i, category in enumerate(categories, start=1))
+        )
+
+
+class ClassifyTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.newsletter = (
+            "Issue #{0} of {0} May. Read online at https://news.example.com/{0}?utm=1. Unsubscribe here."
+        )
+        self.messages = {
+            **{
+                f"issue{i}": make_raw_message(
+                    subject=f"Weekly news #{i}", sender="news@example.com", body=self.newsletter.format(i)
+                )
+                for i in range(3)
+            },
+            "lunch": make_raw_message(subject="Lunch?", body="Are you free on Friday?"),
+            "trip": make_raw_message(subject="Trip", body="Here are the photos"),
+        }
+        self.service = FakeGmailService(self.messages)
+        self.use_service(self.service)
+        EmailMessage.load_full_data_batch(
+            [EmailMessage.objects.create(external_id=i, email_account=self.email_account) for i in self.messages]
+        )
+        self.llm = FakeLLM()
+        self.classifier = EmailClassifier(self.llm, "fake", ["personal", "newsletter"], batch_size=2)
+
+    def _categories(self):
+        return dict(EmailMessage.objects.values_list("external_id", "category"))
+
+    def test_repeated_contents_are_inferred_once_in_batches(self):
+        # WHEN classifying the messages with a task
+        with mock.patch("retriever.models.get_classifier", return_value=self.classifier):
+            result = classify_email_messages(list(EmailMessage.objects.values_list("id", flat=True)))
+
+        # THEN every message has its category
+        self.assertEqual(result, {"updated": 5, "failed": []})
+        self.assertEqual(
+            self._categories(),
+            {
+                "issue0": "newsletter",
+                "issue1": "newsletter",
+                "issue2": "newsletter",
+                "lunch": "personal",
+                "trip": "personal",
+            },
+        )
+
+        # THEN the issues of the newsletter, which only differ by numbers and links, were sent to the model once, and
+        # the three distinct contents in two prompts
+        self.assertEqual(len(self.llm.prompts), 2)
+        self.assertEqual(sum(prompt.count("Weekly news") for prompt in self.llm.prompts), 1)
+        self.assertNotIn("https://", "".join(self.llm.prompts))
+
+        # WHEN a new issue comes
+        self.service.raw_messages["issue3"] = make_raw_message(
+            subject="Weekly news #3", sender="news@example.com", body=self.newsletter.format(3)
+        )
+        email_message = EmailMessage.objects.create(external_id="issue3", email_account=self.email_account)
+        email_message.load_full_data()
+        EmailClassification.classify([email_message], self.classifier)
+
+        # THEN it is classified from the cache
+        self.assertEqual(len(self.llm.prompts), 2)
+        self.assertEqual(self._categories()["issue3"], "newsletter")
+
+    def test_bodies_are_truncated_and_invalid_answers_not_cached(self):
+        # GIVEN a model answering with unknown categories, and a budget of 3 tokens per body
+        llm = FakeLLM(answer="1: important")
+        classifier = EmailClassifier(llm, "fake", ["personal", "newsletter"], max_body_tokens=3, chars_per_token=4)
+
+        # WHEN classifying a message
+        email_message = EmailMessage.objects.select_related("body_content").get(external_id="lunch")
+        failed_ids = EmailClassification.classify([email_message], classifier)
+
+        # THEN it is left unclassified, and was shown the first 12 characters of its body
+        self.assertEqual(failed_ids, [email_message.id])
+        self.assertIsNone(self._categories()["lunch"])
+        self.assertFalse(EmailClassification.objects.exists())
+        self.assertIn("Subject: Lunch?\nAre you free\n", llm.prompts[0])
+
+
+class FakeEmbedModel:
+    """
+    Embeds texts as the counts of their words, hashed into 64 dimensions.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def get_text_embedding_batch(self, texts):
+        self.batches.append(texts)
+        vectors = []
+        for text in texts:
+            vector = [0.0] * 64
+            for word in re.findall(r"[a-z]+", text.lower()):
+                vector[zlib.crc32(word.encode("utf-8")) % 64] += 1
+            vectors.append(vector)
+        return vectors
+
+
+class EmbeddingIndexTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = EmbeddingIndex(os.path.join(directory.name, "1"), chunk_rows=3)
+        self.vectors = normalize(np.random.default_rng(0).normal(size=(10, 8)).astype(np.float32))
+
+    def test_appends_are_incremental_and_search_scans_chunks(self):
+        # WHEN appending the vectors of 10 messages in two calls, the second repeating a message
+        self.assertEqual(self.index.append(range(1, 7), self.vectors[:6]), 6)
+        self.assertEqual(self.index.append(range(6, 11), self.vectors[5:]), 4)
+
+        # THEN every message has a single row
+        self.assertEqual(len(self.index), 10)
+        self.assertEqual(self.index.missing([3, 11]), [11])
+
+        # WHEN searching with two queries, in chunks of 3 rows
+        results = self.index.search(self.vectors[[2, 7]], k=4, exclude=[3])
+
+        # THEN each query gets the best rows of a full scan, without the excluded message
+        scores = self.vectors @ self.vectors[[2, 7]].T
+        scores[2] = -np.inf
+        for query, result in enumerate(results):
+            expected_rows = np.argsort(-scores[:, query])[:4]
+            self.assertEqual([i for i, _ in result], (expected_rows + 1).tolist())
+            np.testing.assert_allclose([score for _, score in result], scores[expected_rows, query], rtol=1e-5)
+
+        # THEN the results can be limited to the most similar messages
+        self.assertEqual([i for i, _ in self.index.search(self.vectors[7], k=3, min_score=0.99)[0]], [8])
+
+    def test_interrupted_appends_are_dropped_and_compact_removes_rows(self):
+        # GIVEN an append interrupted after writing a vector but not its message ID
+        self.index.append(range(1, 5), self.vectors[:4])
+        with open(self.index.vectors_path, "ab") as f:
+            f.write(self.vectors[9].tobytes())
+        self.assertEqual(len(self.index), 4)
+
+        # WHEN appending again
+        self.index.append([5], self.vectors[4:5])
+
+        # THEN the partial row was replaced
+        ids, vectors = self.index.open()
+        self.assertEqual(ids.tolist(), [1, 2, 3, 4, 5])
+        np.testing.assert_array_equal(vectors[4], self.vectors[4])
+
+        # WHEN only keeping some messages
+        self.assertEqual(self.index.compact([1, 3, 5, 42]), 2)
+
+        # THEN the other rows are gone
+        self.assertEqual(self.index.open()[0].tolist(), [1, 3, 5])
+        self.assertEqual(self.index.search(self.vectors[2], k=1)[0][0][0], 3)
+
+    def test_interrupted_compactions_keep_the_previous_index(self):
+        # GIVEN an index, and a compaction interrupted before switching to the compacted files
+        self.index.append(range(1, 5), self.vectors[:4])
+        with mock.patch("retriever.services.embeddings.os.replace", side_effect=OSError):
+            with self.assertRaises(OSError):
+                self.index.compact([2, 4])
+
+        # THEN every row is still there, with its vector
+        ids, vectors = self.index.open()
+        self.assertEqual(ids.tolist(), [1, 2, 3, 4])
+        np.testing.assert_array_equal(vectors, self.vectors[:4])
+
+        # WHEN compacting again, then appending
+        self.assertEqual(self.index.compact([2, 4]), 2)
+        self.index.append([5], self.vectors[4:5])
+
+        # THEN the vectors stay aligned with their IDs
+        ids, vectors = self.index.open()
+        self.assertEqual(ids.tolist(), [2, 4, 5])
+        np.testing.assert_array_equal(vectors, self.vectors[[1, 3, 4]])
+
+
+class EmbeddingsTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(EMBEDDINGS_DIR=directory.name, EMBEDDINGS_ON_INGEST=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.embed_model = FakeEmbedModel()
+        patcher = mock.patch("retriever.models.get_embedder", return_value=EmailEmbedder(self.embed_model, "fake"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        newsletter = "Issue {0} of the weekly news. Read online at https://news.example.com/{0}. Unsubscribe here."
+        self.service = FakeGmailService(
+            {
+                **{
+                    f"issue{i}": make_raw_message(subject="Weekly news", body=newsletter.format(i))
+                    for i in range(3)
+                },
+                "lunch": make_raw_message(subject="Lunch?", body="Are you free on Friday?"),
+                "trip": make_raw_message(subject="Trip", body="Here are the photos of the trip"),
+            }
+        )
+        self.use_service(self.service)
+        for external_id in self.service.raw_messages:
+            EmailMessage.objects.create(external_id=external_id, email_account=self.email_account)
+
+    def test_messages_are_embedded_on_ingest_and_similar_ones_found(self):
+        # WHEN loading the messages, with the embedding tasks run right away
+        with mock.patch("retriever.tasks.embed_email_messages.delay", side_effect=embed_email_messages):
+            fill_full_data_batch(list(EmailMessage.objects.values_list("id", flat=True)), "EmailMessage")
+
+        # THEN they were embedded in one batch, without their links
+        self.assertEqual(len(self.email_account.get_embedding_index()), 5)
+        self.assertEqual(len(self.embed_model.batches), 1)
+        self.assertNotIn("https://", "".join(self.embed_model.batches[0]))
+
+        # WHEN looking for the messages similar to a newsletter issue
+        issue = EmailMessage.objects.select_related("email_account", "body_content").get(external_id="issue0")
+        similar = issue.find_similar(limit=3)
+
+        # THEN the other issues come first
+        self.assertEqual({m.external_id for m in similar[:2]}, {"issue1", "issue2"})
+        self.assertGreater(similar[1].similarity, similar[2].similarity)
+
+        # THEN the admin lists them with the selected issue
+        model_admin = admin.site._registry[EmailMessage]
+        response = model_admin.show_similar(RequestFactory().get("/"), EmailMessage.objects.filter(id=issue.id))
+        listed_ids = [int(i) for i in response.url.split("?id__in=")[1].split(",")]
+        self.assertEqual(listed_ids[0], issue.id)
+        # The other issues may tie, in any order
+        self.assertEqual(set(listed_ids[1:3]), {similar[0].id, similar[1].id})
+
+        # WHEN a new message comes, and the missing embeddings are queued
+        self.service.raw_messages["lunch2"] = make_raw_message(subject="Lunch again?", body="Free on Monday?")
+        new_message = EmailMessage.objects.create(external_id="lunch2", email_account=self.email_account)
+        new_message.load_full_data()
+        with mock.patch("retriever.tasks.embed_email_messages.delay") as delay:
+            tasks = enqueue_embed_email_messages(EmailMessage.objects.all())
+
+        # THEN only the new message is embedded
+        self.assertEqual(tasks, 1)
+        delay.assert_called_once_with([new_message.id])
+
+
+class NearDuplicatesTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        newsletter = (
+            "Hello reader, here is issue {0} of the weekly news from the city. This week the council talked about "
+            "the {1}, and what it means for the neighbourhood and its shops. Our reporters met the people behind "
+            "it, read their story online at https://news.example.com/{0}. You receive this email because you "
+            "subscribed to the weekly news. Unsubscribe or manage your preferences at any time."
+        )
+        topics = ["park", "library", "market", "bridge"]
+        self.service = FakeGmailService(
+            {
+                **{
+                    f"issue{i}": make_raw_message(
+                        subject=f"Weekly news #{i}", sender="news@example.com", body=newsletter.format(i, topic)
+                    )
+                    for i, topic in enumerate(topics[:3])
+                },
+                "lunch": make_raw_message(subject="Lunch?", body="Are you free on Friday?"),
+                "trip": make_raw_message(subject="Trip", body="Here are the photos of the trip"),
+            }
+        )
+        self.service.raw_messages["issue3"] = make_raw_message(
+            subject="Weekly news #3", sender="news@example.com", body=newsletter.format(3, topics[3])
+        )
+        self.use_service(self.service)
+        self.email_messages = {
+            external_id: EmailMessage.objects.create(external_id=external_id, email_account=self.email_account)
+            for external_id in ["issue0", "issue1", "issue2", "lunch", "trip"]
+        }
+        EmailMessage.load_full_data_batch(list(self.email_messages.values()))
+
+    def _clusters(self):
+        clusters = defaultdict(set)
+        for external_id, cluster_id in EmailMessage.objects.values_list("external_id", "cluster_id"):
+            clusters[cluster_id].add(external_id)
+        return sorted(map(sorted, clusters.values()))
+
+    def test_near_duplicates_are_clustered_at_ingest_and_classified_once(self):
+        # THEN the issues of the newsletter are in one cluster, represented by the first one
+        self.assertEqual(self._clusters(), [["issue0", "issue1", "issue2"], ["lunch"], ["trip"]])
+        cluster = EmailMessage.objects.get(external_id="issue1").cluster
+        self.assertEqual((cluster.representative.external_id, cluster.number_of_messages), ("issue0", 3))
+
+        # WHEN a new issue comes, and an older one is deleted
+        issue = EmailMessage.objects.create(external_id="issue3", email_account=self.email_account)
+        issue.load_full_data()
+        EmailMessage.objects.get(external_id="issue2").delete()
+
+        # THEN the new issue joins the cluster, and its count follows
+        self.assertEqual(EmailMessage.objects.get(external_id="issue3").cluster_id, cluster.id)
+        cluster.refresh_from_db()
+        self.assertEqual(cluster.number_of_messages, 3)
+
+        # WHEN classifying the messages
+        llm = FakeLLM()
+        classifier = EmailClassifier(llm, "fake", ["personal", "newsletter"])
+        with mock.patch("retriever.models.get_classifier", return_value=classifier):
+            classify_email_messages(list(EmailMessage.objects.values_list("id", flat=True)))
+
+        # THEN the model was only shown the representative of the newsletter, whose category every issue gets
+        self.assertEqual(sum(prompt.count("Weekly news") for prompt in llm.prompts), 1)
+        self.assertEqual(
+            set(EmailMessage.objects.filter(cluster=cluster).values_list("category", flat=True)), {"newsletter"}
+        )
+
+    def test_cluster_messages_command_clusters_older_messages(self):
+        # GIVEN messages stored before near-duplicates were detected
+        EmailMessage.objects.update(minhash=None, cluster=None)
+        EmailMessageCluster.objects.all().delete()
+
+        # WHEN clustering them
+        call_command("cluster_messages", chunk_size=2, stdout=io.StringIO())
+
+        # THEN they are in the same clusters as at ingest
+        self.assertEqual(self._clusters(), [["issue0", "issue1", "issue2"], ["lunch"], ["trip"]])
+        self.assertEqual(
+            sorted(EmailMessageCluster.objects.values_list("number_of_messages", flat=True)), [1, 1, 3]
+        )
+
+        # THEN the admin lists the near-duplicates of a message
+        model_admin = admin.site._registry[EmailMessage]
+        response = model_admin.show_near_duplicates(
+            RequestFactory().get("/"), EmailMessage.objects.filter(external_id="issue2")
+        )
+        cluster_id = EmailMessage.objects.get(external_id="issue2").cluster_id
+        self.assertTrue(response.url.endswith(f"?cluster__id__in={cluster_id}"))
+
+
+class MailboxActionsTest(FakeServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.service = FakeGmailService(
+            {
+                **{
+                    f"news{i}": make_raw_message(subject=f"News #{i}", sender="News <news@example.com>")
+                    for i in range(3)
+                },
+                "lunch": make_raw_message(subject="Lunch?", body="Are you free on Friday?"),
+            }
+        )
+        self.use_service(self.service, scopes=["https://mail.google.com/"])
+        EmailMessage.load_full_data_batch(
+            [
+                EmailMessage.objects.create(external_id=i, email_account=self.email_account)
+                for i in self.service.raw_messages
+            ]
+        )
+        EmailMessage.objects.update(label_ids=["INBOX"])
+        self.news = EmailMessage.objects.filter(email_sender__email="news@example.com")
+
+    def _labels(self):
+        return dict(EmailMessage.objects.values_list("external_id", "label_ids"))
+
+    def test_querysets_are_archived_and_labeled_in_bulk(self):
+        # WHEN archiving the messages of a sender
+        self.assertEqual(self.news.archive(), 3)
+
+        # THEN they were modified with a single call, and their stored labels follow
+        self.assertEqual(
+            [c for c in self.service.calls if c[0] == "messages.batchModify"], [("messages.batchModify", 3)]
+        )
+        self.assertEqual(self._labels(), {"news0": [], "news1": [], "news2": [], "lunch": ["INBOX"]})
+
+        # WHEN labeling them with a new label, through the admin action form and a task
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        with mock.patch("retriever.tasks.modify_email_messages.delay", side_effect=modify_email_messages):
+            self.client.post(
+                reverse("admin:retriever_emailmessage_changelist"),
+                {
+                    "action": "run_add_labels",
+                    "labels": "Newsletters",
+                    "_selected_action": list(self.news.values_list("id", flat=True)),
+                },
+            )
+
+        # THEN the label was created in the mailbox and added
+        [label_id] = [i for i, name in self.service.mailbox_labels.items() if name == "Newsletters"]
+        self.assertEqual(self.service.label_ids["news0"], [label_id])
+        self.assertEqual(self._labels()["news0"], [label_id])
+
+    def test_delete_from_mailbox_asks_for_confirmation(self):
+        # GIVEN an admin selecting the messages of a sender to delete them from the mailbox
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        data = {
+            "action": "run_delete_from_mailbox",
+            "_selected_action": list(self.news.values_list("id", flat=True)),
+        }
+        url = reverse("admin:retriever_emailmessage_changelist")
+
+        # WHEN running the action
+        response = self.client.post(url, data)
+
+        # THEN it asks for a confirmation first
+        self.assertContains(response, "3 messages will be deleted permanently")
+        self.assertEqual(EmailMessage.objects.count(), 4)
+
+        # WHEN confirming
+        with mock.patch(
+            "retriever.tasks.delete_email_messages_from_mailbox.delay",
+            side_effect=delete_email_messages_from_mailbox,
+        ):
+            self.client.post(url, {**data, "post": "yes"})
+
+        # THEN the messages are deleted from the mailbox with one call, and from the database with their counts
+        self.assertEqual(
+            [c for c in self.service.calls if c[0] == "messages.batchDelete"], [("messages.batchDelete", 3)]
+        )
+        self.assertEqual(list(self.service.raw_messages), ["lunch"])
+        self.assertEqual(list(EmailMessage.objects.values_list("external_id", flat=True)), ["lunch"])
+        self.assertEqual(EmailMessageSender.objects.get(email="news@example.com").number_of_emails, 0)
+        self.assertEqual(sorted(EmailMessageCluster.objects.values_list("number_of_messages", flat=True)), [0, 1])
+
+    def test_delete_from_mailbox_of_messages_selected_across_pages(self):
+        # GIVEN an admin selecting every message of a filtered changelist, with one of them checked on the page
+        self.news.update(category="newsletter")
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        url = reverse("admin:retriever_emailmessage_changelist") + "?category__exact=newsletter"
+        data = {
+            "action": "run_delete_from_mailbox",
+            "select_across": "1",
+            "_selected_action": [self.news.first().id],
+        }
+
+        # WHEN running the action, then posting the confirmation form
+        response = self.client.post(url, data)
+        self.assertContains(response, "3 messages will be deleted permanently")
+        confirmation = defaultdict(list)
+        for name, value in re.findall(
+            r'<input type="hidden" name="([^"]+)" value="([^"]*)"', response.content.decode()
+        ):
+            confirmation[name].append(value)
+        with mock.patch("retriever.tasks.delete_email_messages_from_mailbox.delay") as delay:
+            self.client.post(url, confirmation)
+
+        # THEN the messages of the filtered changelist are queued for deletion
+        [(email_message_ids,), _] = delay.call_args
+        self.assertEqual(sorted(email_message_ids), sorted(self.news.values_list("id", flat=True)))
+
+    def test_actions_need_the_scopes_granted_to_the_account(self):
+        # GIVEN an account authorized with the modify scope, but not the one deleting messages
+        EmailAccount.objects.update(
+            token={"token": "token", "scopes": "https://www.googleapis.com/auth/gmail.modify"}
+        )
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        url = reverse("admin:retriever_emailmessage_changelist")
+        selected = list(self.news.values_list("id", flat=True))
+
+        # WHEN deleting messages from the mailbox
+        with mock.patch("retriever.tasks.delete_email_messages_from_mailbox.delay") as delay:
+            response = self.client.post(
+                url, {"action": "run_delete_from_mailbox", "_selected_action": selected, "post": "yes"}, follow=True
+            )
+
+        # THEN nothing is queued, and the admin is asked to authorize the account again
+        delay.assert_not_called()
+        self.assertContains(response, "Authorize me@example.com again with the https://mail.google.com/ scope")
+
+        # WHEN archiving them, THEN they are queued
+        with mock.patch("retriever.tasks.modify_email_messages.delay") as delay:
+            self.client.post(url, {"action": "run_archive", "_selected_action": selected})
+        delay.assert_called_once()
+
+        # GIVEN an account authorized to read its messages only, WHEN archiving them, THEN nothing is queued
+        EmailAccount.objects.update(
+            token={"token": "token", "scopes": ["https://www.googleapis.com/auth/gmail.readonly"]}
+        )
+        with mock.patch("retriever.tasks.modify_email_messages.delay") as delay:
+            self.client.post(url, {"action": "run_archive", "_selected_action": selected})
+        delay.assert_not_called()
@@ -1 +1,41 @@
-# Create your views here.
+import redis
+from django.conf import settings
+from django.contrib import admin
+from django.http import Http404, HttpResponse
+from django.template.response import TemplateResponse
+
+from retriever.services.metrics import get_metrics
+
+
+def metrics(request):
+    """
+    Serve the pipeline metrics of every process in the Prometheus text format.
+    """
+    if settings.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponse(status=401)
+    pipeline_metrics = get_metrics()
+    if pipeline_metrics is None:
+        raise Http404("Metrics are disabled")
+
+    try:
+        content = pipeline_metrics.render()
+    except redis.RedisError:
+        return HttpResponse("Metrics are unavailable", status=503)
+    return HttpResponse(content, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def metrics_summary(request):
+    """
+    Admin page summarizing the pipeline metrics: counts, mean and percentile latencies of every stage.
+    """
+    pipeline_metrics = get_metrics()
+    context = {
+        **admin.site.each_context(request),
+        "title": "Pipeline metrics",
+        "enabled": pipeline_metrics is not None,
+    }
+    try:
+        context["rows"] = pipeline_metrics.summary() if pipeline_metrics else []
+    except redis.RedisError as e:
+        context["rows"], context["error"] = [], str(e)
+    return TemplateResponse(request, "admin/retriever/metrics_summary.html", context)
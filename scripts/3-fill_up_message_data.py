@@ -1,5 +1,5 @@
 import django
-from retriever.tasks import fill_full_data
+from retriever.tasks import enqueue_fill_full_data
 from retriever.models import EmailAccount
 
 django.setup()
@@ -8,7 +8,6 @@ EMAIL_ADDRESS = "example@gmail.com"
 
 email_account = EmailAccount.objects.get(email=EMAIL_ADDRESS)
 
-email_messages = email_account.emailmessage_set.filter(subject__isnull=True)
+email_messages = email_account.email_messages.filter(subject__isnull=True)
 
-for i in email_messages:
-    fill_full_data.delay(i.id, "EmailMessage")
+enqueue_fill_full_data(email_messages)
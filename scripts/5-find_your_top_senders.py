@@ -1,14 +1,17 @@
 # initiate django
 
 import django
-from retriever.models import EmailAccount, EmailMessageSender, EmailMessage
-import re
 
 django.setup()
 
+from retriever.models import EmailAccount, SenderDailyStat  # noqa: E402
+
 # Select the email account
 email_account = EmailAccount.objects.first()
 
-email_senders = email_account.email_senders.all().values("email").distinct()
+# Senders and domains that sent the most messages, all time
+for sender in SenderDailyStat.top_senders(email_account, limit=20):
+    print(f"{sender['number_of_emails']:>8}  {sender['name'] or ''} <{sender['email']}>")
 
-email_messages = email_account.email_messages.all()
+for domain in SenderDailyStat.top_domains(email_account, limit=20):
+    print(f"{domain['number_of_emails']:>8}  {domain['domain']} ({domain['number_of_senders']} senders)")